@@ -0,0 +1,71 @@
+import unittest
+import mock
+
+from xqueue_watcher import autoscale
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.polls = 0
+        self.empty_polls = 0
+        self.grading_time = 0.0
+
+    def run_for(self, seconds, polls, empty, busy):
+        self.polls += polls
+        self.empty_polls += empty
+        self.grading_time += seconds * busy
+
+
+class AutoscalerTests(unittest.TestCase):
+    def setUp(self):
+        self.scaler = autoscale.Autoscaler(cooldown=30, max_load=1.0)
+        self.scaler.add_queue('q', 1, 6)
+        patcher = mock.patch('xqueue_watcher.autoscale.host_load', return_value=0.5)
+        self.load = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _step(self, clients, now, polls, empty, busy, depth=None):
+        for c in clients:
+            c.run_for(60, polls, empty, busy)
+        return self.scaler.desired('q', clients, depth=depth, now=now)
+
+    def test_scale_up_and_down(self):
+        clients = [FakeClient(), FakeClient()]
+        self.assertEqual(self.scaler.desired('q', clients, now=0), 2)
+        # backlog: no empty polls, connections grading all the time
+        self.assertEqual(self._step(clients, 60, 10, 0, 0.95), 3)
+        clients.append(FakeClient())
+        # in between the thresholds nothing changes
+        self.assertEqual(self._step(clients, 120, 10, 3, 0.5), 3)
+        # idle: mostly empty polls
+        self.assertEqual(self._step(clients, 180, 10, 9, 0.05), 2)
+
+    def test_cooldown(self):
+        clients = [FakeClient(), FakeClient()]
+        self.scaler.desired('q', clients, now=0)
+        self.assertEqual(self._step(clients, 60, 10, 0, 0.95), 3)
+        clients.append(FakeClient())
+        self.assertEqual(self._step(clients, 70, 10, 10, 0), 3)
+        self.assertEqual(self._step(clients, 100, 10, 10, 0), 2)
+
+    def test_bounds(self):
+        clients = [FakeClient() for i in range(6)]
+        self.scaler.desired('q', clients, now=0)
+        self.assertEqual(self._step(clients, 60, 10, 0, 1), 6)
+        clients = [FakeClient()]
+        self.scaler.desired('q', clients, now=200)
+        self.assertEqual(self._step(clients, 260, 10, 10, 0), 1)
+
+    def test_host_load(self):
+        clients = [FakeClient(), FakeClient()]
+        self.scaler.desired('q', clients, now=0)
+        self.load.return_value = 1.5
+        self.assertEqual(self._step(clients, 60, 10, 0, 0.95), 2)
+
+    def test_queue_depth(self):
+        clients = [FakeClient(), FakeClient()]
+        self.scaler.desired('q', clients, now=0)
+        # with the queue length known the empty polls don't matter
+        self.assertEqual(self._step(clients, 60, 10, 5, 0.9, depth=20), 3)
+        clients.append(FakeClient())
+        self.assertEqual(self._step(clients, 120, 10, 0, 0.1, depth=0), 2)
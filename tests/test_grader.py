@@ -11,6 +11,8 @@ MYDIR = path(__file__).dirname() / 'fixtures'
 
 
 class MockGrader(grader.Grader):
+    thread_safe = True
+
     def grade(self, grader_path, grader_config, student_response):
         tests = []
         errors = []
@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import mock
+
+from xqueue_watcher import journal
+from xqueue_watcher import client, servers
+from tests.test_xqueue_client import MockXQueueServer
+
+
+def envelope(submission_id):
+    return json.dumps({
+        'xqueue_header': json.dumps({'submission_id': submission_id}),
+        'xqueue_body': json.dumps({'student_response': 'answer'}),
+    })
+
+
+class JournalTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'test.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_recovery(self):
+        log = journal.Journal(self.filename)
+        self.assertEqual(log.claim(), [])
+        for i in range(3):
+            log.fetched(json.dumps({'submission_id': i}), envelope(i))
+        log.graded(json.dumps({'submission_id': 1}), {'score': 1})
+        log.done(json.dumps({'submission_id': 2}))
+        log.close()
+
+        log = journal.Journal(self.filename)
+        recovered = log.claim()
+        self.assertEqual([entry['content'] for entry in recovered], [envelope(0), envelope(1)])
+        self.assertEqual([entry['results'] for entry in recovered], [[], [{'score': 1}]])
+        # only handed out once
+        self.assertEqual(log.claim(), [])
+        self.assertEqual(log.unfinished, 2)
+
+    def test_compaction(self):
+        log = journal.Journal(self.filename, fsync='never')
+        with mock.patch.object(journal.Journal, 'COMPACT_RECORDS', 10):
+            log.fetched('open', envelope(0))
+            for i in range(20):
+                log.fetched(str(i), envelope(i))
+                log.done(str(i))
+        with open(self.filename) as fd:
+            self.assertLess(len(fd.readlines()), 12)
+        log.close()
+        self.assertEqual([entry['key'] for entry in journal.Journal(self.filename).claim()], ['open'])
+
+    def test_fsync_policy(self):
+        self.assertRaises(ValueError, journal.Journal, self.filename, fsync='sometimes')
+        log = journal.Journal(self.filename, fsync='interval', fsync_interval=0)
+        with mock.patch.object(log.log, 'sync') as sync:
+            log.fetched('a', envelope(0))
+        self.assertTrue(sync.called)
+        log.close()
+
+
+class JournalClientTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(servers._servers, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.filename = os.path.join(self.dir, 'test.journal')
+
+    def _client(self):
+        c = client.XQueueClient('test', xqueue_server='TEST')
+        c.session = MockXQueueServer()
+        c.journal = journal.Journal(self.filename)
+        self.addCleanup(c.journal.close)
+        return c
+
+    def test_journaled_submission(self):
+        c = self._client()
+        c.session._json = {'return_code': 0, 'content': envelope(1)}
+        c.add_handler(lambda submission: {'score': 1})
+        self.assertTrue(c.process_one())
+        self.assertEqual(c.journal.unfinished, 0)
+
+        # a failed post leaves the submission for the next run
+        c.session._url_checker = lambda url, response, session: (
+            url.endswith('put_result/') and setattr(response, 'status_code', 500))
+        c.process_one()
+        self.assertEqual(c.journal.unfinished, 1)
+
+    def test_recover(self):
+        log = journal.Journal(self.filename)
+        log.fetched(json.dumps({'submission_id': 1}), envelope(1))
+        log.fetched(json.dumps({'submission_id': 2}), envelope(2))
+        log.graded(json.dumps({'submission_id': 2}), {'score': 2})
+        log.close()
+
+        c = self._client()
+        c.session._json = {'return_code': 0, 'content': 'ok'}
+        graded = []
+        c.add_handler(lambda submission: graded.append(submission.header) or {'score': 1})
+        c._recover()
+        # the first is graded again, the second only posted
+        self.assertEqual(graded, [json.dumps({'submission_id': 1})])
+        posted = [json.loads(r.kwargs['data']['xqueue_body']) for r in c.session._requests]
+        self.assertEqual(posted, [{'score': 1}, {'score': 2}])
+        self.assertEqual(c.journal.unfinished, 0)
+
+    def test_pipelined(self):
+        c = client.PipelinedXQueueClientThread('test', xqueue_server='TEST', poll_interval=0.01)
+        c.session = MockXQueueServer()
+        c.session._json = {'return_code': 0, 'content': envelope(1)}
+        c.journal = journal.Journal(self.filename)
+        self.addCleanup(c.journal.close)
+        posted = []
+        c.add_handler(lambda submission: {'score': 1})
+        with mock.patch.object(c.journal, 'done', side_effect=posted.append):
+            c.start()
+            time.sleep(.1)
+            c.shutdown()
+            c.join(5)
+        # marked done by the poster, after the results were posted
+        self.assertTrue(posted)
+        self.assertEqual(len(posted), len([r for r in c.session._requests
+                                           if r.url.endswith('put_result/')]))
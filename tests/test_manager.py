@@ -2,12 +2,12 @@ from StringIO import StringIO
 import unittest
 from path import path
 import json
-from mock import Mock
+from mock import Mock, patch
 import time
 import sys
 
 import logging
-from xqueue_watcher import manager
+from xqueue_watcher import manager, client, supervisor, workers, spool, journal
 from tests.test_xqueue_client import MockXQueueServer
 
 try:
@@ -17,6 +17,17 @@ except ImportError:
     HAS_CODEJAIL = False
 
 
+class Unsafe(object):
+    """
+    Handler keeping state between calls.
+    """
+    def __init__(self):
+        self.last = None
+
+    def __call__(self, content):
+        self.last = content
+
+
 class ManagerTests(unittest.TestCase):
     def setUp(self):
         self.m = manager.Manager()
@@ -42,6 +53,12 @@ class ManagerTests(unittest.TestCase):
             }
         }
 
+    def _mock_client(self, queue_name, config):
+        import threading
+        return Mock(spec=client.XQueueClientThread, queue_name=queue_name, running=True,
+                    result_sender=None, in_flight={}, in_flight_lock=threading.Lock(),
+                    siblings=[])
+
     def tearDown(self):
         try:
             self.m.shutdown()
@@ -55,6 +72,61 @@ class ManagerTests(unittest.TestCase):
             if c.queue_name == 'test2':
                 self.assertEqual(c.xqueue_server, 'http://test2')
 
+    def test_server_list(self):
+        config = self.config['test1']
+        config.update(SERVER=['http://test1', 'http://test3'], CONNECTIONS=2)
+        self.m.configure({'test1': config})
+        preferred = [c.xqueue_server for c in self.m.clients]
+        self.assertEqual(sorted(preferred), ['http://test1', 'http://test3'])
+
+    def test_grading_workers(self):
+        self.m.manager_config['GRADING_WORKERS'] = 4
+        config = dict(self.config['test1'], WEIGHT=2, MAX_SHARE=0.5)
+        self.m.configure({'test1': config})
+        self.assertEqual(self.m.scheduler.workers, 4)
+        share = self.m.scheduler.queues['test1']
+        self.assertEqual((share.weight, share.max_workers), (2, 2))
+        self.assertIs(self.m.clients[0].scheduler, self.m.scheduler)
+
+    def test_autoscale(self):
+        config = dict(self.config['test1'], CONNECTIONS=1, MAX_CONNECTIONS=3)
+        self.m.configure({'test1': config})
+        self.assertEqual(len(self.m.clients), 1)
+        self.assertEqual(self.m.autoscaler.queues['test1'].maximum, 3)
+        self.m.autoscaler = Mock(queues={'test1': None})
+        self.m.autoscaler.desired.return_value = 2
+        self.m.client_from_config = self._mock_client
+        self.m.autoscale()
+        self.assertEqual(len(self.m.clients), 2)
+        self.m.clients[1].start.assert_called_once_with()
+        self.m.autoscaler.desired.return_value = 1
+        retired = self.m.clients[1]
+        retired.is_alive.return_value = True
+        self.m.autoscale()
+        self.assertEqual(len(self.m.clients), 1)
+        self.assertEqual(self.m.retiring, [retired])
+        retired.drain.assert_called_once_with()
+        retired.is_alive.return_value = False
+        self.m.reap_retired()
+        self.assertEqual(self.m.retiring, [])
+        retired.shutdown.assert_called_once_with()
+
+    def test_autoscale_async(self):
+        config = dict(self.config['test1'], CLASS='AsyncXQueueClient', MAX_CONNECTIONS=2)
+        self.m.configure({'test1': config})
+        self.m.autoscaler = Mock(queues={'test1': None})
+        self.m.autoscaler.desired.return_value = 2
+        with patch.object(client.AsyncXQueueClient, 'start'):
+            self.m.autoscale()
+        self.assertEqual(len(self.m.clients), 2)
+
+        # processes keep their statistics to themselves
+        self.m.autoscaler.desired.reset_mock()
+        self.m.clients = [Mock(spec=workers.WorkerProcess, queue_name='test1')]
+        self.m.autoscale()
+        self.assertFalse(self.m.autoscaler.desired.called)
+        self.m.clients = []
+
     @unittest.skipUnless(HAS_CODEJAIL, "Codejail not installed")
     def test_codejail_config(self):
         config = {
@@ -115,39 +187,308 @@ class ManagerTests(unittest.TestCase):
         # no-op
         self.m.wait()
 
-        self.m.configure(self.config)
+        self.m.manager_config['POLL_TIME'] = 1
+        self.m.manager_config['RESTART_MAX_CRASHES'] = 0
+        self.m.configure({'test1': self.config['test1']})
+        for c in self.m.clients:
+            c.session = MockXQueueServer()
+            c.session._json = {'return_code': 0, 'msg': 'logged in'}
+            # the client thread dies, and with no restarts allowed the manager exits
+            c.process_one = Mock(side_effect=RuntimeError('crash'))
 
-        def slow_reply(url, response, session):
-            if url.endswith('get_submission/'):
-                response.json.return_value = {
-                    u'return_code': 0,
-                    u'success': 1,
-                    u'content': json.dumps({
-                        u'xqueue_header': {u'hello': 1},
-                        u'xqueue_body': {
-                            u'blah': json.dumps({}),
-                        }
-                    })
-                }
-            if url.endswith('put_result/'):
-                time.sleep(2)
+        self.m.start()
+        started = time.time()
+        self.assertRaises(SystemExit, self.m.wait)
+        self.assertLess(time.time() - started, 1)
 
-        import threading
-        def stopper(client):
-            time.sleep(.4)
-            client.running = False
+    def test_restart(self):
+        self.m.manager_config['RESTART_BACKOFF'] = 0.1
+        self.m.manager_config['RESTART_MAX_CRASHES'] = 1
+        self.m.configure({'test1': self.config['test1']})
+        self.m.client_from_config = self._mock_client
+        crashed = self.m.clients[0]
+        self.m.supervisor = supervisor.Supervisor(backoff=0.1, max_crashes=1)
+        self.m.client_exited(crashed)
+        self.assertEqual(self.m.clients, [])
+        self.m.restart_due()
+        self.assertEqual(self.m.clients, [])
+        time.sleep(0.15)
+        self.m.restart_due()
+        self.assertEqual(len(self.m.clients), 1)
+        self.m.clients[0].start.assert_called_once_with()
+        self.assertEqual(self.m.supervisor.restarts['test1'], 1)
 
-        for c in self.m.clients:
-            c.session = MockXQueueServer()
-            c._json = {'return_code': 0, 'msg': 'logged in'}
-            c.session._url_checker = slow_reply
-            c.session._json = {'return_code': 0}
+        # a client shut down on purpose is not restarted
+        self.m.clients[0].running = False
+        self.m.client_exited(self.m.clients[0])
+        self.assertEqual(self.m.pending_restarts, [])
+
+        # the second crash within the window is a crash loop
+        self.m.clients[0].running = True
+        self.assertRaises(SystemExit, self.m.client_exited, self.m.clients[0])
+
+    def test_crash_loop(self):
+        self.m.configure({'test1': self.config['test1']})
+        self.m.supervisor = supervisor.Supervisor(backoff=0.1, max_crashes=0)
+        # never restarted, even if shutdown() returns
+        with patch.object(self.m, 'shutdown') as shutdown:
+            self.m.client_exited(self.m.clients[0])
+        shutdown.assert_called_once_with()
+        self.assertEqual(self.m.pending_restarts, [])
+
+    def test_restart_index(self):
+        self.m.manager_config['RESTART_BACKOFF'] = 0
+        self.m.configure({'test1': dict(self.config['test1'], CONNECTIONS=3)})
+        self.assertEqual([c.index for c in self.m.clients], [0, 1, 2])
+        self.m.client_from_config = self._mock_client
+        self.m.supervisor = supervisor.Supervisor(backoff=0, max_crashes=5)
+        # the restarted client takes the crashed one's index
+        self.m.client_exited(self.m.clients[1])
+        self.m.restart_due()
+        self.assertEqual([c.index for c in self.m.clients], [0, 2, 1])
+        # not that of a retiring one
+        self.m.retiring.append(self.m.clients.pop(1))
+        self.assertEqual(self.m.add_client('test1').index, 3)
+
+    def test_drain(self):
+        import threading
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.m.manager_config['DRAIN_TIMEOUT'] = 0.3
+        self.m.configure({'test1': self.config['test1']})
+        c = self.m.clients[0]
+        c.session = MockXQueueServer()
+        c.session._json = {
+            'return_code': 0, 'success': 1,
+            'content': json.dumps({'xqueue_header': {'hello': 1}, 'xqueue_body': {}})
+        }
+        c.handlers = [lambda content: release.wait(5) and {'result': True}]
+        self.m.start()
+        for i in range(50):
+            if c.in_flight:
+                break
+            time.sleep(.02)
+        started = time.time()
+        self.assertRaises(SystemExit, self.m.shutdown)
+        self.assertLess(time.time() - started, 1)
+        # still grading at the deadline: abandoned, and the session closed
+        self.assertEqual(list(c.in_flight), ['{"hello": 1}'])
+        self.assertFalse(c.session._open)
 
-        self.m.poll_time = 1
+    def test_second_shutdown(self):
+        import threading
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.m.manager_config['DRAIN_TIMEOUT'] = 5
+        self.m.configure({'test1': self.config['test1']})
+        c = self.m.clients[0]
+        c.session = MockXQueueServer()
+        c.session._json = {
+            'return_code': 0, 'success': 1,
+            'content': json.dumps({'xqueue_header': {'hello': 1}, 'xqueue_body': {}})
+        }
+        c.handlers = [lambda content: release.wait(5) and {'result': True}]
         self.m.start()
-        threading.Thread(target=stopper, args=(self.m.clients[0],)).start()
+        for i in range(50):
+            if c.in_flight:
+                break
+            time.sleep(.02)
+        first = threading.Thread(target=self.m.shutdown)
+        first.daemon = True
+        first.start()
+        time.sleep(.1)
+        # another SIGTERM during the drain still accounts for the clients
+        with patch.object(manager, 'statsd') as statsd:
+            self.assertRaises(SystemExit, self.m.shutdown)
+        statsd.gauge.assert_called_with('xqueuewatcher.abandoned', 1)
 
-        self.assertRaises(SystemExit, self.m.wait)
+    def test_reload(self):
+        import tempfile
+        root = path(tempfile.mkdtemp())
+        self.addCleanup(root.rmtree)
+        (root / 'conf.d').mkdir()
+        queues = {
+            'same': dict(self.config['test1']),
+            'resized': dict(self.config['test1']),
+            'changed': dict(self.config['test1']),
+            'removed': dict(self.config['test1']),
+        }
+        (root / 'conf.d' / 'queues.json').write_text(json.dumps(queues))
+        self.m.client_from_config = self._mock_client
+        self.m.configure_from_directory(root)
+        before = dict((c.queue_name, c) for c in self.m.clients)
+        self.assertEqual(sorted(before), ['changed', 'removed', 'resized', 'same'])
+
+        del queues['removed']
+        queues['resized']['CONNECTIONS'] = 2
+        queues['changed']['HANDLERS'] = []
+        queues['added'] = dict(self.config['test1'])
+        (root / 'conf.d' / 'queues.json').write_text(json.dumps(queues, indent=1))
+        self.assertNotEqual(self.m.config_signature(), self.m.config_mark)
+        self.m.reload()
+        self.assertEqual(self.m.config_signature(), self.m.config_mark)
+
+        after = dict((name, self.m.queue_clients(name)) for name in queues)
+        self.assertEqual(after['same'], [before['same']])
+        before['same'].start.assert_not_called()
+        self.assertEqual(after['resized'][0], before['resized'])
+        self.assertEqual(len(after['resized']), 2)
+        after['resized'][1].start.assert_called_once_with()
+        self.assertNotIn(before['changed'], after['changed'])
+        self.assertEqual(len(after['changed']), 1)
+        self.assertEqual(len(after['added']), 1)
+        self.assertEqual(self.m.queue_clients('removed'), [])
+        self.assertEqual(set(self.m.retiring), set([before['changed'], before['removed']]))
+        before['removed'].drain.assert_called_once_with()
+
+    def test_reload_starts_sender(self):
+        import tempfile
+        import shutil
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        self.m.manager_config['RESULT_SPOOL_DIR'] = spool_dir
+        self.m.configure({'test1': self.config['test1']})
+        watcher = self.m.clients[0]
+        watcher.start = Mock()
+        self.assertIsNone(watcher.result_sender.ident)
+        # as reload() does for a queue on a server no sender was started for
+        self.m.start_client(watcher)
+        self.assertTrue(watcher.result_sender.is_alive())
+
+    def test_client_process_journal(self):
+        import tempfile
+        import shutil
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        for registry in (journal._journals, spool._senders):
+            patcher = patch.dict(registry, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.m.manager_config['JOURNAL_DIR'] = journal_dir
+        self.m.manager_config['RESULT_SPOOL_DIR'] = journal_dir
+        config = dict(self.config['test1'], CLASS='XQueueClientProcess', CONNECTIONS=2)
+        self.m.configure({'test1': config})
+        first, second = self.m.clients
+        # opened by each process for itself, not in the manager
+        self.assertIsNone(first.journal)
+        self.assertIsNone(first.result_sender)
+        self.assertEqual(self.m.journals, [])
+        self.assertEqual(self.m.result_senders, [])
+        self.assertTrue(first.open_journal().filename.endswith('test1-0.journal'))
+        self.assertTrue(second.open_journal().filename.endswith('test1-1.journal'))
+        self.assertTrue(first.open_sender().spool.filename.endswith('test1-0.spool'))
+        self.assertTrue(second.open_sender().spool.filename.endswith('test1-1.spool'))
+
+    def test_worker_processes(self):
+        self.m.manager_config['HEALTH_INTERVAL'] = 0.1
+        # no login: the processes have servers of their own, not logged in by another test
+        config = dict(self.config['test1'], PROCESSES=2, CONNECTIONS=3, AUTH=(None, None))
+        self.m.configure({'test1': config})
+        self.assertEqual(len(self.m.clients), 2)
+        worker = self.m.clients[0]
+        self.assertIsInstance(worker, workers.WorkerProcess)
+
+        import tempfile
+        import shutil
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        self.m.manager_config['RESULT_SPOOL_DIR'] = spool_dir
+
+        # the threads of a process share its handlers, and a spool of its own
+        clients = worker._make_clients()
+        self.assertEqual(len(clients), 3)
+        self.assertIs(clients[0].handlers[0], clients[2].handlers[0])
+        self.assertIs(clients[0].result_sender, clients[2].result_sender)
+        self.assertTrue(clients[0].result_sender.spool.filename.endswith('test1-0.spool'))
+
+        def client_from_config(queue_name, config, **kwargs):
+            watcher = manager.Manager.client_from_config(self.m, queue_name, config, **kwargs)
+            watcher.session = MockXQueueServer()
+            watcher.session._json = {'return_code': 1, 'content': 'empty'}
+            return watcher
+        self.m.client_from_config = client_from_config
+        self.m.start_client(worker)
+        self.addCleanup(worker.terminate)
+        for i in range(50):
+            health = worker.read_health()
+            if health and health['threads'] == 3:
+                break
+            time.sleep(.05)
+        self.assertEqual(health['threads'], 3)
+        self.assertTrue(worker.healthy)
+        self.assertEqual(worker.in_flight, {})
+
+        worker.drain()
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(worker.read_health()['threads'], 0)
+        self.m.clients.remove(worker)
+
+    def test_worker_stalled(self):
+        self.m.configure({'test1': dict(self.config['test1'], PROCESSES=1, CONNECTIONS=2)})
+        worker = self.m.clients[0]
+        stuck = Mock(processing=False, in_flight={}, turned_at=time.time() - 60, idle_until=0)
+        stuck.is_alive.return_value = True
+        self.assertTrue(worker._stalled(stuck))
+        # not while it grades or sleeps on purpose
+        stuck.processing = True
+        self.assertFalse(worker._stalled(stuck))
+        stuck.processing = False
+        stuck.idle_until = time.time() + 60
+        self.assertFalse(worker._stalled(stuck))
+
+        worker.health = {'stalled': 1, 'in_flight': []}
+        worker.health_at = time.time()
+        self.assertFalse(worker.healthy)
+        worker.health['stalled'] = 0
+        self.assertTrue(worker.healthy)
+
+    def test_worker_reset(self):
+        from xqueue_watcher import servers
+        self.m.configure({'test1': dict(self.config['test1'], PROCESSES=1, CONNECTIONS=2)})
+        worker = self.m.clients[0]
+        for registry in (servers._servers, journal._journals, spool._senders):
+            patcher = patch.dict(registry)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        inherited = servers.get_server('http://test1')
+        journal._journals['test1-0'] = Mock()
+        worker._reset()
+        # the copies forked from the manager are dropped
+        self.assertEqual(journal._journals, {})
+        server = servers.get_server('http://test1')
+        self.assertIsNot(server, inherited)
+        self.assertEqual(server.connections, 2)
+
+    def test_shared_handlers(self):
+        config = dict(self.config['test1'], CONNECTIONS=3)
+        config['HANDLERS'] = config['HANDLERS'] + [{'HANDLER': 'tests.test_manager.Unsafe'}]
+        self.m.configure({'test1': config})
+        graders = set(id(c.handlers[0]) for c in self.m.clients)
+        unsafe = set(id(c.handlers[1]) for c in self.m.clients)
+        # thread safe handlers are built once per queue, the others per connection
+        self.assertEqual(len(graders), 1)
+        self.assertEqual(len(unsafe), 3)
+
+    def test_steal_pool(self):
+        pooled = dict(self.config['test1'], STEAL_POOL='python', CONNECTIONS=2)
+        self.m.configure({
+            'test1': pooled,
+            'test3': dict(pooled, STEAL_MAX=2),
+            'test4': dict(pooled, SERVER='http://test4'),
+            'test5': dict(self.config['test1']),
+        })
+        for c in self.m.clients:
+            self.m.set_siblings(c)
+        test1 = self.m.queue_clients('test1')[0]
+        # the same pool on the same server only
+        self.assertEqual([(s.queue_name, depth) for s, depth in test1.siblings], [('test3', 2)])
+        self.assertEqual(type(test1.siblings[0][0]), client.XQueueClient)
+        self.assertIs(test1.steal_slots, self.m.queue_clients('test1')[1].steal_slots)
+        self.assertEqual(self.m.queue_clients('test4')[0].siblings, [])
+        self.assertEqual(self.m.queue_clients('test5')[0].siblings, [])
+        self.assertIsNone(self.m.queue_clients('test5')[0].steal_slots)
 
     def test_main_with_errors(self):
         stderr = sys.stderr
@@ -0,0 +1,72 @@
+import unittest
+import mock
+
+from xqueue_watcher import polling
+
+
+class PollBackoffTests(unittest.TestCase):
+    def test_grows_to_maximum(self):
+        backoff = polling.PollBackoff(1, 5, factor=2, jitter=0)
+        delays = [backoff.next_delay() for i in range(5)]
+        self.assertEqual(delays, [1, 2, 4, 5, 5])
+
+        backoff.reset()
+        self.assertEqual(backoff.next_delay(), 1)
+
+    def test_jitter(self):
+        backoff = polling.PollBackoff(4, 4, jitter=0.5)
+        with mock.patch('random.random', return_value=1):
+            self.assertEqual(backoff.next_delay(), 2)
+        with mock.patch('random.random', return_value=0):
+            self.assertEqual(backoff.next_delay(), 4)
+
+
+class QueueLengthProbeTests(unittest.TestCase):
+    def test_shared_refresh(self):
+        probe = polling.QueueLengthProbe('test', interval=60)
+        fetch = mock.Mock(return_value=(True, 2))
+        self.assertEqual(probe.get(fetch), 2)
+        self.assertEqual(probe.get(fetch), 2)
+        self.assertEqual(fetch.call_count, 1)
+
+        probe.claim()
+        probe.claim()
+        probe.claim()
+        self.assertEqual(probe.get(fetch), 0)
+
+    def test_failed_fetch(self):
+        probe = polling.QueueLengthProbe('test', interval=0)
+        self.assertIsNone(probe.get(lambda: (False, 'error')))
+        self.assertEqual(probe.get(lambda: (True, '3')), 3)
+
+
+class RttEstimatorTests(unittest.TestCase):
+    def test_estimate(self):
+        rtt = polling.RttEstimator(0.1, 10)
+        self.assertEqual(rtt.timeout(2), 2)
+        rtt.record(0.5)
+        # srtt + 4 * rttvar
+        self.assertAlmostEqual(rtt.timeout(2), 0.5 + 4 * 0.25)
+        for i in range(50):
+            rtt.record(0.5)
+        self.assertLess(rtt.timeout(2), 0.6)
+
+        estimate = rtt.timeout(2)
+        rtt.record_timeout()
+        rtt.record_timeout()
+        self.assertAlmostEqual(rtt.timeout(2), 4 * estimate)
+        rtt.record(0.5)
+        self.assertLess(rtt.timeout(2), 0.6)
+
+    def test_bounds(self):
+        rtt = polling.RttEstimator(0.1, 10)
+        rtt.record(0.001)
+        self.assertEqual(rtt.timeout(2), 0.1)
+        rtt.record(100)
+        self.assertEqual(rtt.timeout(2), 10)
+
+
+class RetryBudgetTests(unittest.TestCase):
+    def test_spend(self):
+        budget = polling.RetryBudget(2)
+        self.assertEqual([budget.spend() for i in range(3)], [True, True, False])
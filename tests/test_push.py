@@ -0,0 +1,103 @@
+import json
+import base64
+import threading
+import unittest
+import mock
+import requests
+
+from xqueue_watcher import push
+
+
+def echo(content):
+    return {'score': 1, 'msg': content.student_response}
+
+
+class PushTests(unittest.TestCase):
+    def setUp(self):
+        self.m = push.PushManager()
+        self.m.configure({
+            'push-sync': {
+                'SERVER': 'http://push',
+                'PUSH_AUTH': ['xqueue', 'secret'],
+                'PUSH_MAX_SIZE': 1024,
+                'HANDLERS': [{'HANDLER': 'tests.test_push.echo'}],
+            },
+            'push-async': {
+                'SERVER': 'http://push',
+                'PUSH_AUTH': ['xqueue', 'secret'],
+                'PUSH_REPLY': 'put_result',
+                'HANDLERS': [{'HANDLER': 'tests.test_push.echo'}],
+            },
+        })
+        self.httpd = self.m.make_server('127.0.0.1', 0)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+        self.session = requests.Session()
+        self.session.auth = ('xqueue', 'secret')
+        self.envelope = {
+            'xqueue_header': json.dumps({'submission_id': 1}),
+            'xqueue_files': '',
+            'xqueue_body': json.dumps({'student_response': '42', 'grader_payload': '{}'}),
+        }
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_sync_reply(self):
+        response = self.session.post(self.url + '/push-sync/', json=self.envelope)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'score': 1, 'msg': '42'})
+
+        # form encoded, as XQueue pushes it
+        response = self.session.post(self.url + '/push-sync/', data=self.envelope)
+        self.assertEqual(response.json(), {'score': 1, 'msg': '42'})
+
+    def test_put_result_reply(self):
+        queue = self.m.queues['push-async']
+        posted = threading.Event()
+        queue.client._post_result = mock.Mock(side_effect=lambda *args: posted.set())
+        response = self.session.post(self.url + '/push-async/', json=self.envelope)
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(posted.wait(5))
+        header, result = queue.client._post_result.call_args[0][:2]
+        self.assertEqual(header, self.envelope['xqueue_header'])
+        self.assertEqual(result, {'score': 1, 'msg': '42'})
+
+    def test_errors(self):
+        self.assertEqual(self.session.post(self.url + '/nope/', json=self.envelope).status_code, 404)
+        self.assertEqual(self.session.post(self.url + '/push-sync/', json={}).status_code, 400)
+
+        queue = self.m.queues['push-sync']
+        queue.slots.acquire()
+        self.assertEqual(self.session.post(self.url + '/push-sync/', json=self.envelope).status_code, 503)
+        queue.slots.release()
+
+    def test_auth(self):
+        self.assertRaises(ValueError, push.PushManager().configure,
+                          {'open': {'HANDLERS': [{'HANDLER': 'tests.test_push.echo'}]}})
+
+        response = requests.post(self.url + '/push-sync/', json=self.envelope)
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('Basic', response.headers['WWW-Authenticate'])
+        for auth in [('xqueue', 'wrong'), ('other', 'secret')]:
+            response = requests.post(self.url + '/push-sync/', json=self.envelope, auth=auth)
+            self.assertEqual(response.status_code, 401)
+        response = requests.post(self.url + '/push-sync/', json=self.envelope,
+                                 headers={'Authorization': 'Basic !!!'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_content_length(self):
+        import http.client
+        auth = 'Basic ' + base64.b64encode(b'xqueue:secret').decode('ascii')
+        for length, status in [(None, 411), ('x', 400), ('-1', 400), ('4096', 413)]:
+            connection = http.client.HTTPConnection('127.0.0.1', self.httpd.server_port)
+            self.addCleanup(connection.close)
+            connection.putrequest('POST', '/push-sync/')
+            connection.putheader('Authorization', auth)
+            if length is not None:
+                connection.putheader('Content-Length', length)
+            connection.endheaders()
+            self.assertEqual(connection.getresponse().status, status)
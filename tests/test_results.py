@@ -0,0 +1,46 @@
+import json
+import unittest
+
+from xqueue_watcher import results
+
+
+class ResultsTests(unittest.TestCase):
+    def test_truncate_html(self):
+        self.assertEqual(results.truncate_html('plain text', 5), 'plain')
+        self.assertEqual(results.truncate_html('<p>one <b>two</b> <i>three</i></p>', 24),
+                         '<p>one <b>two</b> <i>thr</i></p>')
+        # no partial tag
+        self.assertEqual(results.truncate_html('<p>one <b>two</b> <i>three</i></p>', 20),
+                         '<p>one <b>two</b> </p>')
+        self.assertEqual(results.truncate_html('<pre>a &amp; b</pre>', 9), '<pre>a </pre>')
+        self.assertEqual(results.truncate_html('<div>a<br>b</div>', 11), '<div>a<br>b</div>')
+
+    def test_limit_result(self):
+        result = {'score': 1, 'msg': 'x' * 100}
+        body, truncated = results.limit_result(result, None)
+        self.assertEqual(json.loads(body), result)
+        self.assertFalse(truncated)
+
+        body, truncated = results.limit_result(result, 80, 'html')
+        self.assertTrue(truncated)
+        self.assertLessEqual(len(body), 80)
+        self.assertEqual(json.loads(body)['score'], 1)
+        self.assertTrue(json.loads(body)['msg'].endswith(results.TRUNCATED_NOTICE))
+
+        # plain text is cut anywhere, markup characters included
+        body, truncated = results.limit_result({'msg': 'a < b && c ' * 20}, 80)
+        self.assertTrue(truncated)
+        self.assertLessEqual(len(body), 80)
+        msg = json.loads(body)['msg']
+        self.assertTrue(msg.endswith(results.TRUNCATED_TEXT_NOTICE))
+        self.assertEqual(msg, ('a < b && c ' * 20)[:len(msg) - len(results.TRUNCATED_TEXT_NOTICE)]
+                         + results.TRUNCATED_TEXT_NOTICE)
+        self.assertGreater(len(msg), len(results.TRUNCATED_TEXT_NOTICE) + 40)
+
+        # non-ascii feedback is measured in encoded bytes
+        body, truncated = results.limit_result({'msg': 'ошибка ' * 50}, 300)
+        self.assertLessEqual(len(body.encode('utf-8')), 300)
+
+        # nothing to cut
+        body, truncated = results.limit_result({'score': 1}, 5)
+        self.assertFalse(truncated)
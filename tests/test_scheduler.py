@@ -0,0 +1,144 @@
+import json
+import time
+import threading
+import unittest
+import mock
+
+from xqueue_watcher import scheduler, client, servers
+from tests.test_xqueue_client import MockXQueueServer
+
+
+class SchedulerTests(unittest.TestCase):
+    def _scheduler(self, workers):
+        pool = scheduler.GradingScheduler(workers)
+        self.addCleanup(pool.join, 5)
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def _feed(self, pool, queue_name, count, graded, duration=0.01):
+        def job():
+            time.sleep(duration)
+            graded.append(queue_name)
+
+        def poller():
+            for i in range(count):
+                if not pool.submit(queue_name, job):
+                    break
+        thread = threading.Thread(target=poller)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_weighted_shares(self):
+        pool = self._scheduler(1)
+        pool.add_queue('heavy', weight=3)
+        pool.add_queue('light', weight=1)
+        graded = []
+        pollers = [self._feed(pool, 'heavy', 100, graded), self._feed(pool, 'light', 100, graded)]
+        pool.start()
+        time.sleep(.5)
+        pool.shutdown()
+        for poller in pollers:
+            poller.join(5)
+        heavy, light = graded.count('heavy'), graded.count('light')
+        self.assertGreater(light, 0)
+        self.assertAlmostEqual(heavy / float(light), 3, delta=1)
+
+    def test_max_share(self):
+        pool = self._scheduler(4)
+        pool.add_queue('capped', max_share=0.5)
+        share = pool.queues['capped']
+        release = threading.Event()
+        peak = []
+
+        def job():
+            peak.append(share.running)
+            release.wait(5)
+        pool.start()
+        pollers = [threading.Thread(target=pool.submit, args=('capped', job)) for i in range(4)]
+        for poller in pollers:
+            poller.daemon = True
+            poller.start()
+        time.sleep(.2)
+        self.assertEqual(share.running, 2)
+        self.assertEqual(len(share.pending), 2)
+        release.set()
+        for poller in pollers:
+            poller.join(5)
+        self.assertLessEqual(max(peak), 2)
+
+    def test_idle_queue_gets_no_credit(self):
+        pool = self._scheduler(1)
+        pool.add_queue('a')
+        pool.add_queue('b')
+        pool.queues['a'].vtime = 100
+        pool.queues['a'].pending.append(scheduler.Job(None, ()))
+        self.assertEqual(pool._busy_vtime(), 100)
+        pool.queues['a'].pending.clear()
+
+    def test_change_and_remove_queue(self):
+        pool = self._scheduler(4)
+        share = pool.add_queue('a', weight=1, max_share=1)
+        self.assertIs(pool.add_queue('a', weight=2, max_share=0.5), share)
+        self.assertEqual((share.weight, share.max_workers), (2, 2))
+
+        # a busy queue stays until its submissions are done
+        share.running = 1
+        pool.remove_queue('a')
+        self.assertIn('a', pool.queues)
+        graded = threading.Event()
+        pool.start()
+        self.assertTrue(pool.submit('a', graded.set))
+        self.assertTrue(graded.wait(5))
+        with pool.condition:
+            while not share.graded:
+                pool.condition.wait(1)
+            share.running -= 1
+        pool.remove_queue('a')
+        self.assertNotIn('a', pool.queues)
+
+    def test_shutdown_releases_pollers(self):
+        pool = self._scheduler(1)
+        pool.add_queue('a')
+        pool.start()
+        results = []
+        poller = threading.Thread(target=lambda: results.append(pool.submit('a', time.sleep, 0.3)))
+        blocked = threading.Thread(target=lambda: results.append(pool.submit('a', time.sleep, 0)))
+        poller.start()
+        time.sleep(.05)
+        blocked.start()
+        time.sleep(.05)
+        pool.shutdown()
+        poller.join(5)
+        blocked.join(5)
+        self.assertEqual(sorted(results), [False, True])
+        self.assertEqual(len(pool.queues['a'].pending), 0)
+
+
+class ScheduledClientTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(servers._servers, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_grades_on_pool(self):
+        pool = scheduler.GradingScheduler(1)
+        pool.add_queue('test')
+        pool.start()
+        self.addCleanup(pool.join, 5)
+        self.addCleanup(pool.shutdown)
+        c = client.XQueueClient('test', xqueue_server='TEST')
+        c.session = MockXQueueServer()
+        c.session._json = {'return_code': 0,
+                           'content': json.dumps({'xqueue_header': 'h', 'xqueue_body': '{}'})}
+        c.scheduler = pool
+        graded = threading.Event()
+        threads = []
+
+        def handler(submission):
+            threads.append(threading.current_thread().name)
+            graded.set()
+        c.add_handler(handler)
+        self.assertTrue(c.process_one())
+        self.assertTrue(graded.wait(5))
+        self.assertEqual(threads, ['grading-worker-0'])
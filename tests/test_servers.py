@@ -0,0 +1,211 @@
+import json
+import asyncio
+import time
+import threading
+import unittest
+import mock
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from xqueue_watcher import servers
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps({'return_code': 1, 'content': 'empty'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_registry(self):
+        self.assertIs(servers.get_server(self.url), servers.get_server(self.url))
+        self.assertIn(servers.get_server(self.url), servers.all_servers())
+
+    def test_shared_pool(self):
+        server = servers.XQueueServer(self.url)
+        server.reserve(2)
+        sessions = [server.session(), server.session()]
+        for i in range(3):
+            for session in sessions:
+                session.get(self.url + '/xqueue/get_submission/')
+        stats = server.connection_stats()
+        self.assertEqual(stats['requests'], 6)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['reused'], 5)
+
+        # the pool survives until the last session is closed
+        sessions[0].close()
+        sessions[1].get(self.url + '/xqueue/get_submission/')
+        self.assertEqual(server.connection_stats()['connections'], 1)
+        sessions[1].close()
+        self.assertEqual(server.adapter.users, 0)
+
+
+    def test_latency(self):
+        server = servers.XQueueServer('TEST')
+        self.assertIsNone(server.recent_latency)
+        server.record_latency(1.0)
+        server.record_latency(2.0)
+        self.assertAlmostEqual(server.recent_latency, 1.2)
+        with mock.patch.object(server, 'LATENCY_MAX_AGE', 0):
+            time.sleep(.01)
+            self.assertIsNone(server.recent_latency)
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.breaker = servers.CircuitBreaker('TEST', failure_threshold=2, reset_timeout=0.2)
+        self.events = []
+        self.breaker.add_listener(lambda breaker, old, new: self.events.append((old, new)))
+
+    def test_open_and_probe(self):
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, servers.CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        self.assertFalse(self.breaker.available())
+
+        time.sleep(.25)
+        self.assertTrue(self.breaker.available())
+        # exactly one probe goes out
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, servers.CircuitBreaker.OPEN)
+
+        time.sleep(.25)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.events, [
+            ('closed', 'open'), ('open', 'half-open'), ('half-open', 'open'),
+            ('open', 'half-open'), ('half-open', 'closed'),
+        ])
+        self.assertEqual(self.breaker.transitions['open'], 2)
+
+    def test_wait_closed(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.wait_closed(0.01))
+
+        waiters = []
+
+        def wait():
+            waiters.append(self.breaker.wait_closed(5))
+
+        threads = [threading.Thread(target=wait) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(.05)
+        self.breaker.record_success()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(waiters, [True, True, True])
+
+
+class RateLimiterTests(unittest.TestCase):
+    def test_disabled(self):
+        limiter = servers.RateLimiter('TEST')
+        start = time.time()
+        for i in range(100):
+            limiter.acquire('poll')
+        self.assertLess(time.time() - start, 0.1)
+
+    def test_rate(self):
+        limiter = servers.RateLimiter('TEST', rate=20)
+        start = time.time()
+        for i in range(25):
+            limiter.acquire('poll')
+        # 20 tokens in the bucket, then 5 more at 20/s
+        self.assertGreater(time.time() - start, 0.2)
+
+    def test_async_acquire(self):
+        limiter = servers.RateLimiter('TEST')
+        limiter.configure(10, burst=1, priority='post')
+        order = []
+
+        async def acquire(kind):
+            await limiter.async_acquire(kind)
+            order.append(kind)
+
+        async def main():
+            await acquire('poll')
+            # the poll waits for the token, the post then takes it first
+            poller = asyncio.ensure_future(acquire('poll'))
+            await asyncio.sleep(.01)
+            self.assertEqual(limiter.waiting['poll'], 1)
+            await asyncio.gather(poller, acquire('post'))
+
+        start = time.time()
+        asyncio.run(main())
+        self.assertEqual(order, ['poll', 'post', 'poll'])
+        self.assertGreater(time.time() - start, 0.15)
+        self.assertEqual(limiter.waiting, {'poll': 0, 'post': 0})
+
+    def test_aimd(self):
+        limiter = servers.RateLimiter('TEST', rate=10)
+        limiter.decreased_at -= 1
+        limiter.record_overload()
+        self.assertEqual(limiter.rate, 5)
+        # only one decrease per second
+        limiter.record_overload()
+        self.assertEqual(limiter.rate, 5)
+
+        limiter.adjusted_at -= 2
+        limiter.record_success()
+        self.assertAlmostEqual(limiter.rate, 7, places=1)
+
+    def test_reconfigure(self):
+        limiter = servers.RateLimiter('TEST', rate=10)
+        limiter.decreased_at -= 1
+        limiter.record_overload()
+        limiter.acquire('poll')
+        tokens = limiter.tokens
+        # the same settings again, as on a reload, change nothing
+        limiter.configure(10)
+        self.assertEqual(limiter.rate, 5)
+        self.assertEqual(limiter.tokens, tokens)
+        # new ones start over
+        limiter.configure(20)
+        self.assertEqual(limiter.rate, 20)
+        self.assertEqual(limiter.tokens, 20)
+
+    def test_priority(self):
+        limiter = servers.RateLimiter('TEST')
+        limiter.configure(10, burst=1, priority='post')
+        limiter.acquire('poll')
+        order = []
+
+        def acquire(kind):
+            limiter.acquire(kind)
+            order.append(kind)
+
+        poller = threading.Thread(target=acquire, args=('poll',))
+        poller.start()
+        time.sleep(.01)
+        poster = threading.Thread(target=acquire, args=('post',))
+        poster.start()
+        poller.join(5)
+        poster.join(5)
+        self.assertEqual(order, ['post', 'poll'])
@@ -0,0 +1,96 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import mock
+
+from xqueue_watcher import spool
+from xqueue_watcher import client
+
+
+class FakeClient(object):
+    def __init__(self, queue_name, failures=0):
+        self.queue_name = queue_name
+        self.failures = failures
+        self.sent = []
+        self.event = threading.Event()
+
+    def _send_result(self, header, result):
+        if self.failures:
+            self.failures -= 1
+            return False
+        self.sent.append((header, result))
+        self.event.set()
+        return True
+
+
+class SpoolTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'test.spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _sender(self):
+        sender = spool.ResultSender(self.filename, 'TEST', retry_interval=0.01, retry_max=0.01)
+        self.addCleanup(sender.shutdown)
+        return sender
+
+    def test_torn_record(self):
+        log = spool.JsonLog(self.filename)
+        log.append({'op': 'add', 'id': 0})
+        with open(self.filename, 'a') as fd:
+            fd.write('{"op": "ad')
+        self.assertEqual(log.read(), [{'op': 'add', 'id': 0}])
+
+    def test_deliver(self):
+        c = FakeClient('test', failures=2)
+        sender = self._sender()
+        sender.register(c)
+        sender.start()
+        sender.submit('test', 'header', {'score': 1})
+        self.assertTrue(c.event.wait(5))
+        self.assertEqual(c.sent, [('header', {'score': 1})])
+
+        ops = [record['op'] for record in spool.JsonLog(self.filename).read()]
+        self.assertEqual(ops, ['add', 'done'])
+
+    def test_replay(self):
+        log = spool.JsonLog(self.filename)
+        log.append({'op': 'add', 'id': 0, 'queue': 'test', 'header': 'a', 'result': 1})
+        log.append({'op': 'add', 'id': 1, 'queue': 'test', 'header': 'b', 'result': 2})
+        log.append({'op': 'done', 'id': 0})
+
+        c = FakeClient('test')
+        sender = self._sender()
+        sender.register(c)
+        sender.start()
+        self.assertTrue(c.event.wait(5))
+        self.assertEqual(c.sent, [('b', 2)])
+
+        # new results don't reuse ids of replayed ones
+        sender.submit('test', 'c', 3)
+        self.assertEqual(sender.next_id, 3)
+
+    def test_unregistered(self):
+        c = FakeClient('test')
+        sender = self._sender()
+        sender.register(c)
+        sender.submit('test', 'header', {'score': 1})
+        entry = sender._next_item()
+        # the client went away in between
+        sender.unregister(c)
+        self.assertFalse(sender._send(entry))
+        self.assertEqual(sender.unsent, 1)
+        self.assertEqual(c.sent, [])
+
+    def test_client_does_not_block(self):
+        c = client.XQueueClient('test', xqueue_server='TEST')
+        c.result_sender = mock.Mock()
+        c._send_result = mock.Mock()
+        self.assertTrue(c._post_result('header', {'score': 1}))
+        c.result_sender.submit.assert_called_with('test', 'header', {'score': 1})
+        self.assertFalse(c._send_result.called)
@@ -0,0 +1,49 @@
+import json
+import pickle
+import unittest
+import mock
+
+from xqueue_watcher.submission import Submission
+
+
+class SubmissionTests(unittest.TestCase):
+    def setUp(self):
+        self.envelope = {
+            'xqueue_header': json.dumps({'submission_id': 1}),
+            'xqueue_files': '',
+            'xqueue_body': json.dumps({
+                'student_response': 'print(42)',
+                'grader_payload': json.dumps({'grader': 'test.py'}),
+            }),
+        }
+        self.raw = json.dumps(self.envelope)
+
+    def test_mapping(self):
+        submission = Submission.wrap(self.raw)
+        self.assertEqual(submission, self.envelope)
+        self.assertEqual(submission['xqueue_files'], '')
+        self.assertIs(Submission.wrap(submission), submission)
+        self.assertEqual(Submission.wrap(self.envelope).header, self.envelope['xqueue_header'])
+
+    def test_decodes_once(self):
+        submission = Submission.wrap(self.raw)
+        with mock.patch('json.loads', side_effect=json.loads) as loads:
+            self.assertEqual(submission.student_response, 'print(42)')
+            self.assertEqual(submission.grader_config, {'grader': 'test.py'})
+            self.assertEqual(submission.grader_config, {'grader': 'test.py'})
+            self.assertEqual(submission.header, self.envelope['xqueue_header'])
+            self.assertEqual(loads.call_count, 3)
+
+    def test_errors(self):
+        self.assertRaises(KeyError, lambda: Submission.wrap({}).student_response)
+        self.assertRaises(ValueError, lambda: Submission.wrap({'xqueue_body': ''}).body)
+        self.envelope['xqueue_body'] = json.dumps({'student_response': '', 'grader_payload': 'blah'})
+        self.assertRaises(ValueError, lambda: Submission.wrap(self.envelope).grader_config)
+
+    def test_pickle(self):
+        submission = Submission.wrap(self.raw)
+        self.assertEqual(pickle.loads(pickle.dumps(submission)), self.envelope)
+        submission.grader_config
+        copy = pickle.loads(pickle.dumps(submission))
+        self.assertEqual(copy.grader_config, {'grader': 'test.py'})
+        self.assertFalse(hasattr(copy, '__dict__'))
@@ -0,0 +1,28 @@
+import unittest
+
+from xqueue_watcher import supervisor
+
+
+class SupervisorTests(unittest.TestCase):
+    def test_backoff(self):
+        sup = supervisor.Supervisor(backoff=1, backoff_max=4, max_crashes=10, window=100)
+        delays = [sup.crashed('q', now=i) for i in range(5)]
+        self.assertEqual(delays, [1, 2, 4, 4, 4])
+        # crashes of other queues are counted apart
+        self.assertEqual(sup.crashed('other', now=5), 1)
+        # after a quiet window the backoff starts over
+        self.assertEqual(sup.crashed('q', now=200), 1)
+
+    def test_crash_loop(self):
+        sup = supervisor.Supervisor(backoff=1, max_crashes=2, window=60)
+        self.assertEqual(sup.crashed('q', now=0), 1)
+        self.assertEqual(sup.crashed('q', now=10), 2)
+        self.assertIsNone(sup.crashed('q', now=20))
+        self.assertIsNotNone(sup.crashed('q', now=75))
+
+    def test_restarts(self):
+        sup = supervisor.Supervisor()
+        sup.restarted('q')
+        sup.restarted('q')
+        self.assertEqual(sup.restarts['q'], 2)
+        self.assertEqual(sup.restarts['other'], 0)
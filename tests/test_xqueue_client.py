@@ -4,8 +4,20 @@ import json
 import collections
 import requests
 import requests.exceptions
+import time
+import asyncio
+import threading
+import gzip
+from urllib.parse import parse_qsl
 
-from xqueue_watcher import client
+from xqueue_watcher import client, servers, results
+
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    HAS_AIOHTTP = True
+except ImportError:
+    HAS_AIOHTTP = False
 
 Request = collections.namedtuple('Request', ('method', 'url', 'kwargs', 'response'))
 
@@ -45,6 +57,9 @@ class MockXQueueServer(mock.Mock):
 
 class ClientTests(unittest.TestCase):
     def setUp(self):
+        patcher = mock.patch.dict(servers._servers, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
         self.client = client.XQueueClient('test', xqueue_server='TEST')
         self.session = MockXQueueServer()
         self.client.session = self.session
@@ -93,6 +108,87 @@ class ClientTests(unittest.TestCase):
         reply = self.client.process_one()
         self.assertFalse(reply)
 
+    def test_poll_stats(self):
+        self.client.add_handler(self._simple_handler)
+        self.client.process_one()
+        self.assertEqual(self.client.empty_polls, 0)
+        self.assertEqual(self.client.idle_time, 0)
+
+        self.sample_item['return_code'] = 1
+        self.client.process_one()
+        self.client.process_one()
+        self.assertEqual(self.client.polls, 3)
+        self.assertEqual(self.client.empty_polls, 2)
+        self.assertGreater(self.client.idle_time, 0)
+
+    def test_queuelen_gating(self):
+        c = client.XQueueClient('test', xqueue_server='TEST', queuelen_gating=True,
+                                queuelen_interval=60)
+        c.session = self.session
+        c.add_handler(self._simple_handler)
+
+        def queuelen(url, response, session):
+            if url.endswith('get_queuelen/'):
+                response.json.return_value = {'return_code': 0, 'content': 0}
+        self.session._url_checker = queuelen
+        self.assertFalse(c.process_one())
+        self.assertFalse(c.process_one())
+        self.assertEqual([r.url for r in self.session._requests], ['TEST/xqueue/get_queuelen/'])
+        self.assertEqual(c.empty_polls, 2)
+
+        c.queue_probe.depth = 1
+        self.assertTrue(c.process_one())
+        self.assertEqual(self.session._requests[-1].url, 'TEST/xqueue/get_submission/')
+        self.assertEqual(c.queue_probe.depth, 0)
+
+    def test_steal(self):
+        self.session._json = {'return_code': 1, 'content': 'empty'}
+        sibling = client.XQueueClient('other', xqueue_server='TEST')
+        sibling.session = MockXQueueServer()
+        sibling.session._json = self.sample_item
+        depth = [3]
+
+        def queuelen(url, response, session):
+            if url.endswith('get_queuelen/'):
+                response.json.return_value = {'return_code': 0, 'content': depth[0]}
+        sibling.session._url_checker = queuelen
+        stolen = []
+        sibling.add_handler(stolen.append)
+        self.client.siblings = [(sibling, 2)]
+        self.client.steal_slots = threading.BoundedSemaphore(1)
+
+        self.assertTrue(self.client.process_one())
+        self.assertEqual(len(stolen), 1)
+        self.assertEqual(sibling.session._requests[-1].url, 'TEST/xqueue/get_submission/')
+        self.assertEqual(sibling.in_flight, {})
+
+        # no free slot
+        self.client.steal_slots.acquire()
+        self.assertFalse(self.client.process_one())
+        self.client.steal_slots.release()
+        self.assertEqual(len(stolen), 1)
+
+        # the sibling's own connections keep up
+        sibling.queue_probe = sibling.server.queue_probe('other', 0)
+        depth[0] = 2
+        self.assertFalse(self.client.process_one())
+        self.assertEqual(len(stolen), 1)
+
+        # replaced siblings are shut down by the thief once it is not stealing
+        self.client.set_siblings([], self.client.steal_slots)
+        self.assertTrue(sibling.running)
+        self.client.process_one()
+        self.assertFalse(sibling.running)
+        self.assertFalse(sibling.session._open)
+
+    def test_decoded_submission(self):
+        seen = []
+        self.client.add_handler(lambda submission: seen.append(submission.header))
+        self.client._handle_submission({'xqueue_header': 'h1', 'xqueue_body': {}})
+        self.client.batch_size = 2
+        self.client._handle_batch([{'xqueue_header': 'h2', 'xqueue_body': {}}])
+        self.assertEqual(seen, ['h1', 'h2'])
+
     def test_add_remove(self):
         def handler(content):
             self.qitem = content
@@ -118,6 +214,85 @@ class ClientTests(unittest.TestCase):
         self.assertTrue(self.excepted)
         self.assertTrue(self.qitem is not None)
 
+    def test_in_flight(self):
+        seen = []
+
+        def handler(content):
+            seen.append(dict(self.client.in_flight))
+            raise Exception('test')
+
+        self.client.add_handler(handler)
+        self.client.process_one()
+        self.assertEqual(list(seen[0]), ['{"hello": 1}'])
+        # finished even though the handler failed
+        self.assertEqual(self.client.in_flight, {})
+
+    def test_drain(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        c = client.XQueueClientThread('test', xqueue_server='TEST', poll_interval=30)
+        c.session = self.session
+
+        def handler(content):
+            release.wait(5)
+            return {'result': True}
+
+        c.add_handler(handler)
+        c.start()
+        for i in range(50):
+            if c.in_flight:
+                break
+            time.sleep(.02)
+        c.drain()
+        release.set()
+        c.join(5)
+        self.assertFalse(c.is_alive())
+        self.assertEqual(c.in_flight, {})
+        self.assertTrue(self.session._open)
+        self.assertEqual(len([r for r in self.session._requests if r.url.endswith('put_result/')]), 1)
+
+        # an idle client does not sleep out its poll interval
+        self.session._json = {'return_code': 1, 'content': 'empty'}
+        c = client.XQueueClientThread('test', xqueue_server='TEST', poll_interval=30)
+        c.session = self.session
+        c.start()
+        time.sleep(.1)
+        c.drain()
+        c.join(2)
+        self.assertFalse(c.is_alive())
+
+    def test_concurrent_handlers(self):
+        self.client.handler_concurrency = 2
+        started = threading.Barrier(2, timeout=5)
+
+        def handler(content):
+            # both handlers must be running at once to get past the barrier
+            started.wait()
+            return {'result': True}
+
+        self.client.add_handler(handler)
+        self.client.add_handler(handler)
+        self.assertTrue(self.client.process_one())
+        posts = [r for r in self.session._requests if r.url.endswith('put_result/')]
+        self.assertEqual(len(posts), 2)
+
+    def test_concurrent_handler_failure(self):
+        self.client.handler_concurrency = 2
+
+        def raises(content):
+            raise Exception('test')
+
+        def handler(content):
+            time.sleep(.1)
+            return {'result': True}
+
+        self.client.add_handler(raises)
+        self.client.add_handler(handler)
+        self.assertRaises(Exception, self.client._handle_submission, self.sample_item['content'])
+        # the other handler's result is still posted under the 'continue' policy
+        posts = [r for r in self.session._requests if r.url.endswith('put_result/')]
+        self.assertEqual(len(posts), 1)
+
     def test_bad_json(self):
         self.client.add_handler(self._simple_handler)
         self.session._json = ValueError()
@@ -140,6 +315,54 @@ class ClientTests(unittest.TestCase):
         reply = self.client.process_one()
         self.assertTrue(reply)
 
+    def test_circuit_breaker(self):
+        self.client.add_handler(self._simple_handler)
+        self.session._fail = requests.exceptions.ConnectionError()
+        breaker = self.client.server.breaker
+        for i in range(breaker.failure_threshold):
+            self.assertFalse(self.client.process_one())
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # requests are refused without touching the network
+        sent = len(self.session._requests)
+        self.assertFalse(self.client.process_one())
+        self.assertEqual(len(self.session._requests), sent)
+
+    def test_failover(self):
+        c = client.XQueueClient('test', xqueue_server=['A', 'B'])
+        self.assertEqual(c.xqueue_server, 'A')
+        # login state is kept per server
+        self.assertIsNot(c.auth, servers.get_server('B').authenticator(None, None, 5))
+        sessions = {'A': MockXQueueServer(), 'B': MockXQueueServer()}
+        for session in sessions.values():
+            session._json = self.sample_item
+        c.sessions = sessions
+        c.session = sessions['A']
+        c.add_handler(self._simple_handler)
+        sessions['A']._fail = requests.exceptions.ConnectionError()
+        for i in range(c.server.breaker.failure_threshold):
+            self.assertFalse(c.process_one())
+        self.assertEqual(c.xqueue_server, 'A')
+
+        # A is down, so polling moves to B
+        self.assertTrue(c.process_one())
+        self.assertEqual(c.xqueue_server, 'B')
+        self.assertTrue(sessions['B']._requests[0].url.startswith('B/'))
+
+        # and back to A once it is available and not much slower
+        a, b = servers.get_server('A'), servers.get_server('B')
+        a.breaker.record_success()
+        a.record_latency(0.01)
+        b.latency = 0.01
+        sessions['A']._fail = False
+        self.assertTrue(c.process_one())
+        self.assertEqual(c.xqueue_server, 'A')
+
+        # unless it is slow
+        a.record_latency(10)
+        self.assertTrue(c.process_one())
+        self.assertEqual(c.xqueue_server, 'B')
+
     def test_redirect_to_login(self):
         self.client.add_handler(self._simple_handler)
         self.session.status_code = 302
@@ -173,6 +396,30 @@ class ClientTests(unittest.TestCase):
         self.assertTrue(req.url, 'TEST/xqueue/login/')
         self.assertFalse(reply)
 
+    def test_shared_login(self):
+        other = client.XQueueClient('other', xqueue_server='TEST')
+        self.assertIs(other.auth, self.client.auth)
+        self.assertIs(other.session.cookies, self.client.auth.cookies)
+
+        logins = []
+
+        def login():
+            logins.append(1)
+            return True
+
+        generation = self.client.auth.generation
+        self.assertTrue(self.client.auth.login(login, generation))
+        # a client redirected before that login reuses it
+        self.assertTrue(other.auth.login(login, generation))
+        self.assertEqual(len(logins), 1)
+
+    def test_login_backoff(self):
+        auth = servers.Authenticator(login_poll_interval=0.2)
+        self.assertFalse(auth.login(lambda: False))
+        start = time.time()
+        self.assertTrue(auth.login(lambda: True))
+        self.assertGreater(time.time() - start, 0.1)
+
     def test_post_back(self):
         def handler(content):
             return {'result': True}
@@ -195,6 +442,160 @@ class ClientTests(unittest.TestCase):
         last_request = self.session._requests[-1]
         self.assertTrue(last_request.url.endswith('put_result/'))
 
+    def test_compressed_post_back(self):
+        self.client.result_compression = True
+        self.client.result_compress_min_size = 10
+        self.client.add_handler(lambda content: {'score': 1, 'msg': 'x' * 100})
+        self.assertTrue(self.client.process_one())
+        posted = self.session._requests[-1].kwargs
+        self.assertEqual(posted['headers']['Content-Encoding'], 'gzip')
+        form = dict(parse_qsl(gzip.decompress(posted['data']).decode('utf-8')))
+        self.assertEqual(json.loads(form['xqueue_body'])['msg'], 'x' * 100)
+
+        # a server that refuses compressed bodies gets them plain from then on
+        with mock.patch.object(self.session, 'request', wraps=self.session.request) as request:
+            def checker(url, response, session):
+                if url.endswith('put_result/') and 'headers' in request.call_args[1]:
+                    response.status_code = 415
+            self.session._url_checker = checker
+            self.assertTrue(self.client.process_one())
+        self.assertFalse(self.client.server.accepts_compression)
+        refused, plain = self.session._requests[-2:]
+        self.assertIn('headers', refused.kwargs)
+        self.assertNotIn('headers', plain.kwargs)
+        self.assertEqual(json.loads(plain.kwargs['data']['xqueue_body'])['msg'], 'x' * 100)
+
+    def test_compressed_post_back_failed_xreply(self):
+        self.client.result_compression = True
+        self.client.result_compress_min_size = 10
+        self.client.add_handler(lambda content: {'score': 1, 'msg': 'x' * 100})
+
+        # XQueue answers a body it cannot parse with 200 and a failure
+        with mock.patch.object(self.session, 'request', wraps=self.session.request) as request:
+            def checker(url, response, session):
+                if url.endswith('put_result/') and 'headers' in request.call_args[1]:
+                    response.json.return_value = {'return_code': 1,
+                                                  'content': 'Incorrect reply format'}
+            self.session._url_checker = checker
+            self.assertTrue(self.client.process_one())
+        self.assertFalse(self.client.server.accepts_compression)
+        refused, plain = self.session._requests[-2:]
+        self.assertIn('headers', refused.kwargs)
+        self.assertNotIn('headers', plain.kwargs)
+
+    def test_endpoint_timeouts(self):
+        self.client.endpoint_timeouts = {'put_result': [1, 10], 'get_submission': 2}
+        self.client.add_handler(lambda content: {'score': 1})
+        self.assertTrue(self.client.process_one())
+        get, put = self.session._requests[-2:]
+        self.assertEqual(get.kwargs['timeout'], (2, 2))
+        self.assertEqual(put.kwargs['timeout'], (1, 10))
+
+        # adaptive timeouts start from the configured ones
+        self.client.adaptive_timeouts = True
+        self.assertEqual(self.client._timeout('put_result'), (1, 10))
+        self.client._rtt('put_result').record(0.5)
+        self.assertAlmostEqual(self.client._timeout('put_result')[1], 1.5)
+
+    def test_retry_budget(self):
+        self.client.add_handler(lambda content: {'score': 1})
+        self.client.add_handler(lambda content: {'score': 2})
+        self.client.retry_budget = 1
+
+        def timeout(url, response, session):
+            if url.endswith('put_result/'):
+                session._fail = requests.exceptions.Timeout()
+        self.session._url_checker = timeout
+        # the post is tried once more, then the timeout ends the submission
+        self.assertTrue(self.client.process_one())
+        self.assertEqual([r.url for r in self.session._requests],
+                         ['TEST/xqueue/get_submission/', 'TEST/xqueue/put_result/',
+                          'TEST/xqueue/put_result/'])
+
+    def test_batch(self):
+        self.client.batch_size = 5
+        batches = []
+
+        class BatchHandler(object):
+            def __call__(self, submission):
+                raise AssertionError('graded one by one')
+
+            def grade_many(self, submissions):
+                batches.append(len(submissions))
+                return [{'score': 1}] * len(submissions)
+
+        calls = []
+        self.client.add_handler(BatchHandler())
+        self.client.add_handler(lambda submission: calls.append(submission) or {'score': 2})
+
+        fetched = []
+
+        def three_items(url, response, session):
+            if url.endswith('get_submission/'):
+                fetched.append(url)
+                if len(fetched) > 3:
+                    response.json.return_value = {'return_code': 1, 'content': 'empty'}
+        self.session._url_checker = three_items
+        self.assertTrue(self.client.process_one())
+        self.assertEqual(batches, [3])
+        self.assertEqual(len(calls), 3)
+        posted = [r for r in self.session._requests if r.url.endswith('put_result/')]
+        self.assertEqual(len(posted), 6)
+
+    def test_batch_failures(self):
+        self.client.batch_size = 2
+        items = iter([ValueError('bad'), {'score': 1}])
+
+        def handler(submission):
+            item = next(items)
+            if isinstance(item, Exception):
+                raise item
+            return item
+        self.client.add_handler(handler)
+        # the second submission is still graded and posted
+        self.assertFalse(self.client.process_one())
+        posted = [r for r in self.session._requests if r.url.endswith('put_result/')]
+        self.assertEqual(len(posted), 1)
+
+    def test_batch_grade_many_failure(self):
+        self.client.batch_size = 2
+        self.client.journal = mock.Mock()
+
+        class BatchHandler(object):
+            def grade_many(self, submissions):
+                return [ValueError('bad')] * len(submissions)
+        self.client.add_handler(BatchHandler())
+        self.session._json = dict(self.sample_item, content=json.dumps({
+            'xqueue_header': 'h1', 'xqueue_body': {}}))
+
+        def one_item(url, response, session):
+            if url.endswith('get_submission/') and len(session._requests) > 0:
+                response.json.return_value = {'return_code': 1, 'content': 'empty'}
+        self.session._url_checker = one_item
+        # the failed submission is neither posted nor done
+        self.assertFalse(self.client.process_one())
+        self.assertFalse([r for r in self.session._requests if r.url.endswith('put_result/')])
+        self.assertFalse(self.client.journal.done.called)
+
+    def test_max_reply_size(self):
+        self.client.max_reply_size = 200
+        handler = mock.Mock(return_value={'score': 1, 'msg': 'x < y ' * 100})
+        self.client.add_handler(handler)
+        self.assertTrue(self.client.process_one())
+        body = self.session._requests[-1].kwargs['data']['xqueue_body']
+        self.assertLessEqual(len(body), 200)
+        msg = json.loads(body)['msg']
+        self.assertTrue(msg.endswith(results.TRUNCATED_TEXT_NOTICE))
+        self.assertTrue(('x < y ' * 100).startswith(msg[:-len(results.TRUNCATED_TEXT_NOTICE)]))
+
+        # kept well formed for a handler whose feedback is HTML
+        handler.msg_format = 'html'
+        handler.return_value = {'score': 1, 'msg': '<p>' + 'x' * 500 + '</p>'}
+        self.assertTrue(self.client.process_one())
+        body = self.session._requests[-1].kwargs['data']['xqueue_body']
+        self.assertLessEqual(len(body), 200)
+        self.assertTrue(json.loads(body)['msg'].endswith('</p>' + results.TRUNCATED_NOTICE))
+
     def test_run(self):
         def handler(content):
             return {'result': True}
@@ -223,3 +624,217 @@ class ClientTests(unittest.TestCase):
         self.session._url_checker = urlchecker
         self.client.running = False
         self.assertTrue(self.client.run())
+
+
+class PipelinedClientTests(unittest.TestCase):
+    def setUp(self):
+        self.session = MockXQueueServer()
+        self.session._json = {
+            u'return_code': 0,
+            u'content': json.dumps({
+                u'xqueue_header': {u'hello': 1},
+                u'xqueue_body': {u'blah': u'blah'}
+            })
+        }
+        self.release = threading.Event()
+
+    def _make_client(self, prefetch):
+        c = client.PipelinedXQueueClientThread('test', xqueue_server='TEST',
+                                               xqueue_auth=(None, None),
+                                               poll_interval=0.01, prefetch=prefetch)
+        c.session = self.session
+
+        def handler(content):
+            self.release.wait(5)
+            return {'result': True}
+
+        c.add_handler(handler)
+        return c
+
+    def _count(self, suffix):
+        return len([r for r in self.session._requests if r.url.endswith(suffix)])
+
+    def _run_blocked(self, prefetch):
+        c = self._make_client(prefetch)
+        c.start()
+        time.sleep(.3)
+        fetched = self._count('get_submission/')
+        c.shutdown()
+        self.release.set()
+        c.join(5)
+        self.assertFalse(c.is_alive())
+        return fetched
+
+    def test_no_prefetch(self):
+        self.assertEqual(self._run_blocked(0), 1)
+        self.assertEqual(self._count('put_result/'), 1)
+
+    def test_prefetch(self):
+        self.assertEqual(self._run_blocked(2), 3)
+        # buffered submissions are still graded and posted on shutdown
+        self.assertEqual(self._count('put_result/'), 3)
+
+
+@unittest.skipUnless(HAS_AIOHTTP, "aiohttp not installed")
+class AsyncClientTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = client.get_engine()
+        self.results = []
+        self.logins = 0
+        self.submission = {
+            u'xqueue_header': json.dumps({u'hello': 1}),
+            u'xqueue_body': {u'blah': u'blah'}
+        }
+
+        # like XQueue, only a session cookie set by login is let through
+        self.set_cookie = True
+
+        async def login(request):
+            self.logins += 1
+            response = web.json_response({'return_code': 0, 'content': 'logged in'})
+            if self.set_cookie:
+                response.set_cookie('sessionid', 'secret')
+            return response
+
+        async def get_submission(request):
+            if request.cookies.get('sessionid') != 'secret':
+                raise web.HTTPFound('/xqueue/login/')
+            return web.json_response({'return_code': 0, 'content': json.dumps(self.submission)})
+
+        async def put_result(request):
+            self.results.append(dict(await request.post()))
+            return web.json_response({'return_code': 0, 'content': 'thank you'})
+
+        self.queuelen_requests = 0
+
+        async def get_queuelen(request):
+            self.queuelen_requests += 1
+            return web.json_response({'return_code': 0, 'content': 0})
+
+        app = web.Application()
+        app.router.add_post('/xqueue/login/', login)
+        app.router.add_get('/xqueue/get_submission/', get_submission)
+        app.router.add_get('/xqueue/get_queuelen/', get_queuelen)
+        app.router.add_post('/xqueue/put_result/', put_result)
+        self.server = TestServer(app, loop=self.engine.loop)
+        asyncio.run_coroutine_threadsafe(self.server.start_server(), self.engine.loop).result()
+        self.client = client.AsyncXQueueClient(
+            'test',
+            xqueue_server=str(self.server.make_url('')).rstrip('/'),
+            xqueue_auth=('lms', 'lms'))
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.engine.loop).result()
+
+    def _run(self, *clients_and_coroutine):
+        """
+        Run a coroutine of unstarted clients on the loop; close their sessions.
+        """
+        coroutine = clients_and_coroutine[-1]
+        clients = clients_and_coroutine[:-1]
+
+        async def run():
+            try:
+                return await coroutine
+            finally:
+                for c in clients:
+                    for session in c.sessions.values():
+                        await session.close()
+        for c in clients:
+            c.engine = self.engine
+        return asyncio.run_coroutine_threadsafe(run(), self.engine.loop).result(5)
+
+    def test_shared_login(self):
+        other = client.AsyncXQueueClient('other', xqueue_server=self.client.xqueue_server,
+                                         xqueue_auth=('lms', 'lms'))
+        self.assertIs(other.auth, self.client.auth)
+
+        async def logins():
+            return await asyncio.gather(self.client._login(), other._login())
+        self.assertEqual(self._run(self.client, other, logins()), [True, True])
+        self.assertEqual(self.logins, 1)
+
+    def test_login_cookie(self):
+        self.client.add_handler(lambda content: None)
+        # the login's cookie sticks on the IP address host
+        self.assertTrue(self._run(self.client, self.client.process_one()))
+        self.assertEqual(self.logins, 1)
+
+        # a server which keeps redirecting is logged in to a few times, not forever
+        self.set_cookie = False
+        c = client.AsyncXQueueClient('test', xqueue_server=self.client.xqueue_server,
+                                     xqueue_auth=('other', 'other'))
+        success, message = self._run(c, c._get_submission())
+        self.assertFalse(success)
+        self.assertEqual(self.logins, 1 + c.MAX_LOGIN_REDIRECTS)
+
+    def test_queuelen_gating_and_failover(self):
+        down = 'http://127.0.0.1:9'
+        breaker = servers.get_server(down).breaker
+        for i in range(breaker.failure_threshold):
+            breaker.record_failure()
+        c = client.AsyncXQueueClient('test', xqueue_server=[down, self.client.xqueue_server],
+                                     queuelen_gating=True, queuelen_interval=60)
+        self.assertEqual(self._run(c, c.process_one()), False)
+        self.assertEqual(c.xqueue_server, self.client.xqueue_server)
+        self.assertEqual(self.queuelen_requests, 1)
+        self.assertEqual(c.empty_polls, 1)
+
+    def test_run(self):
+        graded = threading.Event()
+
+        def handler(content):
+            self.client.shutdown()
+            graded.set()
+            self.assertNotEqual(threading.current_thread(), self.engine.thread)
+            return {'result': True}
+
+        self.client.add_handler(handler)
+        self.client.start()
+        self.assertTrue(graded.wait(5))
+        self.client.join(5)
+        self.assertFalse(self.client.is_alive())
+        self.assertEqual(self.logins, 1)
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(self.results[0]['xqueue_body'], json.dumps({'result': True}))
+        self.assertEqual(json.loads(self.results[0]['xqueue_header']), {'hello': 1})
+
+    def test_result_spool(self):
+        import tempfile
+        import shutil
+        from xqueue_watcher import spool
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        sender = spool.ResultSender(spool_dir + '/test.spool', self.client.xqueue_server)
+        self.addCleanup(sender.shutdown)
+        sender.register(self.client)
+        self.client.result_sender = sender
+        sender.start()
+
+        graded = threading.Event()
+
+        def handler(content):
+            graded.set()
+            return {'result': True}
+
+        self.client.add_handler(handler)
+        self.client.start()
+        self.assertTrue(graded.wait(5))
+        # posted by the sender, through the client's session on the loop
+        for i in range(100):
+            if self.results:
+                break
+            time.sleep(.05)
+        self.client.shutdown()
+        self.client.join(5)
+        self.assertEqual(self.results[0]['xqueue_body'], json.dumps({'result': True}))
+
+    def test_shared_loop(self):
+        other = client.AsyncXQueueClient('other', xqueue_server=self.client.xqueue_server)
+        for c in (self.client, other):
+            c.start()
+        self.assertIs(self.client.engine, other.engine)
+        for c in (self.client, other):
+            c.shutdown()
+            c.join(5)
+            self.assertFalse(c.is_alive())
@@ -0,0 +1,115 @@
+"""
+Scaling the number of connections per queue with its load
+"""
+import os
+import time
+import logging
+
+from statsd import statsd
+
+from .settings import MANAGER_CONFIG_DEFAULTS
+
+log = logging.getLogger(__name__)
+
+
+def host_load():
+    """
+    Return the one minute load average per CPU, or None where unknown.
+    """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+class QueueScale(object):
+    """
+    Connection bounds and last observations of one queue.
+    """
+    def __init__(self, name, minimum, maximum):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        # (time, polls, empty polls, grading seconds) at the last decision
+        self.sample = None
+        self.changed_at = 0
+
+    def __repr__(self):
+        return '{}({}, {}..{})'.format(self.__class__.__name__, self.name, self.minimum, self.maximum)
+
+
+class Autoscaler(object):
+    """
+    Decides how many connections each queue should have.
+
+    Between two decisions it looks at the share of polls that came
+    back empty (or at the queue length, with QUEUELEN_GATING) and at the
+    share of the time the connections spent grading. A queue with a
+    backlog whose connections are busy grows by half, unless the host
+    is already loaded; one whose polls are mostly empty and whose
+    connections mostly idle shrinks by one. The thresholds for growing
+    and shrinking are apart, and a queue is left alone for `cooldown`
+    seconds after every change.
+    """
+    def __init__(self,
+                 cooldown=MANAGER_CONFIG_DEFAULTS['AUTOSCALE_COOLDOWN'],
+                 up_empty_ratio=MANAGER_CONFIG_DEFAULTS['AUTOSCALE_UP_EMPTY_RATIO'],
+                 down_empty_ratio=MANAGER_CONFIG_DEFAULTS['AUTOSCALE_DOWN_EMPTY_RATIO'],
+                 up_busy=MANAGER_CONFIG_DEFAULTS['AUTOSCALE_UP_BUSY'],
+                 down_busy=MANAGER_CONFIG_DEFAULTS['AUTOSCALE_DOWN_BUSY'],
+                 max_load=MANAGER_CONFIG_DEFAULTS['AUTOSCALE_MAX_LOAD']):
+        self.cooldown = cooldown
+        self.up_empty_ratio = up_empty_ratio
+        self.down_empty_ratio = down_empty_ratio
+        self.up_busy = up_busy
+        self.down_busy = down_busy
+        self.max_load = max_load
+        self.queues = {}
+
+    def add_queue(self, name, minimum, maximum):
+        self.queues[name] = QueueScale(name, max(1, minimum), max(1, minimum, maximum))
+        return self.queues[name]
+
+    def overloaded(self):
+        load = host_load()
+        return load is not None and load > self.max_load
+
+    def desired(self, name, clients, depth=None, now=None):
+        """
+        Return how many connections queue `name` should have, given its
+        current clients and, if known, the queue length.
+        """
+        scale = self.queues[name]
+        now = time.time() if now is None else now
+        current = len(clients)
+        sample = (now,
+                  sum(client.polls for client in clients),
+                  sum(client.empty_polls for client in clients),
+                  sum(client.grading_time for client in clients))
+        last, scale.sample = scale.sample, sample
+        if last is None or current == 0 or now - scale.changed_at < self.cooldown:
+            return min(scale.maximum, max(scale.minimum, current))
+
+        elapsed = max(now - last[0], 1e-6)
+        polls = sample[1] - last[1]
+        empty_ratio = (sample[2] - last[2]) / float(polls) if polls > 0 else None
+        busy = (sample[3] - last[3]) / (elapsed * current)
+        if depth is not None:
+            backlog, idle = depth > 0, depth == 0
+        else:
+            backlog = empty_ratio is None or empty_ratio <= self.up_empty_ratio
+            idle = empty_ratio is not None and empty_ratio >= self.down_empty_ratio
+
+        target = current
+        if backlog and busy >= self.up_busy and not self.overloaded():
+            target = current + max(1, current // 2)
+        elif idle and busy <= self.down_busy:
+            target = current - 1
+        target = min(scale.maximum, max(scale.minimum, target))
+        if target != current:
+            log.info('Scaling %s from %d to %d connections (empty polls %s, busy %.2f, depth %s)',
+                     name, current, target, empty_ratio, busy, depth)
+            scale.changed_at = now
+        statsd.gauge('xqueuewatcher.connections', target, tags=['queue:' + name])
+        statsd.gauge('xqueuewatcher.busy', busy, tags=['queue:' + name])
+        return target
@@ -1,16 +1,39 @@
+import os
 import time
-import json
+import queue
+import signal
+import asyncio
 import logging
 import requests
 from requests.auth import HTTPBasicAuth
 import threading
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as wait_futures
+from statsd import statsd
 from .settings import MANAGER_CONFIG_DEFAULTS
+from .polling import PollBackoff, RetryBudget
+from .submission import Submission
+from .results import limit_result, compress_form
+from .journal import submission_key
+from . import servers
+
+try:
+    import aiohttp
+except ImportError:  # only AsyncXQueueClient needs it
+    aiohttp = None
 
 log = logging.getLogger(__name__)
 
 
 class XQueueClient(object):
+    # logins after which a request still redirected to the login page fails
+    MAX_LOGIN_REDIRECTS = 3
+
+    COMPRESSED_HEADERS = {
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Content-Encoding': 'gzip',
+    }
+
     def __init__(self,
                  queue_name,
                  xqueue_server='http://localhost:18040',
@@ -18,31 +41,153 @@ class XQueueClient(object):
                  http_basic_auth=MANAGER_CONFIG_DEFAULTS['HTTP_BASIC_AUTH'],
                  requests_timeout=MANAGER_CONFIG_DEFAULTS['REQUESTS_TIMEOUT'],
                  poll_interval=MANAGER_CONFIG_DEFAULTS['POLL_INTERVAL'],
+                 poll_backoff_max=MANAGER_CONFIG_DEFAULTS['POLL_BACKOFF_MAX'],
+                 poll_backoff_factor=MANAGER_CONFIG_DEFAULTS['POLL_BACKOFF_FACTOR'],
+                 poll_jitter=MANAGER_CONFIG_DEFAULTS['POLL_JITTER'],
                  login_poll_interval=MANAGER_CONFIG_DEFAULTS['LOGIN_POLL_INTERVAL'],
-                 follow_client_redirects=MANAGER_CONFIG_DEFAULTS['FOLLOW_CLIENT_REDIRECTS']):
+                 follow_client_redirects=MANAGER_CONFIG_DEFAULTS['FOLLOW_CLIENT_REDIRECTS'],
+                 handler_concurrency=MANAGER_CONFIG_DEFAULTS['HANDLER_CONCURRENCY'],
+                 handler_failure_policy=MANAGER_CONFIG_DEFAULTS['HANDLER_FAILURE_POLICY'],
+                 queuelen_gating=MANAGER_CONFIG_DEFAULTS['QUEUELEN_GATING'],
+                 queuelen_interval=MANAGER_CONFIG_DEFAULTS['QUEUELEN_INTERVAL'],
+                 failover_latency_factor=MANAGER_CONFIG_DEFAULTS['FAILOVER_LATENCY_FACTOR'],
+                 max_reply_size=MANAGER_CONFIG_DEFAULTS['MAX_REPLY_SIZE'],
+                 result_compression=MANAGER_CONFIG_DEFAULTS['RESULT_COMPRESSION'],
+                 result_compress_min_size=MANAGER_CONFIG_DEFAULTS['RESULT_COMPRESS_MIN_SIZE'],
+                 endpoint_timeouts=MANAGER_CONFIG_DEFAULTS['ENDPOINT_TIMEOUTS'],
+                 adaptive_timeouts=MANAGER_CONFIG_DEFAULTS['ADAPTIVE_TIMEOUTS'],
+                 adaptive_timeout_min=MANAGER_CONFIG_DEFAULTS['ADAPTIVE_TIMEOUT_MIN'],
+                 adaptive_timeout_max=MANAGER_CONFIG_DEFAULTS['ADAPTIVE_TIMEOUT_MAX'],
+                 retry_budget=MANAGER_CONFIG_DEFAULTS['RETRY_BUDGET'],
+                 batch_size=MANAGER_CONFIG_DEFAULTS['BATCH_SIZE']):
         super(XQueueClient, self).__init__()
-        self.session = requests.session()
-        self.xqueue_server = xqueue_server
+        # xqueue_server may list several nodes of one XQueue deployment,
+        # most preferred first; see _choose_server
+        if isinstance(xqueue_server, (list, tuple)):
+            urls = list(xqueue_server)
+        else:
+            urls = [xqueue_server]
+        self.servers = [servers.get_server(url) for url in urls]
+        self.sessions = {}
         self.queue_name = queue_name
         self.handlers = []
         self.daemon = True
         self.username, self.password = xqueue_auth
         self.requests_timeout = requests_timeout
+        # endpoint name -> timeout or [connect timeout, read timeout]
+        self.endpoint_timeouts = endpoint_timeouts
+        self.adaptive_timeouts = adaptive_timeouts
+        self.adaptive_timeout_min = adaptive_timeout_min
+        self.adaptive_timeout_max = adaptive_timeout_max
+        self.retry_budget = retry_budget
+        self.batch_size = batch_size
         self.poll_interval = poll_interval
+        self.poll_backoff = PollBackoff(poll_interval, poll_backoff_max,
+                                        factor=poll_backoff_factor, jitter=poll_jitter)
         self.login_poll_interval = login_poll_interval
         self.follow_client_redirects = follow_client_redirects
+        self.handler_concurrency = handler_concurrency
+        if handler_failure_policy not in ('continue', 'cancel'):
+            raise ValueError("Unknown handler failure policy %r" % handler_failure_policy)
+        self.handler_failure_policy = handler_failure_policy
+        self.handler_pool = None
 
         if http_basic_auth is not None:
             self.http_basic_auth = HTTPBasicAuth(*http_basic_auth)
         else:
             self.http_basic_auth = None
 
+        self.queuelen_gating = queuelen_gating
+        self.queuelen_interval = queuelen_interval
+        self.failover_latency_factor = failover_latency_factor
+        self.max_reply_size = max_reply_size
+        self.result_compression = result_compression
+        self.result_compress_min_size = result_compress_min_size
+        self._use_server(self.servers[0])
+
         self.running = True
         self.processing = False
+        # a spool.ResultSender, if results are delivered in the background
+        self.result_sender = None
+        # a journal.Journal, if fetched submissions are journaled
+        self.journal = None
+        # a scheduler.GradingScheduler, if grading is left to a shared pool
+        self.scheduler = None
+        # called with the client when a thread or async client's run() ends
+        self.on_exit = None
+        # journal key -> time fetched, of submissions not finished yet
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        # set by drain() to cut the sleep between polls short
+        self.wakeup = threading.Event()
+        # (client of a queue of the same STEAL_POOL, depth above which
+        # to steal from it), and the semaphore limiting how many of this
+        # queue's connections grade stolen submissions; see _steal
+        self.siblings = []
+        self.steal_slots = None
+        # replaced siblings, shut down once this client's thread is not using them
+        self.retired_siblings = []
+        self.siblings_lock = threading.Lock()
+
+        # poll statistics, see _record_poll
+        self.polls = 0
+        self.empty_polls = 0
+        self.idle_since = time.time()
+        # grading statistics, see _record_grading
+        self.graded = 0
+        self.grading_time = 0.0
+        # when run() last went round, and until when it chose to sleep
+        self.turned_at = time.time()
+        self.idle_until = 0
 
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, self.queue_name)
 
+    def _use_server(self, server):
+        """
+        Send the following requests to `server`, with its own session and login.
+        """
+        if server.url not in self.sessions:
+            session = server.session()
+            session.cookies = server.authenticator(
+                self.username, self.password, self.login_poll_interval).cookies
+            self.sessions[server.url] = session
+        self.server = server
+        self.xqueue_server = server.url
+        self.session = self.sessions[server.url]
+        self.auth = server.authenticator(self.username, self.password, self.login_poll_interval)
+        if self.queuelen_gating:
+            self.queue_probe = server.queue_probe(self.queue_name, self.queuelen_interval)
+        else:
+            self.queue_probe = None
+
+    def _choose_server(self):
+        """
+        Move to the first listed server that is neither down nor much
+        slower than the fastest one, if that is not the current server.
+
+        A server is down while its circuit breaker refuses requests, and
+        slow while its recent average response time is over
+        failover_latency_factor times the fastest available server's.
+        If every server is down the client stays where it is.
+        """
+        if len(self.servers) < 2:
+            return
+        available = [server for server in self.servers if server.available]
+        if not available:
+            return
+        latencies = dict((server, server.recent_latency) for server in available)
+        measured = [latency for latency in latencies.values() if latency is not None]
+        limit = min(measured) * self.failover_latency_factor if measured else None
+        for server in available:
+            if limit is None or latencies[server] is None or latencies[server] <= limit:
+                break
+        if server is not self.server:
+            log.warning('%r moving from %s to %s', self, self.xqueue_server, server.url)
+            statsd.increment('xqueuewatcher.failover',
+                             tags=['queue:' + self.queue_name, 'server:' + server.url])
+            self._use_server(server)
+
     def _parse_response(self, response, is_reply=True):
         if response.status_code not in [200]:
             error_message = "Server %s returned status_code=%d" % (response.url, response.status_code)
@@ -56,6 +201,9 @@ class XQueueClient(object):
             log.error(error_message)
             return False, error_message
 
+        return self._parse_xreply(xreply)
+
+    def _parse_xreply(self, xreply):
         if 'return_code' in xreply:
             return_code = xreply['return_code'] == 0
             content = xreply['content']
@@ -70,29 +218,105 @@ class XQueueClient(object):
 
         return return_code, content
 
-    def _request(self, method, uri, **kwargs):
-        url = self.xqueue_server + uri
+    def _rtt(self, endpoint):
+        return self.server.rtt(endpoint, self.adaptive_timeout_min, self.adaptive_timeout_max)
+
+    def _timeout(self, endpoint):
+        """
+        Return the (connect, read) timeout for a request to endpoint.
+
+        ENDPOINT_TIMEOUTS may give a timeout, or a pair of them, per
+        endpoint ('login', 'get_submission', 'get_queuelen',
+        'put_result'); REQUESTS_TIMEOUT is used for the others. With
+        adaptive timeouts the read timeout is estimated from the round
+        trips measured so far, starting from the configured one.
+        """
+        timeout = self.endpoint_timeouts.get(endpoint, self.requests_timeout)
+        if isinstance(timeout, (list, tuple)):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        if self.adaptive_timeouts:
+            read = self._rtt(endpoint).timeout(read)
+        return connect, read
+
+    def _request(self, method, uri, plain_data=None, budget=None, **kwargs):
+        """
+        Send a request to the current server and parse its xreply.
+
+        A request whose data is compressed passes the uncompressed
+        form as plain_data, which is sent instead if the server
+        refuses the compressed body. Requests that time out or fail to
+        connect are tried again while the RetryBudget `budget` lasts.
+        """
+        server = self.server
+        url = server.url + uri
+        endpoint = uri.strip('/').rsplit('/', 1)[-1]
+        breaker = server.breaker
         r = None
+        limiter = server.rate_limiter
+        logins = 0
         while not r:
+            if not breaker.allow():
+                return False, "Circuit open for %s" % server.url
+            limiter.acquire('post' if uri == '/xqueue/put_result/' else 'poll')
+            auth_generation = self.auth.generation
+            timeout = self._timeout(endpoint)
+            started = time.time()
             try:
                 r = self.session.request(
                     method,
                     url,
                     auth=self.http_basic_auth,
-                    timeout=self.requests_timeout,
+                    timeout=timeout,
                     allow_redirects=self.follow_client_redirects,
                     **kwargs
                 )
             except requests.exceptions.ConnectionError as e:
-                log.error('Could not connect to server at %s in timeout=%r', url, self.requests_timeout)
+                breaker.record_failure()
+                log.error('Could not connect to server at %s in timeout=%r', url, timeout)
+                if budget is not None and budget.spend():
+                    continue
                 return False, str(e)
+            except requests.exceptions.Timeout:
+                breaker.record_failure()
+                if self.adaptive_timeouts:
+                    self._rtt(endpoint).record_timeout()
+                if budget is not None and budget.spend():
+                    log.warning('%s timed out after %rs, retrying', url, timeout)
+                    continue
+                raise
+            elapsed = time.time() - started
+            if r.status_code >= 500:
+                breaker.record_failure()
+                limiter.record_overload()
+            else:
+                breaker.record_success()
+                limiter.record_success()
+                server.record_latency(elapsed)
+                if self.adaptive_timeouts:
+                    self._rtt(endpoint).record(elapsed)
             if r.status_code == 200:
-                return self._parse_response(r)
+                reply = self._parse_response(r)
+                if reply[0] or plain_data is None:
+                    return reply
+                # XQueue answers a body it cannot read with a failed xreply
+            if r.status_code in (200, 400, 415) and plain_data is not None:
+                log.warning('%s refused a compressed request body, sending it uncompressed', url)
+                server.accepts_compression = False
+                kwargs['data'] = plain_data
+                del kwargs['headers']
+                plain_data = None
+                r = None
             # Django can issue both a 302 to the login page and a
             # 301 if the original URL did not have a trailing / and
             # APPEND_SLASH is true in XQueue deployment, which is the default.
             elif r.status_code in (301, 302):
-                if self._login():
+                logins += 1
+                if logins > self.MAX_LOGIN_REDIRECTS:
+                    log.error('%s still redirects to the login page after %d logins', url, logins - 1)
+                    return (False, "Redirected to login")
+                if self._login(auth_generation):
                     r = None
                 else:
                     return (False, "Could not log in")
@@ -109,15 +333,26 @@ class XQueueClient(object):
                 log.error(message)
                 return (False, message)
 
-    def _login(self):
+    def _login(self, seen_generation=None):
+        """
+        Log in through the server's shared Authenticator, see Authenticator.login
+        """
         if self.username is None:
             return True
+        return self.auth.login(self._send_login, seen_generation)
+
+    def _send_login(self):
         url = self.xqueue_server + '/xqueue/login/'
         log.debug("Trying to login to {0} with user: {1} and pass {2}".format(url, self.username, self.password))
-        response = self.session.request('post', url, auth=self.http_basic_auth, data={
-            'username': self.username,
-            'password': self.password,
-            })
+        try:
+            response = self.session.request('post', url, auth=self.http_basic_auth,
+                                            timeout=self._timeout('login'), data={
+                'username': self.username,
+                'password': self.password,
+                })
+        except requests.exceptions.RequestException as e:
+            log.error('Log in error %s', e)
+            return False
         if response.status_code != 200:
             log.error('Log in error %s %s', response.status_code, response.content)
             return False
@@ -125,12 +360,42 @@ class XQueueClient(object):
         log.debug("login response from %r: %r", url, msg)
         return msg['return_code'] == 0
 
+    def drain(self):
+        """
+        Stop fetching; submissions in flight are still graded and posted
+        """
+        self.running = False
+        self.wakeup.set()
+
     def shutdown(self):
         """
         Close connection and shutdown
         """
         self.running = False
         self.session.close()
+        for session in self.sessions.values():
+            if session is not self.session:
+                session.close()
+        if self.handler_pool is not None:
+            self.handler_pool.shutdown(wait=False)
+        for sibling, min_depth in self.siblings:
+            sibling.shutdown()
+        self._shutdown_retired_siblings()
+
+    def set_siblings(self, siblings, steal_slots):
+        """
+        Replace the clients of the queues to steal from, see _steal.
+        """
+        with self.siblings_lock:
+            self.retired_siblings.extend(sibling for sibling, min_depth in self.siblings)
+            self.siblings = siblings
+            self.steal_slots = steal_slots
+
+    def _shutdown_retired_siblings(self):
+        with self.siblings_lock:
+            retired, self.retired_siblings = self.retired_siblings, []
+        for sibling in retired:
+            sibling.shutdown()
 
     def add_handler(self, handler):
         """
@@ -138,34 +403,336 @@ class XQueueClient(object):
         """
         self.handlers.append(handler)
 
+    @property
+    def msg_format(self):
+        """
+        'html' if a handler declares that its feedback is HTML, else 'text'
+        """
+        if any(getattr(handler, 'msg_format', 'text') == 'html' for handler in self.handlers):
+            return 'html'
+        return 'text'
+
     def remove_handler(self, handler):
         """
         Remove handler function
         """
         self.handlers.remove(handler)
 
+    @property
+    def idle_time(self):
+        """
+        Seconds since the queue last returned a submission, 0 while busy
+        """
+        if self.idle_since is None:
+            return 0
+        return time.time() - self.idle_since
+
+    def _record_poll(self, got_submission):
+        tags = ['queue:' + self.queue_name]
+        self.polls += 1
+        if got_submission:
+            self.idle_since = None
+        else:
+            self.empty_polls += 1
+            if self.idle_since is None:
+                self.idle_since = time.time()
+            statsd.increment('xqueuewatcher.empty-poll', tags=tags)
+        statsd.gauge('xqueuewatcher.idle-time', self.idle_time, tags=tags)
+
+    def _record_grading(self, started, count=1):
+        """
+        Count `count` submissions handled since `started`, results posted included
+        """
+        elapsed = time.time() - started
+        self.graded += count
+        self.grading_time += elapsed
+        statsd.histogram('xqueuewatcher.grading-time', elapsed, tags=['queue:' + self.queue_name])
+
+    def _encode_reply(self, header, result):
+        """
+        Return the put_result form for result, cut to max_reply_size.
+        """
+        body, truncated = limit_result(result, self.max_reply_size, self.msg_format)
+        tags = ['queue:' + self.queue_name]
+        statsd.histogram('xqueuewatcher.reply-size', len(body.encode('utf-8')), tags=tags)
+        if truncated:
+            log.warning('%r truncated the feedback for %r to %s bytes',
+                        self, header, self.max_reply_size)
+            statsd.increment('xqueuewatcher.reply-truncated', tags=tags)
+        return {'xqueue_body': body,
+                'xqueue_header': header}
+
+    def _compress_reply(self, reply):
+        """
+        Return the compressed request body for reply, or None if it is
+        not worth compressing or the server does not take it.
+        """
+        if not self.result_compression or not self.server.accepts_compression:
+            return None
+        if len(reply['xqueue_body']) < self.result_compress_min_size:
+            return None
+        data = compress_form(reply)
+        statsd.histogram('xqueuewatcher.reply-size-compressed', len(data),
+                         tags=['queue:' + self.queue_name])
+        return data
+
+    def _send_result(self, header, result, budget=None):
+        reply = self._encode_reply(header, result)
+        data = self._compress_reply(reply)
+        if data is None:
+            status, message = self._request('post', '/xqueue/put_result/', data=reply, verify=False,
+                                            budget=budget)
+        else:
+            status, message = self._request('post', '/xqueue/put_result/', data=data, verify=False,
+                                            plain_data=reply, headers=self.COMPRESSED_HEADERS,
+                                            budget=budget)
+        if not status:
+            log.error('Failure for %r -> %r', reply, message)
+        return status
+
+    def _post_result(self, header, result, budget=None):
+        if self.result_sender is not None:
+            self.result_sender.submit(self.queue_name, header, result)
+            return True
+        return self._send_result(header, result, budget)
+
     def _handle_submission(self, content):
-        content = json.loads(content)
+        content = Submission.wrap(content)
+        header = content.header
+        # shared by every result posted for this submission
+        budget = RetryBudget(self.retry_budget)
+        started = time.time()
+        success = False
+        try:
+            if self.handler_concurrency > 1 and len(self.handlers) > 1:
+                success = self._handle_concurrently(content, header, budget)
+            else:
+                success = []
+                for handler in self.handlers:
+                    result = handler(content)
+                    if result:
+                        self._record_graded(header, result)
+                        success.append(self._post_result(header, result, budget))
+                success = all(success)
+        finally:
+            self._record_grading(started)
+            self._finish_submission(header, success)
+        return success
+
+    def _fetch_burst(self, content):
+        """
+        Fetch more submissions after `content`, up to batch_size in all
+        or until the queue is empty.
+        """
+        contents = [content]
+        while len(contents) < self.batch_size and self.running:
+            try:
+                success, content = self._get_submission()
+            except requests.exceptions.Timeout:
+                break
+            if not success:
+                break
+            contents.append(content)
+        return contents
+
+    def _grade_batch(self, handler, submissions):
+        """
+        Return handler's results for submissions, from its grade_many()
+        if it has one, else from one call per submission. A submission
+        that could not be graded gets the exception instead.
+        """
+        grade_many = getattr(handler, 'grade_many', None)
+        if grade_many is not None:
+            try:
+                return grade_many(submissions)
+            except Exception as e:
+                log.exception('%r grade_many, grading one by one: %s', self, e)
+        results = []
+        for submission in submissions:
+            try:
+                results.append(handler(submission))
+            except Exception as e:
+                log.exception(str(e))
+                results.append(e)
+        return results
+
+    def _handle_batch(self, contents):
+        """
+        Grade a burst of submissions with every handler, then post the results.
+        """
+        submissions = [Submission.wrap(content) for content in contents]
+        headers = [submission.header for submission in submissions]
+        budgets = [RetryBudget(self.retry_budget) for submission in submissions]
+        success = [False] * len(submissions)
+        started = time.time()
+        try:
+            success = [True] * len(submissions)
+            for handler in self.handlers:
+                results = self._grade_batch(handler, submissions)
+                for i, result in enumerate(results):
+                    if isinstance(result, Exception):
+                        success[i] = False
+                    elif result:
+                        self._record_graded(headers[i], result)
+                        success[i] = self._post_result(headers[i], result, budgets[i]) and success[i]
+        except Exception:
+            success = [False] * len(submissions)
+            raise
+        finally:
+            self._record_grading(started, len(submissions))
+            for header, posted in zip(headers, success):
+                self._finish_submission(header, posted)
+        return all(success)
+
+    def _record_graded(self, header, result):
+        if self.journal is not None:
+            self.journal.graded(header, result)
+
+    def _finish_submission(self, header, success):
+        """
+        Called once every result of the submission was posted, or failed to be.
+        """
+        if self.journal is not None and success:
+            self.journal.done(header)
+        with self.in_flight_lock:
+            self.in_flight.pop(submission_key(header), None)
+
+    def _fetched(self, content):
+        """
+        Count a fetched submission in flight and journal it; return it as a Submission.
+        """
+        submission = Submission.wrap(content)
+        with self.in_flight_lock:
+            self.in_flight[submission_key(submission.header)] = time.time()
+        if self.journal is not None:
+            self.journal.fetched(submission.header, content)
+        return submission
+
+    def _recover(self):
+        """
+        Finish the submissions the journal kept from the previous run:
+        post the results they already had, or grade them again.
+        """
+        if self.journal is None:
+            return
+        for entry in self.journal.claim():
+            try:
+                submission = Submission.wrap(entry['content'])
+                header = submission.header
+                if entry['results']:
+                    log.info('%r posting recovered results for %r', self, header)
+                    success = all([self._post_result(header, result)
+                                   for result in entry['results']])
+                    self._finish_submission(header, success)
+                else:
+                    log.info('%r grading recovered submission %r', self, header)
+                    self._handle_submission(submission)
+            except Exception as e:
+                log.exception(str(e))
+
+    def _handle_concurrently(self, content, header, budget=None):
+        """
+        Run every handler on the handler pool and post each result as soon
+        as its handler finishes. If a handler raises, the 'cancel' policy
+        drops the handlers which have not started yet, while 'continue'
+        lets them finish; either way the first error is raised at the end.
+        """
+        if self.handler_pool is None:
+            self.handler_pool = ThreadPoolExecutor(max_workers=self.handler_concurrency)
+        futures = [self.handler_pool.submit(handler, content) for handler in self.handlers]
         success = []
-        for handler in self.handlers:
-            result = handler(content)
+        error = None
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                if error is None:
+                    error = e
+                if self.handler_failure_policy == 'cancel':
+                    for pending in futures:
+                        pending.cancel()
+                continue
             if result:
-                reply = {'xqueue_body': json.dumps(result),
-                         'xqueue_header': content['xqueue_header']}
-                status, message = self._request('post', '/xqueue/put_result/', data=reply, verify=False)
-                if not status:
-                    log.error('Failure for %r -> %r', reply, message)
-                success.append(status)
+                self._record_graded(header, result)
+                success.append(self._post_result(header, result, budget))
+        if error is not None:
+            raise error
         return all(success)
 
+    def _steal(self):
+        """
+        Grade a submission of a sibling queue whose backlog is deeper
+        than its own connections, with that queue's client and handlers.
+        Only while one of this queue's steal slots is free, so that its
+        other connections keep polling it. Return whether it stole one.
+        """
+        if self.steal_slots is None or not self.steal_slots.acquire(False):
+            return False
+        try:
+            for sibling, min_depth in self.siblings:
+                sibling._choose_server()
+                probe = sibling.server.queue_probe(sibling.queue_name, sibling.queuelen_interval)
+                depth = probe.get(sibling._get_queuelen)
+                if depth is None or depth <= min_depth:
+                    continue
+                success, content = sibling._get_submission()
+                if not success:
+                    continue
+                if sibling.queue_probe is None:
+                    probe.claim()
+                statsd.increment('xqueuewatcher.stolen',
+                                 tags=['queue:' + sibling.queue_name, 'thief:' + self.queue_name])
+                self.processing = True
+                if self.scheduler is not None:
+                    self.scheduler.submit(sibling.queue_name, sibling._handle_submission, content)
+                else:
+                    sibling._handle_submission(content)
+                return True
+            return False
+        finally:
+            self.steal_slots.release()
+
+    def _get_queuelen(self):
+        return self._request('get', '/xqueue/get_queuelen/', params={'queue_name': self.queue_name})
+
+    def _get_submission(self):
+        self._choose_server()
+        if self.queue_probe is not None:
+            # only fetch when XQueue says there is something to fetch
+            if self.queue_probe.get(self._get_queuelen) == 0:
+                self._record_poll(False)
+                return False, "Queue is empty"
+        get_params = {'queue_name': self.queue_name}
+        success, content = self._request('get', '/xqueue/get_submission/', params=get_params)
+        self._record_poll(success)
+        if success and self.queue_probe is not None:
+            self.queue_probe.claim()
+        if success:
+            content = self._fetched(content)
+        return success, content
+
     def process_one(self):
         try:
             self.processing = False
-            get_params = {'queue_name': self.queue_name}
-            success, content = self._request('get', '/xqueue/get_submission/', params=get_params)
+            success, content = self._get_submission()
             if success:
                 self.processing = True
-                success = self._handle_submission(content)
+                if self.batch_size > 1:
+                    handle, content = self._handle_batch, self._fetch_burst(content)
+                else:
+                    handle = self._handle_submission
+                if self.scheduler is not None:
+                    # returns once a shared worker has taken it
+                    self.scheduler.submit(self.queue_name, handle, content)
+                else:
+                    success = handle(content)
+            elif self.siblings and self.running:
+                success = self._steal()
+            if self.retired_siblings:
+                # not stealing now
+                self._shutdown_retired_siblings()
             return success
         except requests.exceptions.Timeout:
             return True
@@ -178,28 +745,584 @@ class XQueueClient(object):
         Run forever, processing items from the queue
         """
         if not self._login():
-            log.error("Could not log in to Xqueue %s. Retrying every 5 seconds..." % self.queue_name)
+            log.error("Could not log in to Xqueue %s. Retrying every %s seconds...",
+                      self.queue_name, self.login_poll_interval)
             num_tries = 1
             while self.running:
                 num_tries += 1
-                time.sleep(self.login_poll_interval)
+                self.turned_at = time.time()
+                # the Authenticator spaces attempts by login_poll_interval
                 if not self._login():
-                    log.error("Still could not log in to %s (%s:%s) tries: %d",
+                    log.error("Still could not log in to %s (%s) tries: %d",
                         self.queue_name,
                         self.username,
-                        self.password,
                         num_tries)
                 else:
                     break
+        self._recover()
         while self.running:
-            if not self.process_one():
-                time.sleep(self.poll_interval)
+            self.turned_at = time.time()
+            if self.process_one():
+                self.poll_backoff.reset()
+            elif not any(server.available for server in self.servers):
+                # wake up with the other clients when the server is back
+                self.idle_until = time.time() + self.server.breaker.reset_timeout
+                self.server.breaker.wait_closed(self.server.breaker.reset_timeout)
+            else:
+                delay = self.poll_backoff.next_delay()
+                self.idle_until = time.time() + delay
+                self.wakeup.wait(delay)
         return True
 
 
 class XQueueClientThread(XQueueClient, threading.Thread):
-    pass
+    def run(self):
+        try:
+            return super(XQueueClientThread, self).run()
+        finally:
+            if self.on_exit is not None:
+                self.on_exit(self)
 
 
 class XQueueClientProcess(XQueueClient, multiprocessing.Process):
-    pass
+    # return the journal and the result sender, opened in the client's process by run()
+    open_journal = None
+    open_sender = None
+
+    def drain(self):
+        # the client runs in its own process, which drains on SIGTERM
+        XQueueClient.drain(self)
+        if self.pid is not None and self.is_alive():
+            os.kill(self.pid, signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: XQueueClient.drain(self))
+        if self.open_journal is not None:
+            self.journal = self.open_journal()
+        if self.open_sender is not None:
+            self.result_sender = self.open_sender()
+            self.result_sender.register(self)
+            self.result_sender.start()
+        try:
+            return super(XQueueClientProcess, self).run()
+        finally:
+            if self.result_sender is not None:
+                # unsent results stay in the spool for the next process
+                self.result_sender.shutdown()
+            if self.journal is not None:
+                self.journal.close()
+
+
+class PipelinedXQueueClientThread(XQueueClientThread):
+    """
+    Connection split in three stages so that grading overlaps the HTTP
+    round trips: this thread fetches submissions into a local buffer,
+    a grading thread runs the handlers and a poster thread sends the
+    results back to XQueue.
+
+    At most `prefetch` submissions wait in the buffer while one is being
+    graded. With the default of 0 a submission is only fetched once the
+    grader is free, so nothing sits fetched but unstarted.
+    """
+    def __init__(self, queue_name,
+                 prefetch=MANAGER_CONFIG_DEFAULTS['PREFETCH'],
+                 **kwargs):
+        super(PipelinedXQueueClientThread, self).__init__(queue_name, **kwargs)
+        self.prefetch = prefetch
+        self.buffer = queue.Queue()
+        self.results = queue.Queue()
+        # one slot for the submission being graded plus the buffer
+        self.slots = threading.Semaphore(prefetch + 1)
+
+    def _post_result(self, header, result, budget=None):
+        self.results.put((header, result, budget))
+        return True
+
+    def _finish_submission(self, header, success):
+        # the poster finishes it after posting the results queued before
+        self.results.put((header, None, success))
+
+    def process_one(self):
+        """
+        Fetch stage: wait for a free slot, then fetch one submission into the buffer
+        """
+        while not self.slots.acquire(timeout=self.poll_interval):
+            if not self.running:
+                return True
+        if not self.running:
+            self.slots.release()
+            return True
+        fetched = False
+        try:
+            fetched, content = self._get_submission()
+            if fetched:
+                self.buffer.put(content)
+            return fetched
+        except requests.exceptions.Timeout:
+            return True
+        except Exception as e:
+            log.exception(str(e))
+            return True
+        finally:
+            if not fetched:
+                self.slots.release()
+
+    def _grade_loop(self):
+        while True:
+            content = self.buffer.get()
+            if content is None:
+                break
+            try:
+                self.processing = True
+                self._handle_submission(content)
+            except Exception as e:
+                log.exception(str(e))
+            finally:
+                self.processing = False
+                self.slots.release()
+
+    def _post_loop(self):
+        # submissions some result of which could not be posted
+        unposted = set()
+        while True:
+            item = self.results.get()
+            if item is None:
+                break
+            header, result, budget = item
+            try:
+                if result is None:
+                    # the finishing marker has whether grading succeeded for a budget
+                    posted = budget and submission_key(header) not in unposted
+                    unposted.discard(submission_key(header))
+                    XQueueClient._finish_submission(self, header, posted)
+                elif not XQueueClient._post_result(self, *item):
+                    unposted.add(submission_key(header))
+            except Exception as e:
+                unposted.add(submission_key(header))
+                log.exception(str(e))
+
+    def run(self):
+        """
+        Run the three stages until shut down, then finish the buffered submissions
+        """
+        grader = threading.Thread(target=self._grade_loop, name='%s-grader' % self.name)
+        poster = threading.Thread(target=self._post_loop, name='%s-poster' % self.name)
+        for stage in (grader, poster):
+            stage.daemon = True
+            stage.start()
+        try:
+            # not XQueueClientThread.run, on_exit waits for the stages
+            return XQueueClient.run(self)
+        finally:
+            self.buffer.put(None)
+            grader.join()
+            self.results.put(None)
+            poster.join()
+            if self.on_exit is not None:
+                self.on_exit(self)
+
+
+class AsyncEngine(object):
+    """
+    Event loop thread and grading executor shared by every
+    AsyncXQueueClient in the process.
+    """
+    def __init__(self, grading_workers):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=grading_workers)
+        self.connector = None
+        self.thread = threading.Thread(target=self._run, name='xqueue-watcher-loop')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def get_connector(self):
+        """
+        Return the TCP connector pooled by all client sessions.
+        Must be called from the event loop.
+        """
+        if self.connector is None:
+            self.connector = aiohttp.TCPConnector()
+        return self.connector
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(grading_workers=MANAGER_CONFIG_DEFAULTS['ASYNC_GRADING_WORKERS']):
+    """
+    Return the process-wide AsyncEngine, starting it on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncEngine(grading_workers)
+        return _engine
+
+
+class AsyncXQueueClient(XQueueClient):
+    """
+    XQueue client whose network calls are coroutines on the shared event loop.
+
+    Every instance is one polling connection, like XQueueClientThread,
+    but all of them share a single loop thread and handlers run on a
+    fixed-size executor, so idle queues cost no OS threads. Like the
+    threads, they log in once per server and account, go through the
+    server's rate limiter, fail over between the servers of a list and
+    may gate polls on the queue length.
+    """
+    def __init__(self, queue_name,
+                 grading_workers=MANAGER_CONFIG_DEFAULTS['ASYNC_GRADING_WORKERS'],
+                 **kwargs):
+        if aiohttp is None:
+            raise ImportError("AsyncXQueueClient requires aiohttp")
+        super(AsyncXQueueClient, self).__init__(queue_name, **kwargs)
+        self.grading_workers = grading_workers
+        self.engine = None
+        self._future = None
+        # asyncio.Event cutting the sleep between polls short, see drain()
+        self._wakeup = None
+
+        if self.http_basic_auth is not None:
+            self.aio_basic_auth = aiohttp.BasicAuth(self.http_basic_auth.username,
+                                                    self.http_basic_auth.password)
+        else:
+            self.aio_basic_auth = None
+
+    def _use_server(self, server):
+        """
+        XQueueClient._use_server with aiohttp sessions, see _open_session.
+        """
+        self.server = server
+        self.xqueue_server = server.url
+        self.session = self.sessions.get(server.url)
+        self.auth = server.authenticator(self.username, self.password, self.login_poll_interval,
+                                         asynchronous=True)
+        if self.queuelen_gating:
+            self.queue_probe = server.queue_probe(self.queue_name, self.queuelen_interval)
+        else:
+            self.queue_probe = None
+
+    def _open_session(self):
+        """
+        Return the session to the current server, opening it on first use.
+        Must be called from the event loop.
+        """
+        if self.session is None:
+            if self.auth.cookies is None:
+                # XQueue is often addressed by IP, whose cookies aiohttp drops by default
+                self.auth.cookies = aiohttp.CookieJar(unsafe=True)
+            self.session = aiohttp.ClientSession(connector=self.engine.get_connector(),
+                                                 connector_owner=False,
+                                                 cookie_jar=self.auth.cookies)
+            self.sessions[self.xqueue_server] = self.session
+        return self.session
+
+    async def _request(self, method, uri, plain_data=None, budget=None, **kwargs):
+        session = self._open_session()
+        url = self.xqueue_server + uri
+        endpoint = uri.strip('/').rsplit('/', 1)[-1]
+        kwargs.pop('verify', None)
+        breaker = self.server.breaker
+        limiter = self.server.rate_limiter
+        logins = 0
+        while True:
+            if not breaker.allow():
+                return False, "Circuit open for %s" % self.xqueue_server
+            kind = 'post' if uri == '/xqueue/put_result/' else 'poll'
+            await limiter.async_acquire(kind)
+            auth_generation = self.auth.generation
+            timeout = self._timeout(endpoint)
+            started = time.time()
+            try:
+                async with session.request(
+                        method,
+                        url,
+                        auth=self.aio_basic_auth,
+                        timeout=aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1]),
+                        allow_redirects=self.follow_client_redirects,
+                        **kwargs) as r:
+                    status = r.status
+                    elapsed = time.time() - started
+                    if status >= 500:
+                        breaker.record_failure()
+                        limiter.record_overload()
+                    else:
+                        breaker.record_success()
+                        limiter.record_success()
+                        self.server.record_latency(elapsed)
+                        if self.adaptive_timeouts:
+                            self._rtt(endpoint).record(elapsed)
+                    if status == 200:
+                        try:
+                            xreply = await r.json(content_type=None)
+                        except ValueError:
+                            error_message = "Could not parse xreply."
+                            log.error(error_message)
+                            return False, error_message
+                        reply = self._parse_xreply(xreply)
+                        if reply[0] or plain_data is None:
+                            return reply
+            except aiohttp.ClientConnectionError as e:
+                breaker.record_failure()
+                log.error('Could not connect to server at %s in timeout=%r', url, timeout)
+                if budget is not None and budget.spend():
+                    continue
+                return False, str(e)
+            except asyncio.TimeoutError:
+                breaker.record_failure()
+                if self.adaptive_timeouts:
+                    self._rtt(endpoint).record_timeout()
+                if budget is not None and budget.spend():
+                    log.warning('%s timed out after %rs, retrying', url, timeout)
+                    continue
+                raise
+            # see XQueueClient._request for the meaning of these codes
+            if status in (200, 400, 415) and plain_data is not None:
+                log.warning('%s refused a compressed request body, sending it uncompressed', url)
+                self.server.accepts_compression = False
+                kwargs['data'] = plain_data
+                del kwargs['headers']
+                plain_data = None
+            elif status in (301, 302):
+                logins += 1
+                if logins > self.MAX_LOGIN_REDIRECTS:
+                    log.error('%s still redirects to the login page after %d logins', url, logins - 1)
+                    return (False, "Redirected to login")
+                if not await self._login(auth_generation):
+                    return (False, "Could not log in")
+            elif status == 500 and uri == "/xqueue/get_submission/":
+                message = "Got code 500 at update request"
+                log.warning(message)
+                return (False, message)
+            else:
+                message = "Received un expected response status code, {0}, calling {1}.".format(
+                    status, url)
+                log.error(message)
+                return (False, message)
+
+    async def _login(self, seen_generation=None):
+        """
+        Log in through the server's shared AsyncAuthenticator
+        """
+        if self.username is None:
+            return True
+        return await self.auth.login(self._send_login, seen_generation)
+
+    async def _send_login(self):
+        url = self.xqueue_server + '/xqueue/login/'
+        log.debug("Trying to login to {0} with user: {1}".format(url, self.username))
+        connect, read = self._timeout('login')
+        try:
+            async with self._open_session().post(url, auth=self.aio_basic_auth,
+                                         timeout=aiohttp.ClientTimeout(sock_connect=connect,
+                                                                       sock_read=read),
+                                         data={
+                    'username': self.username,
+                    'password': self.password,
+                    }) as response:
+                if response.status != 200:
+                    log.error('Log in error %s %s', response.status, await response.text())
+                    return False
+                msg = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.error('Log in error %r', e)
+            return False
+        log.debug("login response from %r: %r", url, msg)
+        return msg['return_code'] == 0
+
+    async def _post_result(self, header, result, budget=None):
+        if self.result_sender is not None:
+            self.result_sender.submit(self.queue_name, header, result)
+            return True
+        return await self._put_result(header, result, budget)
+
+    def _send_result(self, header, result, budget=None):
+        """
+        Post a result from another thread, e.g. the ResultSender's, on the event loop.
+        """
+        if not self.is_alive():
+            return False
+        future = asyncio.run_coroutine_threadsafe(self._put_result(header, result, budget),
+                                                  self.engine.loop)
+        return future.result()
+
+    async def _put_result(self, header, result, budget=None):
+        reply = self._encode_reply(header, result)
+        data = self._compress_reply(reply)
+        if data is None:
+            status, message = await self._request('post', '/xqueue/put_result/', data=reply,
+                                                  budget=budget)
+        else:
+            status, message = await self._request('post', '/xqueue/put_result/', data=data,
+                                                  plain_data=reply, headers=self.COMPRESSED_HEADERS,
+                                                  budget=budget)
+        if not status:
+            log.error('Failure for %r -> %r', reply, message)
+        return status
+
+    async def _handle_submission(self, content):
+        content = Submission.wrap(content)
+        header = content.header
+        budget = RetryBudget(self.retry_budget)
+        loop = self.engine.loop
+        started = time.time()
+        success = False
+        try:
+            if self.handler_concurrency > 1 and len(self.handlers) > 1:
+                success = await self._handle_concurrently(content, header, budget)
+            else:
+                success = []
+                for handler in self.handlers:
+                    result = await loop.run_in_executor(self.engine.executor, handler, content)
+                    if result:
+                        self._record_graded(header, result)
+                        success.append(await self._post_result(header, result, budget))
+                success = all(success)
+        finally:
+            self._record_grading(started)
+            self._finish_submission(header, success)
+        return success
+
+    async def _recover(self):
+        """
+        Coroutine version of XQueueClient._recover
+        """
+        if self.journal is None:
+            return
+        for entry in self.journal.claim():
+            try:
+                submission = Submission.wrap(entry['content'])
+                header = submission.header
+                if entry['results']:
+                    success = all([await self._post_result(header, result)
+                                   for result in entry['results']])
+                    self._finish_submission(header, success)
+                else:
+                    await self._handle_submission(submission)
+            except Exception as e:
+                log.exception(str(e))
+
+    async def _handle_concurrently(self, content, header, budget=None):
+        """
+        Coroutine version of XQueueClient._handle_concurrently on the shared executor
+        """
+        loop = self.engine.loop
+        pending = set(loop.run_in_executor(self.engine.executor, handler, content)
+                      for handler in self.handlers)
+        success = []
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    if error is None:
+                        error = future.exception()
+                    if self.handler_failure_policy == 'cancel':
+                        for other in pending:
+                            other.cancel()
+                    continue
+                if future.result():
+                    self._record_graded(header, future.result())
+                    success.append(await self._post_result(header, future.result(), budget))
+        if error is not None:
+            raise error
+        return all(success)
+
+    async def _get_queuelen(self):
+        return await self._request('get', '/xqueue/get_queuelen/',
+                                   params={'queue_name': self.queue_name})
+
+    async def _get_submission(self):
+        self._choose_server()
+        probe = self.queue_probe
+        if probe is not None:
+            if probe.due:
+                # the other connections use the last depth meanwhile
+                probe.checked_at = time.time()
+                probe.record(*await self._get_queuelen())
+            if probe.depth == 0:
+                self._record_poll(False)
+                return False, "Queue is empty"
+        get_params = {'queue_name': self.queue_name}
+        success, content = await self._request('get', '/xqueue/get_submission/', params=get_params)
+        self._record_poll(success)
+        if success and probe is not None:
+            probe.claim()
+        if success:
+            content = self._fetched(content)
+        return success, content
+
+    async def process_one(self):
+        try:
+            self.processing = False
+            success, content = await self._get_submission()
+            if success:
+                self.processing = True
+                success = await self._handle_submission(content)
+            return success
+        except asyncio.TimeoutError:
+            return True
+        except Exception as e:
+            log.exception(str(e))
+            return True
+
+    async def run(self):
+        """
+        Run on the event loop until shut down, processing items from the queue
+        """
+        self._wakeup = asyncio.Event()
+        try:
+            num_tries = 1
+            while self.running and not await self._login():
+                log.error("Could not log in to %s (%s) tries: %d",
+                          self.queue_name, self.username, num_tries)
+                num_tries += 1
+                self.idle_until = time.time() + self.login_poll_interval
+                await asyncio.sleep(self.login_poll_interval)
+            await self._recover()
+            while self.running:
+                self.turned_at = time.time()
+                if await self.process_one():
+                    self.poll_backoff.reset()
+                else:
+                    delay = self.poll_backoff.next_delay()
+                    self.idle_until = time.time() + delay
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            for session in self.sessions.values():
+                await session.close()
+        return True
+
+    def start(self):
+        self.engine = get_engine(self.grading_workers)
+        self._future = asyncio.run_coroutine_threadsafe(self.run(), self.engine.loop)
+        if self.on_exit is not None:
+            self._future.add_done_callback(lambda future: self.on_exit(self))
+
+    def is_alive(self):
+        return self._future is not None and not self._future.done()
+
+    def join(self, timeout=None):
+        if self._future is not None:
+            wait_futures([self._future], timeout=timeout)
+
+    def drain(self):
+        self.running = False
+        if self._wakeup is not None:
+            self.engine.loop.call_soon_threadsafe(self._wakeup.set)
+
+    def shutdown(self):
+        """
+        Stop polling; the session is closed when run() returns
+        """
+        self.running = False
@@ -5,12 +5,13 @@ import imp
 import sys
 import cgi
 import time
-import json
 from path import path
 import logging
 import multiprocessing
 from statsd import statsd
 
+from .submission import Submission
+
 
 def format_errors(errors):
     esc = cgi.escape
@@ -40,6 +41,12 @@ def to_dict(result):
 
 
 class Grader(object):
+    # subclasses whose instances may grade for all connections of a
+    # queue at once, keeping no state between calls, set this to True
+    thread_safe = False
+    # the feedback of render_results is HTML, see MAX_REPLY_SIZE
+    msg_format = 'html'
+
     results_template = u"""
 <div class="test">
 <header>Test results</header>
@@ -120,15 +127,14 @@ class Grader(object):
     def process_item(self, content, queue=None):
         try:
             statsd.increment('xqueuewatcher.process-item')
-            body = content['xqueue_body']
-            files = content['xqueue_files']
+            submission = Submission.wrap(content)
+            files = submission['xqueue_files']
 
             # Delivery from the lms
-            body = json.loads(body)
-            student_response = body['student_response']
-            payload = body['grader_payload']
+            student_response = submission.student_response
+            payload = submission.grader_payload
             try:
-                grader_config = json.loads(payload)
+                grader_config = submission.grader_config
             except ValueError as err:
                 # If parsing json fails, erroring is fine--something is wrong in the content.
                 # However, for debugging, still want to see what the problem is
@@ -0,0 +1,153 @@
+"""
+Write-ahead journal of the submissions a queue is grading
+"""
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from .settings import MANAGER_CONFIG_DEFAULTS
+from .spool import JsonLog
+
+log = logging.getLogger(__name__)
+
+
+def submission_key(header):
+    """
+    Return the journal key of the submission with this xqueue_header.
+    """
+    if isinstance(header, str):
+        return header
+    return json.dumps(header, sort_keys=True)
+
+
+class Journal(object):
+    """
+    Submissions of one queue that were fetched but not yet reported.
+
+    A submission is recorded as 'fetched', with its content, before it
+    is graded, every result as 'graded' before it is posted, and the
+    submission as 'done' once all its results were posted. Whatever a
+    previous run left unfinished is handed out by claim(): submissions
+    with results have them posted again, the others are graded again.
+
+    fsync is 'always' (every record), 'interval' (at most once per
+    fsync_interval seconds) or 'never' (left to the OS).
+    """
+    # rewrite the journal with only the unfinished entries when it grows this long
+    COMPACT_RECORDS = 1000
+
+    def __init__(self, filename,
+                 fsync=MANAGER_CONFIG_DEFAULTS['JOURNAL_FSYNC'],
+                 fsync_interval=MANAGER_CONFIG_DEFAULTS['JOURNAL_FSYNC_INTERVAL']):
+        if fsync not in ('always', 'interval', 'never'):
+            raise ValueError("Unknown journal fsync policy %r" % fsync)
+        self.filename = filename
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.log = JsonLog(filename, fsync=(fsync == 'always'))
+        self.lock = threading.Lock()
+        self.synced_at = time.time()
+        # key -> {'key', 'content', 'results'} of the unfinished submissions
+        self.entries = OrderedDict()
+        self.records = 0
+        self.recovered = self._load()
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.filename)
+
+    def _load(self):
+        with self.lock:
+            for record in self.log.read():
+                key = record['key']
+                if record['op'] == 'fetched':
+                    self.entries[key] = {'key': key, 'content': record['content'], 'results': []}
+                elif record['op'] == 'graded' and key in self.entries:
+                    self.entries[key]['results'].append(record['result'])
+                elif record['op'] == 'done':
+                    self.entries.pop(key, None)
+            self._compact()
+            if self.entries:
+                log.info('%r recovering %d unfinished submissions', self, len(self.entries))
+            return list(self.entries.values())
+
+    def _compact(self):
+        records = []
+        for entry in self.entries.values():
+            records.append({'op': 'fetched', 'key': entry['key'], 'content': entry['content']})
+            records.extend({'op': 'graded', 'key': entry['key'], 'result': result}
+                           for result in entry['results'])
+        self.log.rewrite(records)
+        self.records = len(records)
+
+    def _append(self, record):
+        self.log.append(record)
+        self.records += 1
+        if self.fsync == 'interval' and time.time() - self.synced_at >= self.fsync_interval:
+            self.log.sync()
+            self.synced_at = time.time()
+        if self.records > self.COMPACT_RECORDS and self.records > 2 * len(self.entries):
+            self._compact()
+
+    def fetched(self, header, content):
+        key = submission_key(header)
+        with self.lock:
+            self.entries[key] = {'key': key, 'content': content, 'results': []}
+            self._append({'op': 'fetched', 'key': key, 'content': content})
+
+    def graded(self, header, result):
+        key = submission_key(header)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry['results'].append(result)
+                self._append({'op': 'graded', 'key': key, 'result': result})
+
+    def done(self, header):
+        key = submission_key(header)
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self._append({'op': 'done', 'key': key})
+
+    def claim(self):
+        """
+        Return the submissions left unfinished by the previous run, once.
+        """
+        with self.lock:
+            recovered, self.recovered = self.recovered, []
+            return recovered
+
+    @property
+    def unfinished(self):
+        return len(self.entries)
+
+    def close(self):
+        self.log.sync()
+        self.log.close()
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def get_journal(journal_dir, queue_name, **kwargs):
+    """
+    Return the Journal of queue_name, creating it on first use.
+    """
+    with _journals_lock:
+        if queue_name not in _journals:
+            filename = os.path.join(journal_dir, re.sub(r'[^\w.-]+', '_', queue_name) + '.journal')
+            _journals[queue_name] = Journal(filename, **kwargs)
+        return _journals[queue_name]
+
+
+def clear_journals():
+    """
+    Forget all journals, in a forked process, see servers.clear_servers().
+    """
+    global _journals_lock
+    _journals_lock = threading.Lock()
+    _journals.clear()
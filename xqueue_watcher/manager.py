@@ -2,20 +2,58 @@
 
 from __future__ import print_function
 
+import functools
 import getpass
+import heapq
 import importlib
 import inspect
 import json
 import logging
 import logging.config
+import multiprocessing
 from path import path
+import queue
 import signal
 import sys
 import time
+import threading
 
 import codejail
+from statsd import statsd
 
-from .settings import get_manager_config_values, MANAGER_CONFIG_DEFAULTS
+from . import servers, spool, journal
+from .autoscale import Autoscaler
+from .scheduler import GradingScheduler
+from .supervisor import Supervisor
+from .workers import WorkerProcess
+from .settings import get_manager_config_values, get_queue_config_values, MANAGER_CONFIG_DEFAULTS
+
+
+def reserved_connections(config):
+    """
+    Return how many connections a queue may open, autoscaled or not.
+    """
+    connections = config.get('CONNECTIONS', 1)
+    return max(connections, config.get('MAX_CONNECTIONS', connections)) * config.get('PROCESSES', 1)
+
+
+def client_count(config):
+    """
+    Return how many clients the manager runs for a queue: its worker
+    processes with PROCESSES, else its connections.
+    """
+    return config.get('PROCESSES') or config.get('CONNECTIONS', 1)
+
+
+def without_connections(config):
+    """
+    Return config without the settings resize_queue() can apply.
+    """
+    if config.get('PROCESSES'):
+        scaled = ('PROCESSES',)
+    else:
+        scaled = ('CONNECTIONS', 'MIN_CONNECTIONS', 'MAX_CONNECTIONS')
+    return dict((key, value) for key, value in config.items() if key not in scaled)
 
 
 class Manager(object):
@@ -24,53 +62,472 @@ class Manager(object):
     """
     def __init__(self):
         self.clients = []
+        self.result_senders = []
+        self.journals = []
+        # the GradingScheduler, if GRADING_WORKERS are shared by the queues
+        self.scheduler = None
+        # the Autoscaler, if some queue has MAX_CONNECTIONS above MIN_CONNECTIONS
+        self.autoscaler = None
+        # queue name -> its configuration, for adding clients later
+        self.queue_configs = {}
+        # queue name -> {position: handler} of its thread safe handlers
+        self.shared_handlers = {}
+        # queue name -> semaphore of its connections stealing, see STEAL_POOL
+        self.steal_slots = {}
+        # clients scaled away, shut down once they finished their submission
+        self.retiring = []
+        # clients whose run() ended, put there as it ends
+        self.exited = queue.Queue()
+        # the Supervisor restarting crashed clients, created by start()
+        self.supervisor = None
+        # (time due, queue name) of the clients to restart
+        self.pending_restarts = []
+        self.stopping = False
+        # clients being drained by shutdown(), for a second call to account for
+        self.draining = []
+        # the settings directory, and the conf.d files last loaded from it
+        self.config_root = None
+        self.config_mark = None
+        self.reload_requested = False
         self.log = logging
         self.manager_config = MANAGER_CONFIG_DEFAULTS.copy()
 
-    def client_from_config(self, queue_name, watcher_config):
+    def client_from_config(self, queue_name, watcher_config, handlers=None, journal_name=None,
+                           spool_name=None):
         """
-        Return an XQueueClient from the configuration object.
+        Return an XQueueClient from the configuration object, with
+        `handlers` if given, else with handlers built for it. Its journal
+        is named after the queue, or journal_name.
         """
         from . import client
 
+        config = get_queue_config_values(self.manager_config, watcher_config)
         klass = getattr(client, watcher_config.get('CLASS', 'XQueueClientThread'))
+        kwargs = {}
+        if issubclass(klass, client.AsyncXQueueClient):
+            kwargs['grading_workers'] = config['ASYNC_GRADING_WORKERS']
+        elif issubclass(klass, client.PipelinedXQueueClientThread):
+            kwargs['prefetch'] = config['PREFETCH']
         watcher = klass(
             queue_name,
             xqueue_server=watcher_config.get('SERVER', 'http://localhost:18040'),
             xqueue_auth=watcher_config.get('AUTH', (None, None)),
-            http_basic_auth=self.manager_config['HTTP_BASIC_AUTH'],
-            requests_timeout=self.manager_config['REQUESTS_TIMEOUT'],
-            poll_interval=self.manager_config['POLL_INTERVAL'],
-            login_poll_interval=self.manager_config['LOGIN_POLL_INTERVAL'],
+            http_basic_auth=config['HTTP_BASIC_AUTH'],
+            requests_timeout=config['REQUESTS_TIMEOUT'],
+            poll_interval=config['POLL_INTERVAL'],
+            poll_backoff_max=config['POLL_BACKOFF_MAX'],
+            poll_backoff_factor=config['POLL_BACKOFF_FACTOR'],
+            poll_jitter=config['POLL_JITTER'],
+            login_poll_interval=config['LOGIN_POLL_INTERVAL'],
+            handler_concurrency=config['HANDLER_CONCURRENCY'],
+            handler_failure_policy=config['HANDLER_FAILURE_POLICY'],
+            queuelen_gating=config['QUEUELEN_GATING'],
+            queuelen_interval=config['QUEUELEN_INTERVAL'],
+            failover_latency_factor=config['FAILOVER_LATENCY_FACTOR'],
+            max_reply_size=config['MAX_REPLY_SIZE'],
+            result_compression=config['RESULT_COMPRESSION'],
+            result_compress_min_size=config['RESULT_COMPRESS_MIN_SIZE'],
+            endpoint_timeouts=config['ENDPOINT_TIMEOUTS'],
+            adaptive_timeouts=config['ADAPTIVE_TIMEOUTS'],
+            adaptive_timeout_min=config['ADAPTIVE_TIMEOUT_MIN'],
+            adaptive_timeout_max=config['ADAPTIVE_TIMEOUT_MAX'],
+            retry_budget=config['RETRY_BUDGET'],
+            batch_size=config['BATCH_SIZE'],
+            **kwargs
         )
 
-        for handler_config in watcher_config.get('HANDLERS', []):
+        if config['RESULT_SPOOL_DIR']:
+            open_sender = functools.partial(
+                spool.get_sender,
+                config['RESULT_SPOOL_DIR'],
+                watcher.xqueue_server,
+                name=spool_name,
+                retry_interval=config['RESULT_RETRY_INTERVAL'],
+                retry_max=config['RESULT_RETRY_MAX'],
+                max_attempts=config['RESULT_MAX_ATTEMPTS'],
+            )
+            if isinstance(watcher, multiprocessing.Process):
+                # started in the client's process, which spools the results
+                watcher.open_sender = open_sender
+            else:
+                sender = open_sender()
+                sender.register(watcher)
+                watcher.result_sender = sender
+                if sender not in self.result_senders:
+                    self.result_senders.append(sender)
+
+        if config['JOURNAL_DIR']:
+            open_journal = functools.partial(
+                journal.get_journal,
+                config['JOURNAL_DIR'],
+                journal_name or queue_name,
+                fsync=config['JOURNAL_FSYNC'],
+                fsync_interval=config['JOURNAL_FSYNC_INTERVAL'],
+            )
+            if isinstance(watcher, multiprocessing.Process):
+                # loaded in the client's process, or every process forked
+                # from this one would recover the same submissions
+                watcher.open_journal = open_journal
+            else:
+                watcher.journal = open_journal()
+                if watcher.journal not in self.journals:
+                    self.journals.append(watcher.journal)
+
+        if handlers is None:
+            handlers = self.build_handlers(watcher_config,
+                                           self.shared_handlers.setdefault(queue_name, {}))
+        for handler in handlers:
+            watcher.add_handler(handler)
+        return watcher
+
+    def build_handlers(self, watcher_config, shared=None):
+        """
+        Return the handlers of a queue configuration, instantiated.
+
+        Handlers whose class sets `thread_safe` are instantiated once and
+        kept in the dict `shared`, if given, for the other connections
+        of the queue; the others are instantiated for every connection.
+        """
+        handlers = []
+        for i, handler_config in enumerate(watcher_config.get('HANDLERS', [])):
             handler_name = handler_config['HANDLER']
             mod_name, classname = handler_name.rsplit('.', 1)
             module = importlib.import_module(mod_name)
+            handler = getattr(module, classname)
+            thread_safe = shared is not None and getattr(handler, 'thread_safe', False)
+            if thread_safe and i in shared:
+                handlers.append(shared[i])
+                continue
 
-            kw = handler_config.get('KWARGS', {})
+            kw = dict(handler_config.get('KWARGS', {}))
 
             # codejail configuration per handler
             codejail_config = handler_config.get("CODEJAIL", None)
             if codejail_config:
                 kw['codejail_python'] = self.enable_codejail(codejail_config)
 
-            handler = getattr(module, classname)
             if kw or inspect.isclass(handler):
                 # handler could be a function or a class
                 handler = handler(**kw)
-            watcher.add_handler(handler)
-        return watcher
+            if thread_safe:
+                shared[i] = handler
+            handlers.append(handler)
+        return handlers
 
     def configure(self, configuration):
         """
         Configure XQueue clients.
         """
+        if self.manager_config['GRADING_WORKERS'] and self.scheduler is None:
+            self.scheduler = GradingScheduler(self.manager_config['GRADING_WORKERS'])
         for queue_name, config in configuration.items():
-            for i in range(config.get('CONNECTIONS', 1)):
-                watcher = self.client_from_config(queue_name, config)
-                self.clients.append(watcher)
+            self.configure_server(config.get('SERVER', 'http://localhost:18040'),
+                                  reserved_connections(config))
+            self.queue_configs[queue_name] = config
+            if self.scheduler is not None:
+                self.scheduler.add_queue(queue_name,
+                                         weight=config.get('WEIGHT', 1),
+                                         min_share=config.get('MIN_SHARE', 0),
+                                         max_share=config.get('MAX_SHARE', 1))
+            self.configure_autoscaling(queue_name, config)
+            if config.get('STEAL_POOL'):
+                self.steal_slots[queue_name] = threading.BoundedSemaphore(config.get('STEAL_MAX', 1))
+            for i in range(client_count(config)):
+                self.add_client(queue_name)
+
+    def configure_autoscaling(self, queue_name, config):
+        connections = config.get('CONNECTIONS', 1)
+        minimum = config.get('MIN_CONNECTIONS', connections)
+        maximum = config.get('MAX_CONNECTIONS', connections)
+        if maximum <= minimum:
+            if self.autoscaler is not None:
+                self.autoscaler.queues.pop(queue_name, None)
+            return
+        if self.autoscaler is None:
+            self.autoscaler = Autoscaler(
+                cooldown=self.manager_config['AUTOSCALE_COOLDOWN'],
+                up_empty_ratio=self.manager_config['AUTOSCALE_UP_EMPTY_RATIO'],
+                down_empty_ratio=self.manager_config['AUTOSCALE_DOWN_EMPTY_RATIO'],
+                up_busy=self.manager_config['AUTOSCALE_UP_BUSY'],
+                down_busy=self.manager_config['AUTOSCALE_DOWN_BUSY'],
+                max_load=self.manager_config['AUTOSCALE_MAX_LOAD'],
+            )
+        self.autoscaler.add_queue(queue_name, minimum, maximum)
+
+    def queue_clients(self, queue_name):
+        return [c for c in self.clients if c.queue_name == queue_name]
+
+    def client_config(self, queue_name, index):
+        """
+        Return the configuration of the index'th connection of a queue.
+        """
+        config = self.queue_configs[queue_name]
+        urls = config.get('SERVER', 'http://localhost:18040')
+        if isinstance(urls, (list, tuple)):
+            # spread the connections: each prefers a different
+            # server and fails over to the ones after it
+            start = index % len(urls)
+            config = dict(config, SERVER=list(urls[start:]) + list(urls[:start]))
+        return config
+
+    def add_client(self, queue_name):
+        """
+        Create one more client (or worker process) for a configured queue and return it.
+        """
+        config = self.queue_configs[queue_name]
+        # the lowest index free: that of a crashed client, with its journal and spool,
+        # but not that of one still finishing its submissions
+        taken = set(getattr(c, 'index', None) for c in self.clients + self.retiring
+                    if c.queue_name == queue_name)
+        index = 0
+        while index in taken:
+            index += 1
+        if config.get('PROCESSES'):
+            watcher = WorkerProcess(self, queue_name, index, config.get('CONNECTIONS', 1),
+                                    health_interval=self.manager_config['HEALTH_INTERVAL'])
+        elif config.get('CLASS') == 'XQueueClientProcess':
+            # a journal and a result spool of its own, as for a worker process
+            name = '%s-%d' % (queue_name, index)
+            watcher = self.client_from_config(queue_name, self.client_config(queue_name, index),
+                                              journal_name=name, spool_name=name)
+        else:
+            watcher = self.client_from_config(queue_name, self.client_config(queue_name, index))
+        if isinstance(watcher, threading.Thread):
+            # the pool's threads are not there in a client process
+            watcher.scheduler = self.scheduler
+        watcher.index = index
+        watcher.on_exit = self.exited.put
+        if self.supervisor is not None:
+            # started: the other queues are configured
+            self.set_siblings(watcher)
+        self.clients.append(watcher)
+        return watcher
+
+    def set_siblings(self, watcher):
+        """
+        Give a client of a STEAL_POOL queue a client of every other queue
+        of the pool on the same server, to grade their backlog with when
+        its own queue is empty.
+        """
+        from . import client
+
+        config = self.queue_configs[watcher.queue_name]
+        pool = config.get('STEAL_POOL')
+        if not pool or type(watcher) is not client.XQueueClientThread:
+            return
+        siblings = []
+        for queue_name, other in sorted(self.queue_configs.items()):
+            if queue_name == watcher.queue_name or other.get('STEAL_POOL') != pool:
+                continue
+            if other.get('PROCESSES') or other.get('SERVER') != config.get('SERVER'):
+                self.log.warning('Not stealing from %r for %r, it is on other servers or processes',
+                                 queue_name, watcher.queue_name)
+                continue
+            # never started, it polls and grades on the thief's thread
+            sibling = self.client_from_config(queue_name, dict(self.client_config(queue_name, 0),
+                                                               CLASS='XQueueClient'))
+            sibling.scheduler = watcher.scheduler
+            siblings.append((sibling, client_count(other)))
+        watcher.set_siblings(siblings, self.steal_slots[watcher.queue_name])
+
+    def start_client(self, watcher):
+        sender = watcher.result_sender
+        if sender is not None and sender.ident is None:
+            # a reload added a queue on a new server
+            self.log.info('Starting %r', sender)
+            sender.start()
+        self.log.info('Starting %r', watcher)
+        watcher.start()
+        if isinstance(watcher, multiprocessing.Process):
+            # a client process cannot call on_exit in this process
+            notifier = threading.Thread(target=self._join_process, args=(watcher,),
+                                        name='%s-exit' % watcher.name)
+            notifier.daemon = True
+            notifier.start()
+
+    def _join_process(self, watcher):
+        watcher.join()
+        self.exited.put(watcher)
+
+    def client_exited(self, watcher):
+        """
+        Schedule the restart of a client that exited without being shut
+        down, or shut everything down if its queue is crash looping.
+        """
+        if self.stopping or not watcher.running or watcher not in self.clients:
+            # shut down, scaled away or reloaded
+            return
+        self.clients.remove(watcher)
+        self.release_client(watcher)
+        watcher.shutdown()
+        delay = self.supervisor.crashed(watcher.queue_name)
+        if delay is None:
+            self.log.error('Client died -> %r, crash looping', watcher.queue_name)
+            self.shutdown()
+            return
+        self.log.error('Client died -> %r, restarting in %.1fs', watcher.queue_name, delay)
+        heapq.heappush(self.pending_restarts, (time.time() + delay, watcher.queue_name))
+
+    def restart_due(self):
+        """
+        Restart the crashed clients whose backoff is over.
+        """
+        while self.pending_restarts and self.pending_restarts[0][0] <= time.time():
+            due, queue_name = heapq.heappop(self.pending_restarts)
+            self.supervisor.restarted(queue_name)
+            self.log.info('Restarting a client of %r (%d restarts)',
+                          queue_name, self.supervisor.restarts[queue_name])
+            self.start_client(self.add_client(queue_name))
+
+    def autoscale(self):
+        """
+        Add or remove clients of the autoscaled queues, as the Autoscaler decides.
+        """
+        for queue_name in sorted(self.autoscaler.queues):
+            clients = self.queue_clients(queue_name)
+            if any(isinstance(c, multiprocessing.Process) for c in clients):
+                # the statistics of a client process stay in the process
+                continue
+            probe = clients[0].queue_probe if clients else None
+            target = self.autoscaler.desired(queue_name, clients,
+                                             depth=probe.depth if probe is not None else None)
+            while len(clients) < target:
+                watcher = self.add_client(queue_name)
+                self.start_client(watcher)
+                clients.append(watcher)
+            while len(clients) > target:
+                self.retire_client(clients.pop())
+
+    def retire_client(self, watcher):
+        """
+        Stop a client from fetching; it is shut down by reap_retired()
+        once it finished its submissions.
+        """
+        self.log.info('Retiring %r', watcher)
+        watcher.drain()
+        self.clients.remove(watcher)
+        self.release_client(watcher)
+        self.retiring.append(watcher)
+
+    def release_client(self, watcher):
+        if watcher.result_sender is not None:
+            # another client of the queue posts the spooled results
+            watcher.result_sender.unregister(watcher)
+            for other in self.queue_clients(watcher.queue_name):
+                watcher.result_sender.register(other)
+
+    def reap_retired(self):
+        for watcher in list(self.retiring):
+            if not watcher.is_alive():
+                watcher.shutdown()
+                self.retiring.remove(watcher)
+
+    def read_queue_configs(self):
+        """
+        Return the queue configurations in conf.d, by queue name.
+        """
+        configuration = {}
+        for watcher in sorted(self.config_root.joinpath('conf.d').files('*.json')):
+            with open(watcher) as queue_config:
+                configuration.update(json.load(queue_config))
+        return configuration
+
+    def config_signature(self):
+        return sorted((f.name, f.mtime, f.size)
+                      for f in self.config_root.joinpath('conf.d').files('*.json'))
+
+    def request_reload(self, *args):
+        self.reload_requested = True
+
+    def reload(self):
+        """
+        Apply the changes to conf.d: start the clients of added queues and
+        retire those of removed ones. Changed queues get new clients,
+        unless only their connection counts changed, which just adds or
+        retires clients. Queues that did not change are left alone.
+        """
+        self.reload_requested = False
+        self.config_mark = self.config_signature()
+        try:
+            configuration = self.read_queue_configs()
+        except (OSError, ValueError):
+            self.log.exception('Not reloading, could not read the queue configuration')
+            return
+        # STEAL_POOLs whose queues changed
+        pools = set()
+        for queue_name in sorted(set(self.queue_configs) - set(configuration)):
+            self.log.info('Removing queue %r', queue_name)
+            pools.add(self.queue_configs[queue_name].get('STEAL_POOL'))
+            self.remove_queue(queue_name)
+        for queue_name, config in sorted(configuration.items()):
+            old = self.queue_configs.get(queue_name)
+            if old == config:
+                continue
+            pools.update([(old or {}).get('STEAL_POOL'), config.get('STEAL_POOL')])
+            if old is not None and without_connections(old) == without_connections(config):
+                self.log.info('Resizing queue %r', queue_name)
+                self.resize_queue(queue_name, config)
+                continue
+            if old is not None:
+                self.log.info('Restarting queue %r', queue_name)
+                self.remove_queue(queue_name)
+            else:
+                self.log.info('Adding queue %r', queue_name)
+            self.configure({queue_name: config})
+            for watcher in self.queue_clients(queue_name):
+                self.start_client(watcher)
+        pools.discard(None)
+        for watcher in self.clients:
+            if self.queue_configs[watcher.queue_name].get('STEAL_POOL') in pools:
+                self.set_siblings(watcher)
+
+    def remove_queue(self, queue_name):
+        for watcher in self.queue_clients(queue_name):
+            self.retire_client(watcher)
+        config = self.queue_configs.pop(queue_name)
+        self.shared_handlers.pop(queue_name, None)
+        if self.scheduler is not None:
+            self.scheduler.remove_queue(queue_name)
+        self.configure_server(config.get('SERVER', 'http://localhost:18040'),
+                              -reserved_connections(config))
+        if self.autoscaler is not None:
+            self.autoscaler.queues.pop(queue_name, None)
+        self.pending_restarts = [(due, name) for due, name in self.pending_restarts
+                                 if name != queue_name]
+        heapq.heapify(self.pending_restarts)
+
+    def resize_queue(self, queue_name, config):
+        old = self.queue_configs[queue_name]
+        self.configure_server(config.get('SERVER', 'http://localhost:18040'),
+                              reserved_connections(config) - reserved_connections(old))
+        self.queue_configs[queue_name] = config
+        self.configure_autoscaling(queue_name, config)
+        clients = self.queue_clients(queue_name)
+        while len(clients) < client_count(config):
+            watcher = self.add_client(queue_name)
+            self.start_client(watcher)
+            clients.append(watcher)
+        while len(clients) > client_count(config):
+            self.retire_client(clients.pop())
+
+    def configure_server(self, url, connections):
+        """
+        Apply the manager configuration to the XQueue server at url,
+        which `connections` more clients will use. url may be a list of
+        servers, any of which the clients may fail over to.
+        """
+        if isinstance(url, (list, tuple)):
+            return [self.configure_server(each, connections) for each in url]
+        server = servers.get_server(url)
+        server.reserve(connections)
+        server.breaker.configure(self.manager_config['BREAKER_FAILURES'],
+                                 self.manager_config['BREAKER_RESET_TIMEOUT'])
+        server.rate_limiter.configure(self.manager_config['RATE_LIMIT'],
+                                      burst=self.manager_config['RATE_LIMIT_BURST'],
+                                      priority=self.manager_config['RATE_LIMIT_PRIORITY'],
+                                      min_rate=self.manager_config['RATE_LIMIT_MIN'],
+                                      increase=self.manager_config['RATE_LIMIT_INCREASE'])
+        return server
 
     def configure_from_directory(self, directory):
         """
@@ -91,10 +548,9 @@ class Manager(object):
         app_config_path = directory / 'xqwatcher.json'
         self.manager_config = get_manager_config_values(app_config_path)
 
-        confd = directory / 'conf.d'
-        for watcher in confd.files('*.json'):
-            with open(watcher) as queue_config:
-                self.configure(json.load(queue_config))
+        self.config_root = directory
+        self.config_mark = self.config_signature()
+        self.configure(self.read_queue_configs())
 
     def enable_codejail(self, codejail_config):
         """
@@ -133,47 +589,137 @@ class Manager(object):
         """
         Start XQueue client threads (or processes).
         """
+        self.supervisor = Supervisor(
+            backoff=self.manager_config['RESTART_BACKOFF'],
+            backoff_max=self.manager_config['RESTART_BACKOFF_MAX'],
+            max_crashes=self.manager_config['RESTART_MAX_CRASHES'],
+            window=self.manager_config['RESTART_WINDOW'],
+        )
+        # worker processes first, forking before other threads hold locks
+        for c in self.clients:
+            if isinstance(c, WorkerProcess):
+                self.start_client(c)
+        for sender in self.result_senders:
+            self.log.info('Starting %r', sender)
+            sender.start()
+        if self.scheduler is not None:
+            self.log.info('Starting %r', self.scheduler)
+            self.scheduler.start()
         for c in self.clients:
-            self.log.info('Starting %r', c)
-            c.start()
+            self.set_siblings(c)
+        for c in self.clients:
+            if not isinstance(c, WorkerProcess):
+                self.start_client(c)
+
+    def check_workers(self):
+        """
+        Read the health reports of the worker processes; terminate those
+        that stopped reporting, which the supervisor then restarts.
+        """
+        for watcher in self.clients:
+            if not isinstance(watcher, WorkerProcess):
+                continue
+            watcher.read_health()
+            if watcher.is_alive() and not watcher.healthy:
+                self.log.error('%r stalled or stopped reporting its health, terminating', watcher)
+                watcher.terminate()
 
     def wait(self):
         """
-        Monitor clients.
+        Supervise clients: restart those that exit unexpectedly as soon
+        as they do, and report statistics every POLL_TIME seconds.
         """
         if not self.clients:
             return
         signal.signal(signal.SIGTERM, self.shutdown)
+        if self.config_root is not None:
+            signal.signal(signal.SIGHUP, self.request_reload)
+        poll_time = self.manager_config['POLL_TIME']
+        reload_interval = self.manager_config['RELOAD_INTERVAL']
+        next_report = time.time() + poll_time
+        next_reload_check = time.time() + (reload_interval or poll_time)
         while 1:
-            for client in self.clients:
-                if not client.is_alive():
-                    self.log.error('Client died -> %r',
-                                   client.queue_name)
-                    self.shutdown()
-                try:
-                    time.sleep(self.manager_config['POLL_TIME'])
-                except KeyboardInterrupt:  # pragma: no cover
-                    self.shutdown()
+            wake = min([next_report, next_reload_check] +
+                       [due for due, queue_name in self.pending_restarts])
+            try:
+                watcher = self.exited.get(timeout=max(0, wake - time.time()))
+                self.client_exited(watcher)
+            except queue.Empty:
+                pass
+            except KeyboardInterrupt:  # pragma: no cover
+                self.shutdown()
+            self.restart_due()
+            if self.config_root is not None and time.time() >= next_reload_check:
+                # SIGHUP only sets reload_requested, it is acted on here
+                next_reload_check = time.time() + (reload_interval or poll_time)
+                if self.reload_requested or (reload_interval and
+                                             self.config_signature() != self.config_mark):
+                    self.reload()
+            if time.time() < next_report:
+                continue
+            next_report = time.time() + poll_time
+            self.reap_retired()
+            self.check_workers()
+            for server in servers.all_servers():
+                server.report()
+            if self.scheduler is not None:
+                self.scheduler.report()
+            if self.autoscaler is not None:
+                self.autoscale()
 
     def shutdown(self, *args):
         """
-        Cleanly shutdown all clients.
+        Drain and shut down all clients: they stop fetching, and the
+        submissions in flight get DRAIN_TIMEOUT seconds to be graded and
+        posted. A second call (another SIGTERM) stops waiting.
         """
-        self.log.info('shutting down')
-        while self.clients:
-            client = self.clients.pop()
+        drain_timeout = 0 if self.stopping else self.manager_config['DRAIN_TIMEOUT']
+        self.log.info('shutting down, draining for up to %ss', drain_timeout)
+        self.stopping = True
+        deadline = time.time() + drain_timeout
+        self.draining.extend(self.clients + self.retiring)
+        self.clients, self.retiring = [], []
+        clients = list(self.draining)
+        for client in clients:
+            client.drain()
+        for client in clients:
+            if client.is_alive():
+                client.join(max(0, deadline - time.time()))
+        if self.scheduler is not None:
+            # the pollers submitted their last; let the workers finish grading
+            self.scheduler.shutdown()
+            self.scheduler.join(max(0, deadline - time.time()))
+        abandoned = 0
+        for client in clients:
+            if isinstance(client, WorkerProcess):
+                # its submissions in flight as of its last health report
+                client.read_health()
+            if isinstance(client, multiprocessing.Process) and client.is_alive():
+                # its submissions in flight are only known in the process
+                self.log.error('%r still running after the drain, terminating', client)
+                client.terminate()
+            keys = []
+            for each in [client] + [sibling for sibling, min_depth in client.siblings]:
+                with each.in_flight_lock:
+                    keys.extend(each.in_flight)
+            for key in keys:
+                self.log.warning('%r abandoned submission %s', client, key)
+            abandoned += len(keys)
+            # only now, the results in flight were posted with these sessions
             client.shutdown()
-            if client.processing:
-                try:
-                    client.join()
-                except RuntimeError:
-                    self.log.exception("joining")
-                    sys.exit(9)
             self.log.info('%r done', client)
+        statsd.gauge('xqueuewatcher.abandoned', abandoned)
+        if abandoned:
+            self.log.warning('%d submissions abandoned', abandoned)
+        for sender in self.result_senders:
+            sender.shutdown()
+            self.log.info('%r stopped with %d results spooled', sender, sender.unsent)
+        for log in self.journals:
+            log.close()
+            self.log.info('%r closed with %d unfinished submissions', log, log.unfinished)
         self.log.info('done')
         sys.exit()
 
-
 def main(args=None):
     import argparse
     parser = argparse.ArgumentParser(prog="xqueue_watcher", description="Run grader from settings")
@@ -0,0 +1,153 @@
+"""
+Polling policies for XQueue clients
+"""
+import time
+import random
+import threading
+
+from statsd import statsd
+
+
+class PollBackoff(object):
+    """
+    Delay between polls of a queue that keeps coming back empty.
+
+    The delay starts at `initial`, grows by `factor` after every empty
+    poll up to `maximum`, and up to `jitter` (a fraction) of it is
+    randomized so that connections started together drift apart.
+    reset() is called on the first submission, after which the client
+    polls without sleeping for as long as submissions keep coming.
+    """
+    def __init__(self, initial, maximum, factor=2, jitter=0.25):
+        self.initial = initial
+        self.maximum = max(initial, maximum)
+        self.factor = factor
+        self.jitter = jitter
+        self.delay = initial
+
+    def reset(self):
+        self.delay = self.initial
+
+    def next_delay(self):
+        """
+        Return the time to sleep before the next poll and grow the backoff.
+        """
+        delay = self.delay
+        self.delay = min(self.maximum, self.delay * self.factor)
+        return delay * (1 - self.jitter * random.random())
+
+
+class QueueLengthProbe(object):
+    """
+    Depth of one queue as reported by XQueue's get_queuelen.
+
+    Shared by all connections of the queue: the depth is asked for at
+    most once per `interval`, by whichever connection needs it first,
+    while the others wait for that answer.
+    """
+    def __init__(self, queue_name, interval):
+        self.queue_name = queue_name
+        self.interval = interval
+        self.depth = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def get(self, fetch):
+        """
+        Return the queue depth, calling fetch() for a fresh one if the
+        last is older than interval. fetch returns (success, depth) and
+        None is returned if it failed.
+        """
+        with self.lock:
+            if self.due:
+                self.record(*fetch())
+            return self.depth
+
+    @property
+    def due(self):
+        return time.time() - self.checked_at >= self.interval
+
+    def record(self, success, content):
+        """
+        Take in a get_queuelen reply fetched by the caller.
+        """
+        self.checked_at = time.time()
+        try:
+            self.depth = int(content) if success else None
+        except (TypeError, ValueError):
+            self.depth = None
+        if self.depth is not None:
+            statsd.gauge('xqueuewatcher.queue-length', self.depth,
+                         tags=['queue:' + self.queue_name])
+
+    def claim(self):
+        """
+        Count one submission as taken until the next refresh, so that
+        connections don't all fetch from a queue holding a single item.
+        """
+        with self.lock:
+            if self.depth:
+                self.depth -= 1
+
+
+class RttEstimator(object):
+    """
+    Round-trip time of one endpoint of a server, estimated the way TCP
+    computes its retransmission timeout (RFC 6298).
+
+    timeout() is the smoothed round trip plus four times its mean
+    deviation, which is above all but the slowest responses, kept
+    between `minimum` and `maximum`. Every timed out request doubles
+    it until the next response is measured.
+    """
+    ALPHA = 1 / 8.0
+    BETA = 1 / 4.0
+
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+        self.lock = threading.Lock()
+
+    def record(self, rtt):
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2.0
+            else:
+                self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+                self.srtt += self.ALPHA * (rtt - self.srtt)
+            self.backoff = 1
+
+    def record_timeout(self):
+        with self.lock:
+            self.backoff = min(self.backoff * 2, 64)
+
+    def timeout(self, default):
+        """
+        Return the timeout to use, `default` until a round trip was measured.
+        """
+        with self.lock:
+            rto = default if self.srtt is None else self.srtt + 4 * self.rttvar
+            return min(self.maximum, max(self.minimum, rto * self.backoff))
+
+
+class RetryBudget(object):
+    """
+    Retries left for the requests made on behalf of one submission.
+    """
+    def __init__(self, retries):
+        self.retries = retries
+        self.lock = threading.Lock()
+
+    def spend(self):
+        """
+        Take one retry; return False if none is left.
+        """
+        with self.lock:
+            if self.retries <= 0:
+                return False
+            self.retries -= 1
+            return True
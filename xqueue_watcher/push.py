@@ -0,0 +1,224 @@
+"""
+Push mode: XQueue delivers submissions to a local HTTP server instead
+of the watcher polling for them.
+"""
+from __future__ import print_function
+
+import sys
+import hmac
+import json
+import base64
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+from .manager import Manager
+from .submission import Submission
+
+log = logging.getLogger(__name__)
+
+# default largest pushed submission, in bytes
+PUSH_MAX_SIZE = 10 * 1024 * 1024
+
+
+class PushQueue(object):
+    """
+    Grades the submissions pushed for one queue with its client's handlers.
+
+    In 'sync' reply mode the first result is the HTTP response and any
+    further ones are posted with put_result; in 'put_result' mode the
+    push is acknowledged at once and every result is posted. At most
+    `concurrency` submissions are graded at a time, pushes beyond that
+    are refused so that XQueue retries them later.
+
+    Pushes must come with the HTTP basic auth credentials `auth`, a
+    (username, password) pair, and be at most `max_size` bytes long.
+    """
+    def __init__(self, client, auth, reply='sync', concurrency=1, max_size=PUSH_MAX_SIZE):
+        if reply not in ('sync', 'put_result'):
+            raise ValueError("Unknown push reply mode %r" % reply)
+        if not auth or len(auth) != 2 or not all(auth):
+            raise ValueError("Queue %r needs PUSH_AUTH, a username and password" % client.queue_name)
+        self.client = client
+        self.reply = reply
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.credentials = ('%s:%s' % tuple(auth)).encode('utf-8')
+        self.max_size = max_size
+
+    def __repr__(self):
+        return '{}({}, {})'.format(self.__class__.__name__, self.client.queue_name, self.reply)
+
+    def authorized(self, authorization):
+        """
+        Return whether the Authorization header carries this queue's credentials.
+        """
+        scheme, _, token = (authorization or '').partition(' ')
+        if scheme.lower() != 'basic':
+            return False
+        try:
+            credentials = base64.b64decode(token.strip(), validate=True)
+        except ValueError:
+            return False
+        return hmac.compare_digest(credentials, self.credentials)
+
+    def _grade_and_post(self, submission):
+        try:
+            self.client._handle_submission(submission)
+        except Exception:
+            log.exception('push %s', self.client.queue_name)
+        finally:
+            self.slots.release()
+
+    def handle(self, envelope):
+        """
+        Grade a pushed submission; return an HTTP status and a reply body.
+        """
+        submission = Submission.wrap(envelope)
+        try:
+            header = submission.header
+        except KeyError:
+            return 400, {'return_code': 1, 'content': 'Missing xqueue_header'}
+        if not self.slots.acquire(False):
+            return 503, {'return_code': 1, 'content': 'Too many submissions in progress'}
+
+        if self.reply == 'put_result':
+            grader = threading.Thread(target=self._grade_and_post, args=(submission,))
+            grader.daemon = True
+            grader.start()
+            return 202, {'return_code': 0, 'content': 'Queued'}
+
+        try:
+            reply = None
+            for handler in self.client.handlers:
+                result = handler(submission)
+                if not result:
+                    continue
+                if reply is None:
+                    reply = result
+                else:
+                    self.client._post_result(header, result)
+        except Exception as e:
+            log.exception('push %s', self.client.queue_name)
+            return 500, {'return_code': 1, 'content': str(e)}
+        finally:
+            self.slots.release()
+        return 200, reply or {}
+
+
+class PushRequestHandler(BaseHTTPRequestHandler):
+    """
+    Accepts a submission, as JSON or form data, POSTed to /<queue_name>/.
+    """
+    def _reply(self, status, body, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _refuse(self, status, message, headers=()):
+        # the body was not read, so the connection cannot carry another request
+        self.close_connection = True
+        self._reply(status, {'return_code': 1, 'content': message}, headers)
+
+    def do_POST(self):
+        queue = self.server.queues.get(self.path.strip('/'))
+        if queue is None:
+            return self._refuse(404, 'Unknown queue')
+        if not queue.authorized(self.headers.get('Authorization')):
+            return self._refuse(401, 'Unauthorized',
+                                [('WWW-Authenticate', 'Basic realm="xqueue_watcher"')])
+        length = self.headers.get('Content-Length')
+        if length is None:
+            return self._refuse(411, 'Missing Content-Length')
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self._refuse(400, 'Invalid Content-Length')
+        if length > queue.max_size:
+            return self._refuse(413, 'Submission too large')
+        try:
+            data = self.rfile.read(length).decode('utf-8')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                envelope = json.loads(data)
+            else:
+                envelope = dict(parse_qsl(data))
+        except ValueError:
+            return self._reply(400, {'return_code': 1, 'content': 'Could not parse submission'})
+        self._reply(*queue.handle(envelope))
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class PushManager(Manager):
+    """
+    Manages queues whose submissions are pushed by XQueue.
+
+    Each queue gets one client, which is never started: its handlers
+    grade the pushed submissions and its session posts results.
+    """
+    def __init__(self):
+        super(PushManager, self).__init__()
+        self.queues = {}
+
+    def configure(self, configuration):
+        for queue_name, config in configuration.items():
+            concurrency = config.get('PUSH_CONCURRENCY', config.get('CONNECTIONS', 1))
+            self.configure_server(config.get('SERVER', 'http://localhost:18040'), concurrency)
+            client = self.client_from_config(queue_name, config)
+            self.clients.append(client)
+            self.queues[queue_name] = PushQueue(client, config.get('PUSH_AUTH'),
+                                                reply=config.get('PUSH_REPLY', 'sync'),
+                                                concurrency=concurrency,
+                                                max_size=config.get('PUSH_MAX_SIZE', PUSH_MAX_SIZE))
+
+    def make_server(self, host, port):
+        httpd = ThreadingHTTPServer((host, port), PushRequestHandler)
+        httpd.daemon_threads = True
+        httpd.queues = self.queues
+        return httpd
+
+    def start(self):
+        for sender in self.result_senders:
+            self.log.info('Starting %r', sender)
+            sender.start()
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="xqueue_watcher.push",
+                                     description="Grade submissions pushed by XQueue")
+    parser.add_argument('-d', '--config_root', required=True,
+                        help='Configuration root, as for xqueue_watcher')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=18050, help='port to listen on')
+    args = parser.parse_args(args)
+
+    manager = PushManager()
+    manager.configure_from_directory(args.config_root)
+
+    if not manager.queues:
+        print("No xqueue queues configured")
+        return 0
+    manager.start()
+    httpd = manager.make_server(args.host, args.port)
+    manager.log.info('Accepting pushed submissions on %s:%d for %s',
+                     args.host, args.port, ', '.join(sorted(manager.queues)))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    finally:
+        httpd.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Encoding of graded results for put_result
+"""
+import gzip
+import json
+from html.parser import HTMLParser
+from urllib.parse import urlencode
+
+# appended to feedback cut short by limit_result, in HTML and in plain text
+TRUNCATED_NOTICE = '<p>[feedback truncated]</p>'
+TRUNCATED_TEXT_NOTICE = '\n[feedback truncated]'
+
+# elements without a closing tag
+VOID_ELEMENTS = frozenset((
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+))
+
+
+class _OpenTags(HTMLParser):
+    """
+    Collects the elements left open at the end of an HTML fragment.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=False)
+        self.stack = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.stack:
+            del self.stack[len(self.stack) - 1 - self.stack[::-1].index(tag):]
+
+
+def truncate_html(text, length):
+    """
+    Return at most the first `length` characters of text, without a
+    partial tag or character reference at the end and with the
+    elements left open closed again.
+    """
+    text = text[:length]
+    for start, end in (('<', '>'), ('&', ';')):
+        cut = text.rfind(start)
+        if cut > text.rfind(end):
+            text = text[:cut]
+    parser = _OpenTags()
+    parser.feed(text)
+    parser.close()
+    return text + ''.join('</%s>' % tag for tag in reversed(parser.stack))
+
+
+def truncate_msg(msg, length, msg_format='text'):
+    """
+    Return msg cut to `length` characters, with the truncation notice;
+    as HTML if msg_format is 'html', else as plain text.
+    """
+    if msg_format == 'html':
+        return truncate_html(msg, length) + TRUNCATED_NOTICE
+    return msg[:length] + TRUNCATED_TEXT_NOTICE
+
+
+def limit_result(result, max_size, msg_format='text'):
+    """
+    Return the xqueue_body for result and whether its feedback was truncated.
+
+    If the body is over max_size bytes, `msg` is shortened until it
+    fits, see truncate_msg. Results without a text `msg` are sent whole.
+    """
+    body = json.dumps(result)
+    size = len(body.encode('utf-8'))
+    msg = result.get('msg') if isinstance(result, dict) else None
+    if max_size is None or size <= max_size or not isinstance(msg, str):
+        return body, False
+    keep = len(msg)
+    while size > max_size and keep > 0:
+        keep = max(0, keep - (size - max_size))
+        body = json.dumps(dict(result, msg=truncate_msg(msg, keep, msg_format)))
+        size = len(body.encode('utf-8'))
+    return body, True
+
+
+def compress_form(data):
+    """
+    Return the gzipped form encoding of data.
+    """
+    return gzip.compress(urlencode(data).encode('utf-8'))
@@ -0,0 +1,217 @@
+"""
+Grading worker pool shared by every queue
+"""
+import math
+import time
+import logging
+import threading
+from collections import deque
+
+from statsd import statsd
+
+log = logging.getLogger(__name__)
+
+
+class QueueShare(object):
+    """
+    Scheduling state of one queue.
+    """
+    # weight of the newest job in the average grading time
+    COST_ALPHA = 0.2
+
+    def __init__(self, name, weight, min_workers, max_workers):
+        self.name = name
+        self.weight = weight
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.pending = deque()
+        self.running = 0
+        # worker seconds used, divided by weight
+        self.vtime = 0.0
+        self.cost = 1.0
+        self.graded = 0
+        # dropped from the scheduler once no longer busy
+        self.removed = False
+
+    def __repr__(self):
+        return '{}({}, weight={})'.format(self.__class__.__name__, self.name, self.weight)
+
+    @property
+    def busy(self):
+        return bool(self.pending or self.running)
+
+
+class Job(object):
+    __slots__ = ('func', 'args', 'started')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.started = False
+
+
+class GradingScheduler(object):
+    """
+    Fixed pool of grading workers which queues share by weighted fair queueing.
+
+    Every queue is charged the worker time its submissions take,
+    divided by its weight, and a free worker takes the next submission
+    of the queue charged least so far. Queues running fewer than their
+    minimum share of the workers go first, and none runs more than its
+    maximum share. A queue that was idle starts at the charge of the
+    busy ones, so idleness is not saved up for a later surge.
+
+    Pollers hand submissions to submit(), which returns once a worker
+    has taken it, so each poller fetches no faster than its queue is
+    scheduled.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.queues = {}
+        self.condition = threading.Condition()
+        self.threads = []
+        self.stopped = False
+        # charge of the last scheduled queue, for queues becoming busy
+        self.vclock = 0.0
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.workers)
+
+    def add_queue(self, name, weight=1, min_share=0, max_share=1):
+        """
+        Register a queue, or change the weight and shares of a registered
+        one; its shares are fractions of the workers.
+        """
+        if weight <= 0:
+            raise ValueError("Queue weight must be positive, got %r" % weight)
+        min_workers = int(min_share * self.workers)
+        max_workers = max(1, int(math.ceil(max_share * self.workers)))
+        with self.condition:
+            share = self.queues.get(name)
+            if share is None:
+                share = self.queues[name] = QueueShare(name, weight, min_workers, max_workers)
+            else:
+                share.weight = weight
+                share.min_workers = min_workers
+                share.max_workers = max_workers
+                share.removed = False
+                self.condition.notify_all()
+            return share
+
+    def remove_queue(self, name):
+        """
+        Unregister a queue once the submissions it has in the pool are done.
+        """
+        with self.condition:
+            share = self.queues.get(name)
+            if share is not None:
+                share.removed = True
+                self._forget(share)
+
+    def _forget(self, share):
+        if share.removed and not share.busy and self.queues.get(share.name) is share:
+            del self.queues[share.name]
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='grading-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, queue_name, func, *args):
+        """
+        Schedule func(*args) for queue_name and block until a worker
+        takes it. Return False if the scheduler was shut down first.
+        """
+        job = Job(func, args)
+        with self.condition:
+            share = self.queues.get(queue_name)
+            if share is None:
+                # removed while one of its clients was still fetching
+                share = self.add_queue(queue_name)
+                share.removed = True
+            if not share.busy:
+                share.vtime = max(share.vtime, self._busy_vtime())
+            share.pending.append(job)
+            self.condition.notify_all()
+            while not self.stopped and not job.started:
+                self.condition.wait()
+            if not job.started:
+                share.pending.remove(job)
+                self._forget(share)
+            return job.started
+
+    def _busy_vtime(self):
+        busy = [share.vtime for share in self.queues.values() if share.busy]
+        return min(busy) if busy else self.vclock
+
+    def _next_queue(self):
+        ready = [share for share in self.queues.values()
+                 if share.pending and share.running < share.max_workers]
+        if not ready:
+            return None
+        starved = [share for share in ready if share.running < share.min_workers]
+        return min(starved or ready, key=lambda share: (share.vtime, share.name))
+
+    def _work(self):
+        while True:
+            with self.condition:
+                share = None
+                while not self.stopped:
+                    share = self._next_queue()
+                    if share is not None:
+                        break
+                    self.condition.wait()
+                if share is None:
+                    return
+                job = share.pending.popleft()
+                job.started = True
+                share.running += 1
+                # charge the expected time now, so that concurrent picks see it
+                charge = share.cost / share.weight
+                share.vtime += charge
+                self.vclock = share.vtime
+                self.condition.notify_all()
+            started = time.time()
+            try:
+                job.func(*job.args)
+            except Exception as e:
+                log.exception(str(e))
+            finally:
+                elapsed = time.time() - started
+                with self.condition:
+                    share.running -= 1
+                    share.graded += 1
+                    share.vtime += elapsed / share.weight - charge
+                    share.cost += QueueShare.COST_ALPHA * (elapsed - share.cost)
+                    self._forget(share)
+                    self.condition.notify_all()
+
+    def report(self):
+        with self.condition:
+            stats = dict((share.name, {'running': share.running,
+                                       'pending': len(share.pending),
+                                       'graded': share.graded})
+                         for share in self.queues.values())
+        for name, counts in stats.items():
+            for key, value in counts.items():
+                statsd.gauge('xqueuewatcher.scheduler.' + key, value, tags=['queue:' + name])
+        log.debug('%r %r', self, stats)
+        return stats
+
+    def shutdown(self):
+        """
+        Stop scheduling; submissions not taken yet are dropped.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait, up to timeout seconds in all, for the submissions being graded.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
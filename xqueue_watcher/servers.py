@@ -0,0 +1,523 @@
+"""
+State shared by every client of one XQueue server
+"""
+import time
+import socket
+import asyncio
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+from statsd import statsd
+
+from .settings import MANAGER_CONFIG_DEFAULTS
+from .polling import QueueLengthProbe, RttEstimator
+
+log = logging.getLogger(__name__)
+
+
+class SharedHTTPAdapter(HTTPAdapter):
+    """
+    Connection pool mounted by the sessions of many clients.
+
+    Session.close() closes every mounted adapter, so the pool counts
+    the sessions using it and is only closed by the last one.
+    """
+    def __init__(self, **kwargs):
+        self.users = 0
+        self.users_lock = threading.Lock()
+        super(SharedHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        # keep idle pooled connections from being dropped by firewalls and NAT
+        pool_kwargs.setdefault('socket_options', HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        ])
+        super(SharedHTTPAdapter, self).init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+    def resize(self, maxsize):
+        """
+        Keep up to `maxsize` idle connections in pools created from now on.
+        """
+        self._pool_maxsize = maxsize
+        self.poolmanager.connection_pool_kw['maxsize'] = maxsize
+
+    def acquire(self):
+        with self.users_lock:
+            self.users += 1
+
+    def close(self):
+        with self.users_lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+        super(SharedHTTPAdapter, self).close()
+
+    def connection_counts(self):
+        """
+        Return the number of connections opened and requests sent so far.
+        """
+        connections = requests_sent = 0
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+        return connections, requests_sent
+
+
+class CircuitBreaker(object):
+    """
+    Stops every client of a server from hammering it while it is down.
+
+    After failure_threshold consecutive failures the circuit opens and
+    requests are refused locally. Once reset_timeout has passed a single
+    probe request is let through (half-open); if it succeeds the circuit
+    closes and every waiting client resumes at once, otherwise it opens
+    again. Listeners are called with (breaker, old_state, new_state) on
+    every change.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, url,
+                 failure_threshold=MANAGER_CONFIG_DEFAULTS['BREAKER_FAILURES'],
+                 reset_timeout=MANAGER_CONFIG_DEFAULTS['BREAKER_RESET_TIMEOUT']):
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.transitions = dict.fromkeys((self.CLOSED, self.OPEN, self.HALF_OPEN), 0)
+        self.listeners = []
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+        return '{}({}, {})'.format(self.__class__.__name__, self.url, self.state)
+
+    def configure(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _set_state(self, state):
+        old_state, self.state = self.state, state
+        self.transitions[state] += 1
+        if state == self.OPEN:
+            self.opened_at = time.time()
+            log.warning('XQueue server %s unavailable, pausing requests for %ss',
+                        self.url, self.reset_timeout)
+        elif state == self.CLOSED:
+            log.info('XQueue server %s available again', self.url)
+            self.condition.notify_all()
+        tags = ['server:' + self.url]
+        statsd.increment('xqueuewatcher.circuit.' + state, tags=tags)
+        statsd.gauge('xqueuewatcher.circuit-open', int(state != self.CLOSED), tags=tags)
+        for listener in self.listeners:
+            try:
+                listener(self, old_state, state)
+            except Exception:
+                log.exception('circuit listener')
+
+    def allow(self):
+        """
+        Return whether a request may be sent now.
+        """
+        with self.condition:
+            if self.state == self.CLOSED:
+                return True
+            # opened_at is also the time of the last probe, which may have
+            # died without reporting back
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # this caller sends the probe
+                self.opened_at = time.time()
+                if self.state == self.OPEN:
+                    self._set_state(self.HALF_OPEN)
+                return True
+            return False
+
+    def available(self):
+        """
+        Return whether allow() would let a request through now, without counting one.
+        """
+        with self.condition:
+            return (self.state == self.CLOSED or
+                    time.time() - self.opened_at >= self.reset_timeout)
+
+    def record_success(self):
+        with self.condition:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self.condition:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self._set_state(self.OPEN)
+
+    def wait_closed(self, timeout):
+        """
+        Block until the circuit closes or timeout passes; return whether it is closed.
+        """
+        with self.condition:
+            if self.state != self.CLOSED:
+                self.condition.wait(timeout)
+            return self.state == self.CLOSED
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the requests all clients send to a server.
+
+    The allowed rate is halved, at most once a second, when the server
+    answers with a 5xx, and grows back by `increase` requests per second
+    every second while it answers normally. Requests of the `priority`
+    kind ('poll' or 'post') get tokens before waiting ones of the other
+    kind. A rate of None disables the limiter.
+    """
+    def __init__(self, url, rate=MANAGER_CONFIG_DEFAULTS['RATE_LIMIT']):
+        self.url = url
+        self.condition = threading.Condition()
+        self.waiting = {'poll': 0, 'post': 0}
+        self.settings = None
+        self.configure(rate)
+
+    def configure(self, rate,
+                  burst=MANAGER_CONFIG_DEFAULTS['RATE_LIMIT_BURST'],
+                  priority=MANAGER_CONFIG_DEFAULTS['RATE_LIMIT_PRIORITY'],
+                  min_rate=MANAGER_CONFIG_DEFAULTS['RATE_LIMIT_MIN'],
+                  increase=MANAGER_CONFIG_DEFAULTS['RATE_LIMIT_INCREASE']):
+        """
+        Apply the settings, unless they are those already applied: a
+        reload leaves the current rate and tokens of the limiter alone.
+        """
+        if priority not in ('poll', 'post'):
+            raise ValueError("Unknown rate limit priority %r" % priority)
+        settings = (rate, burst, priority, min_rate, increase)
+        with self.condition:
+            if settings == self.settings:
+                return
+            self.settings = settings
+            self.max_rate = rate
+            self.rate = rate
+            self.burst = burst or max(1, rate or 1)
+            self.priority = priority
+            self.min_rate = min_rate
+            self.increase = increase
+            self.tokens = self.burst
+            self.updated_at = self.adjusted_at = self.decreased_at = time.time()
+            self.condition.notify_all()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, kind):
+        """
+        Block until a request of `kind` may be sent.
+        """
+        if self.max_rate is None:
+            return
+        other = 'post' if kind == 'poll' else 'poll'
+        with self.condition:
+            self.waiting[kind] += 1
+            try:
+                while True:
+                    self._refill(time.time())
+                    yielding = kind != self.priority and self.waiting[other]
+                    if self.tokens >= 1 and not yielding:
+                        self.tokens -= 1
+                        return
+                    self.condition.wait(max(1 - self.tokens, 0.01) / self.rate)
+            finally:
+                self.waiting[kind] -= 1
+                self.condition.notify_all()
+
+    async def async_acquire(self, kind):
+        """
+        Coroutine version of acquire(), for AsyncXQueueClient: it sleeps
+        on the event loop, counted among the waiters of `kind` like a
+        blocked thread.
+        """
+        if self.max_rate is None:
+            return
+        other = 'post' if kind == 'poll' else 'poll'
+        with self.condition:
+            self.waiting[kind] += 1
+        try:
+            while True:
+                with self.condition:
+                    self._refill(time.time())
+                    yielding = kind != self.priority and self.waiting[other]
+                    if self.tokens >= 1 and not yielding:
+                        self.tokens -= 1
+                        return
+                    delay = max(1 - self.tokens, 0.01) / self.rate
+                await asyncio.sleep(delay)
+        finally:
+            with self.condition:
+                self.waiting[kind] -= 1
+                self.condition.notify_all()
+
+    def record_overload(self):
+        if self.max_rate is None:
+            return
+        with self.condition:
+            now = time.time()
+            if now - self.decreased_at >= 1:
+                self._refill(now)
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.decreased_at = self.adjusted_at = now
+                log.warning('XQueue server %s overloaded, limiting requests to %.2f/s',
+                            self.url, self.rate)
+                statsd.gauge('xqueuewatcher.rate-limit', self.rate, tags=['server:' + self.url])
+
+    def record_success(self):
+        if self.max_rate is None or self.rate >= self.max_rate:
+            return
+        with self.condition:
+            now = time.time()
+            self._refill(now)
+            self.rate = min(self.max_rate, self.rate + self.increase * (now - self.adjusted_at))
+            self.adjusted_at = now
+
+
+class Authenticator(object):
+    """
+    XQueue login shared by every client that uses the same account on a server.
+
+    Clients share the session cookie through one cookie jar. Only one
+    of them logs in at a time; the others wait and reuse its session,
+    and after a failed login nobody tries again for login_poll_interval.
+    """
+    def __init__(self, login_poll_interval):
+        self.login_poll_interval = login_poll_interval
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.lock = threading.Lock()
+        # incremented on every successful login
+        self.generation = 0
+        self.logged_in = False
+        self.next_attempt = 0
+
+    def login(self, do_login, seen_generation=None):
+        """
+        Call do_login() unless the session is already valid.
+
+        A client that was redirected to the login page passes the
+        generation it made its request with; if somebody logged in
+        since then, their session is reused.
+        """
+        with self.lock:
+            if self.logged_in and seen_generation != self.generation:
+                return True
+            delay = self.next_attempt - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if do_login():
+                self.generation += 1
+                self.logged_in = True
+                self.next_attempt = 0
+            else:
+                self.logged_in = False
+                self.next_attempt = time.time() + self.login_poll_interval
+            return self.logged_in
+
+
+class AsyncAuthenticator(Authenticator):
+    """
+    Authenticator of AsyncXQueueClients, whose logins are coroutines on
+    the shared event loop. Their sessions share the aiohttp cookie jar
+    `cookies`, which the first client sets.
+    """
+    def __init__(self, login_poll_interval):
+        super(AsyncAuthenticator, self).__init__(login_poll_interval)
+        self.cookies = None
+        # an asyncio.Lock, created on the event loop
+        self.lock = None
+
+    async def login(self, do_login, seen_generation=None):
+        """
+        Coroutine version of Authenticator.login; do_login is a coroutine function.
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.logged_in and seen_generation != self.generation:
+                return True
+            delay = self.next_attempt - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if await do_login():
+                self.generation += 1
+                self.logged_in = True
+                self.next_attempt = 0
+            else:
+                self.logged_in = False
+                self.next_attempt = time.time() + self.login_poll_interval
+            return self.logged_in
+
+
+class XQueueServer(object):
+    """
+    One XQueue server and the resources its clients share.
+    """
+    # weight of the newest sample in the average response time
+    LATENCY_ALPHA = 0.2
+    # seconds after which the average is no longer trusted, so that a
+    # server every client moved away from gets measured again
+    LATENCY_MAX_AGE = 60
+
+    def __init__(self, url):
+        self.url = url
+        self.connections = 0
+        self.authenticators = {}
+        self.queue_probes = {}
+        self.rtt_estimators = {}
+        self.lock = threading.Lock()
+        self.adapter = SharedHTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+        self.breaker = CircuitBreaker(url)
+        self.rate_limiter = RateLimiter(url)
+        # moving average of response times, None until the first response
+        self.latency = None
+        self.latency_at = 0
+        # cleared when the server refuses a compressed request body
+        self.accepts_compression = True
+        self._last_counts = (0, 0, time.time())
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.url)
+
+    def reserve(self, connections):
+        """
+        Size the connection pool for `connections` more polling clients.
+        """
+        self.connections += connections
+        # one more for the result sender
+        self.adapter.resize(self.connections + 1)
+
+    def session(self):
+        """
+        Return a new session whose requests to this server go through the shared pool.
+        """
+        session = requests.session()
+        session.mount(self.url, self.adapter)
+        self.adapter.acquire()
+        return session
+
+    def authenticator(self, username, password, login_poll_interval, asynchronous=False):
+        """
+        Return the Authenticator shared by clients logging in with these
+        credentials, or the AsyncAuthenticator of asynchronous clients.
+        """
+        with self.lock:
+            key = (username, password, asynchronous)
+            if key not in self.authenticators:
+                factory = AsyncAuthenticator if asynchronous else Authenticator
+                self.authenticators[key] = factory(login_poll_interval)
+            return self.authenticators[key]
+
+    def queue_probe(self, queue_name, interval):
+        """
+        Return the QueueLengthProbe shared by the connections of queue_name.
+        """
+        with self.lock:
+            if queue_name not in self.queue_probes:
+                self.queue_probes[queue_name] = QueueLengthProbe(queue_name, interval)
+            return self.queue_probes[queue_name]
+
+    def record_latency(self, elapsed):
+        with self.lock:
+            if self.recent_latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += self.LATENCY_ALPHA * (elapsed - self.latency)
+            self.latency_at = time.time()
+
+    @property
+    def recent_latency(self):
+        """
+        Average response time, or None if nothing was measured lately.
+        """
+        if time.time() - self.latency_at > self.LATENCY_MAX_AGE:
+            return None
+        return self.latency
+
+    @property
+    def available(self):
+        return self.breaker.available()
+
+    def rtt(self, endpoint,
+            minimum=MANAGER_CONFIG_DEFAULTS['ADAPTIVE_TIMEOUT_MIN'],
+            maximum=MANAGER_CONFIG_DEFAULTS['ADAPTIVE_TIMEOUT_MAX']):
+        """
+        Return the RttEstimator shared by the clients calling endpoint.
+        """
+        with self.lock:
+            if endpoint not in self.rtt_estimators:
+                self.rtt_estimators[endpoint] = RttEstimator(minimum, maximum)
+            return self.rtt_estimators[endpoint]
+
+    def connection_stats(self):
+        """
+        Return connection counters and the rates since the previous call.
+        """
+        connections, requests_sent = self.adapter.connection_counts()
+        last_connections, last_requests, last_time = self._last_counts
+        now = time.time()
+        elapsed = max(now - last_time, 1e-6)
+        self._last_counts = (connections, requests_sent, now)
+        return {
+            'connections': connections,
+            'requests': requests_sent,
+            'reused': requests_sent - connections,
+            'new_connection_rate': (connections - last_connections) / elapsed,
+            'request_rate': (requests_sent - last_requests) / elapsed,
+        }
+
+    def report(self):
+        stats = self.connection_stats()
+        tags = ['server:' + self.url]
+        for name, value in stats.items():
+            statsd.gauge('xqueuewatcher.http.' + name.replace('_', '-'), value, tags=tags)
+        if self.latency is not None:
+            statsd.gauge('xqueuewatcher.http.latency', self.latency, tags=tags)
+        log.debug('%r %r', self, stats)
+        return stats
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def get_server(url):
+    """
+    Return the XQueueServer for url, creating it on first use.
+    """
+    with _servers_lock:
+        if url not in _servers:
+            _servers[url] = XQueueServer(url)
+        return _servers[url]
+
+
+def all_servers():
+    with _servers_lock:
+        return list(_servers.values())
+
+
+def clear_servers():
+    """
+    Forget all servers, in a forked process: their connections and locks
+    are copies of the parent's, maybe taken by its threads at the fork.
+    """
+    global _servers_lock
+    _servers_lock = threading.Lock()
+    _servers.clear()
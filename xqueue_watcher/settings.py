@@ -5,10 +5,77 @@ MANAGER_CONFIG_DEFAULTS = {
     'POLL_TIME': 10,
     'REQUESTS_TIMEOUT': 1,
     'POLL_INTERVAL': 1,
+    'POLL_BACKOFF_MAX': 10,
+    'POLL_BACKOFF_FACTOR': 2,
+    'POLL_JITTER': 0.25,
     'LOGIN_POLL_INTERVAL': 5,
-    'FOLLOW_CLIENT_REDIRECTS': False
+    'FOLLOW_CLIENT_REDIRECTS': False,
+    'ASYNC_GRADING_WORKERS': 4,
+    'PREFETCH': 0,
+    'RESULT_SPOOL_DIR': None,
+    'RESULT_RETRY_INTERVAL': 1,
+    'RESULT_RETRY_MAX': 60,
+    'RESULT_MAX_ATTEMPTS': 1000,
+    'BREAKER_FAILURES': 5,
+    'BREAKER_RESET_TIMEOUT': 30,
+    'HANDLER_CONCURRENCY': 1,
+    'HANDLER_FAILURE_POLICY': 'continue',
+    'QUEUELEN_GATING': False,
+    'QUEUELEN_INTERVAL': 1,
+    'RATE_LIMIT': None,
+    'RATE_LIMIT_BURST': None,
+    'RATE_LIMIT_PRIORITY': 'post',
+    'RATE_LIMIT_MIN': 0.5,
+    'RATE_LIMIT_INCREASE': 1,
+    'FAILOVER_LATENCY_FACTOR': 3,
+    'MAX_REPLY_SIZE': None,
+    'RESULT_COMPRESSION': False,
+    'RESULT_COMPRESS_MIN_SIZE': 1024,
+    'ENDPOINT_TIMEOUTS': {},
+    'ADAPTIVE_TIMEOUTS': False,
+    'ADAPTIVE_TIMEOUT_MIN': 0.2,
+    'ADAPTIVE_TIMEOUT_MAX': 30,
+    'RETRY_BUDGET': 0,
+    'JOURNAL_DIR': None,
+    'JOURNAL_FSYNC': 'always',
+    'JOURNAL_FSYNC_INTERVAL': 1,
+    'BATCH_SIZE': 1,
+    'GRADING_WORKERS': None,
+    'AUTOSCALE_COOLDOWN': 60,
+    'AUTOSCALE_UP_EMPTY_RATIO': 0.1,
+    'AUTOSCALE_DOWN_EMPTY_RATIO': 0.5,
+    'AUTOSCALE_UP_BUSY': 0.75,
+    'AUTOSCALE_DOWN_BUSY': 0.25,
+    'AUTOSCALE_MAX_LOAD': 1.0,
+    'RESTART_BACKOFF': 1,
+    'RESTART_BACKOFF_MAX': 60,
+    'RESTART_MAX_CRASHES': 5,
+    'RESTART_WINDOW': 300,
+    'DRAIN_TIMEOUT': 60,
+    'RELOAD_INTERVAL': None,
+    'HEALTH_INTERVAL': 5,
 }
 
+# Settings which a queue configuration in conf.d may override for itself
+QUEUE_CONFIG_OVERRIDES = (
+    'REQUESTS_TIMEOUT',
+    'POLL_INTERVAL',
+    'POLL_BACKOFF_MAX',
+    'POLL_BACKOFF_FACTOR',
+    'POLL_JITTER',
+    'LOGIN_POLL_INTERVAL',
+    'PREFETCH',
+    'HANDLER_CONCURRENCY',
+    'HANDLER_FAILURE_POLICY',
+    'QUEUELEN_GATING',
+    'QUEUELEN_INTERVAL',
+    'MAX_REPLY_SIZE',
+    'ENDPOINT_TIMEOUTS',
+    'ADAPTIVE_TIMEOUTS',
+    'RETRY_BUDGET',
+    'BATCH_SIZE',
+)
+
 
 def get_manager_config_values(app_config_path):
     if not app_config_path.exists():
@@ -19,3 +86,14 @@ def get_manager_config_values(app_config_path):
             config_key: config_tokens.get(config_key, default_config_value)
             for config_key, default_config_value in MANAGER_CONFIG_DEFAULTS.items()
         }
+
+
+def get_queue_config_values(manager_config, watcher_config):
+    """
+    Return the manager settings for one queue with its conf.d overrides applied.
+    """
+    values = manager_config.copy()
+    for config_key in QUEUE_CONFIG_OVERRIDES:
+        if config_key in watcher_config:
+            values[config_key] = watcher_config[config_key]
+    return values
@@ -0,0 +1,249 @@
+"""
+Durable delivery of graded results to XQueue
+"""
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+from .settings import MANAGER_CONFIG_DEFAULTS
+from .polling import PollBackoff
+
+log = logging.getLogger(__name__)
+
+
+class JsonLog(object):
+    """
+    Append-only file of JSON records, one per line.
+    """
+    def __init__(self, filename, fsync=True):
+        self.filename = filename
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.fd = open(filename, 'a')
+
+    def _sync(self, fd):
+        fd.flush()
+        if self.fsync:
+            os.fsync(fd.fileno())
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.fd.write(line)
+            self._sync(self.fd)
+
+    def sync(self):
+        """
+        Force appended records to disk, whatever the fsync setting.
+        """
+        with self.lock:
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+
+    def read(self):
+        """
+        Return every record in the file. A torn last line, left by a
+        crash in the middle of append(), is skipped.
+        """
+        records = []
+        with self.lock, open(self.filename) as fd:
+            for line in fd:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    log.warning('Skipping corrupt record in %s: %r', self.filename, line)
+        return records
+
+    def rewrite(self, records):
+        """
+        Atomically replace the file with `records`.
+        """
+        tmp_filename = self.filename + '.tmp'
+        with self.lock:
+            with open(tmp_filename, 'w') as fd:
+                for record in records:
+                    fd.write(json.dumps(record) + '\n')
+                self._sync(fd)
+            os.rename(tmp_filename, self.filename)
+            self.fd.close()
+            self.fd = open(self.filename, 'a')
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
+
+
+class ResultSender(threading.Thread):
+    """
+    Posts graded results for one XQueue server from an on-disk spool.
+
+    Graders hand results to submit(), which only appends them to the
+    spool, and this thread delivers them with retries. Results left in
+    the spool by a previous run are delivered again on start.
+    """
+    # rewrite the spool when everything is delivered and it has grown this long
+    COMPACT_RECORDS = 1000
+
+    def __init__(self, filename, xqueue_server,
+                 retry_interval=MANAGER_CONFIG_DEFAULTS['RESULT_RETRY_INTERVAL'],
+                 retry_max=MANAGER_CONFIG_DEFAULTS['RESULT_RETRY_MAX'],
+                 max_attempts=MANAGER_CONFIG_DEFAULTS['RESULT_MAX_ATTEMPTS']):
+        super(ResultSender, self).__init__(name='result-sender(%s)' % xqueue_server)
+        self.daemon = True
+        self.xqueue_server = xqueue_server
+        self.spool = JsonLog(filename)
+        self.backoff = PollBackoff(retry_interval, retry_max)
+        self.max_attempts = max_attempts
+        self.clients = {}
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.next_id = 0
+        self.spooled = 0
+        self.running = True
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.xqueue_server)
+
+    def register(self, client):
+        """
+        Post results of client's queue through client's session.
+        """
+        with self.condition:
+            self.clients.setdefault(client.queue_name, client)
+            self.condition.notify()
+
+    def unregister(self, client):
+        """
+        Stop posting through client, which is being shut down.
+        """
+        with self.condition:
+            if self.clients.get(client.queue_name) is client:
+                del self.clients[client.queue_name]
+
+    def submit(self, queue_name, header, result):
+        with self.condition:
+            item = {'op': 'add', 'id': self.next_id, 'queue': queue_name,
+                    'header': header, 'result': result}
+            self.next_id += 1
+            self.spool.append(item)
+            self.spooled += 1
+            self.pending.append([item, 0])
+            self.condition.notify()
+
+    def replay(self):
+        """
+        Load the results which the spool holds but XQueue never acknowledged.
+        """
+        with self.condition:
+            items = {}
+            for record in self.spool.read():
+                if record['op'] == 'add':
+                    items[record['id']] = record
+                else:
+                    items.pop(record['id'], None)
+            unsent = sorted(items.values(), key=lambda item: item['id'])
+            self.spool.rewrite(unsent)
+            self.spooled = len(unsent)
+            if unsent:
+                log.info('%r replaying %d spooled results', self, len(unsent))
+                self.next_id = max(self.next_id, unsent[-1]['id'] + 1)
+            self.pending.extendleft([item, 0] for item in reversed(unsent))
+
+    def _next_item(self):
+        with self.condition:
+            while self.running:
+                for entry in self.pending:
+                    if entry[0]['queue'] in self.clients:
+                        self.pending.remove(entry)
+                        return entry
+                self.condition.wait()
+
+    def _ack(self, item, op):
+        with self.condition:
+            self.spool.append({'op': op, 'id': item['id']})
+            self.spooled += 1
+            if not self.pending and self.spooled > self.COMPACT_RECORDS:
+                self.spool.rewrite([])
+                self.spooled = 0
+
+    def _send(self, entry):
+        item, attempts = entry
+        with self.condition:
+            client = self.clients.get(item['queue'])
+            if client is None:
+                # unregistered since _next_item; wait for another client of the queue
+                self.pending.appendleft(entry)
+                return False
+        try:
+            sent = client._send_result(item['header'], item['result'])
+        except Exception as e:
+            log.exception(str(e))
+            sent = False
+        if sent:
+            self._ack(item, 'done')
+        elif attempts + 1 >= self.max_attempts:
+            log.error('Giving up on result for %s after %d attempts: %r',
+                      item['queue'], attempts + 1, item['header'])
+            self._ack(item, 'drop')
+        else:
+            with self.condition:
+                self.pending.append([item, attempts + 1])
+        return sent
+
+    def start(self):
+        self.replay()
+        super(ResultSender, self).start()
+
+    def run(self):
+        while self.running:
+            entry = self._next_item()
+            if entry is None:
+                break
+            if self._send(entry):
+                self.backoff.reset()
+            else:
+                time.sleep(self.backoff.next_delay())
+
+    def shutdown(self):
+        """
+        Stop sending; unsent results stay in the spool for the next start.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    @property
+    def unsent(self):
+        return len(self.pending)
+
+
+_senders = {}
+_senders_lock = threading.Lock()
+
+
+def get_sender(spool_dir, xqueue_server, name=None, **kwargs):
+    """
+    Return the ResultSender for xqueue_server, creating it on first use.
+    Senders with a name have a spool of their own, e.g. for one process.
+    """
+    key = (xqueue_server, name)
+    with _senders_lock:
+        sender = _senders.get(key)
+        if sender is None or not sender.running:
+            basename = xqueue_server if name is None else '%s-%s' % (xqueue_server, name)
+            filename = os.path.join(spool_dir, re.sub(r'[^\w.-]+', '_', basename) + '.spool')
+            _senders[key] = ResultSender(filename, xqueue_server, **kwargs)
+        return _senders[key]
+
+
+def clear_senders():
+    """
+    Forget all senders, in a forked process, see servers.clear_servers().
+    """
+    global _senders_lock
+    _senders_lock = threading.Lock()
+    _senders.clear()
@@ -11,6 +11,7 @@ import pprint
 from path import path
 import logging
 import multiprocessing
+from queue import Empty
 # from statsd import statsd
 import contextlib
 import importlib.util
@@ -22,6 +23,8 @@ import inspect
 import epicbox
 from epicbox.config import DEFAULT_LIMITS
 
+from .submission import Submission
+
 static_path = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
 
 
@@ -61,6 +64,9 @@ def check_mail(params, logger):
 
 
 class StepikGrader(object):
+    # one instance may grade for all connections of a queue at once
+    thread_safe = True
+
     TECH_DIFF_MSG = "Упс.\nВозникла проблема на нашей стороне, над которой, скорей всего, мы уже " \
                     "работаем.\nСообщите номер вашего решения по адресу, указанному в курсе, и " \
                     "воздержитесь от дальнейшей отправки решений до объявления."
@@ -148,19 +154,59 @@ class StepikGrader(object):
         else:
             return self.process_item(content)
 
-    def process_item(self, content, queue=None):
+    def grade_many(self, submissions):
+        """
+        Grade a batch of submissions; return their replies in order,
+        the exception for those that could not be graded.
+
+        Submissions of the same problem share the loaded grader module,
+        the generated tests and the reference answers. With
+        fork_per_item the whole batch is graded in one process.
+        """
+        if self.fork_per_item:
+            q = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=self.process_items, args=(submissions, q))
+            proc.start()
+            while True:
+                try:
+                    replies = q.get(timeout=1)
+                    break
+                except Empty:
+                    # the replies are in the queue before the process exits
+                    if not proc.is_alive() and q.empty():
+                        raise RuntimeError("Grading process exited with code %s without replying"
+                                           % proc.exitcode)
+            proc.join()
+            return replies
+        else:
+            return self.process_items(submissions)
+
+    def process_items(self, submissions, queue=None):
+        shared = {}
+        replies = []
+        for content in submissions:
+            try:
+                replies.append(self.process_item(content, shared=shared))
+            except Exception as e:
+                # logged by process_item
+                replies.append(e)
+        if queue:
+            queue.put(replies)
+        return replies
+
+    def process_item(self, content, queue=None, shared=None):
         grader_path, body = None, None
         try:
             # statsd.increment('xqueuewatcher.process-item')
-            body = content['xqueue_body']
-            # files = content.get('xqueue_files', {})
+            submission = Submission.wrap(content)
+            # files = submission.get('xqueue_files', {})
             # {"<FILENAME>": "https://stepik.org/media/submissions/.../foobar.py"}
 
-            body = json.loads(body)
-            student_response = body['student_response']
-            payload = body['grader_payload']
+            body = submission.body
+            student_response = submission.student_response
+            payload = submission.grader_payload
             try:
-                grader_config = json.loads(payload)
+                grader_config = submission.grader_config
             except ValueError as err:
                 # statsd.increment('xqueuewatcher.grader_payload_error')
                 self.log.debug("error parsing: '{0}' -- {1}".format(payload, err))
@@ -174,7 +220,7 @@ class StepikGrader(object):
             # start = time.time()
             task_type = grader_config.get("type", "code")
             if task_type == "code":
-                results = self.grade(grader_path, grader_config, student_response)
+                results = self.grade(grader_path, grader_config, student_response, shared)
             elif task_type == "server":
                 results = self.grade_server(grader_path, grader_config, student_response)
             else:
@@ -217,25 +263,43 @@ class StepikGrader(object):
         else:
             return "Good job!"
 
-    def grade(self, grader_path, grader_config, student_response):
-        try:
-            grader = load_module("grader", grader_path)
-
-            limits = DEFAULT_LIMITS.copy()
-            own_limits = grader_config.get("limits", None)
-            if own_limits is not None:
-                limits.update(own_limits)
+    def prepare(self, grader_path, grader_config):
+        """
+        Load the grader and generate its tests; return (grader, limits,
+        tests, answers), answers caching grader.solve() by test.
+        """
+        grader = load_module("grader", grader_path)
+
+        limits = DEFAULT_LIMITS.copy()
+        own_limits = grader_config.get("limits", None)
+        if own_limits is not None:
+            limits.update(own_limits)
+
+        test_data = grader.generate()
+        if isinstance(test_data, (str, tuple)):
+            test_data = [test_data]
+            suite_size = grader_config.get("SUITE_SIZE", 20)
+            for i in range(suite_size - 1):
+                test_data.append(grader.generate())
+        elif isinstance(test_data, list):
+            pass  # all right!
+        else:
+            raise AssertionError(f"{grader_path}: generate() must return a list or at least a single test!")
+        return grader, limits, test_data, {}
 
-            test_data = grader.generate()
-            if isinstance(test_data, (str, tuple)):
-                test_data = [test_data]
-                suite_size = grader_config.get("SUITE_SIZE", 20)
-                for i in range(suite_size - 1):
-                    test_data.append(grader.generate())
-            elif isinstance(test_data, list):
-                pass  # all right!
+    def grade(self, grader_path, grader_config, student_response, shared=None):
+        """
+        shared, if given, keeps what prepare() returned for the other
+        submissions of a batch.
+        """
+        try:
+            if shared is None:
+                grader, limits, test_data, answers = self.prepare(grader_path, grader_config)
             else:
-                raise AssertionError(f"{grader_path}: generate() must return a list or at least a single test!")
+                key = (grader_path, json.dumps(grader_config, sort_keys=True))
+                if key not in shared:
+                    shared[key] = self.prepare(grader_path, grader_config)
+                grader, limits, test_data, answers = shared[key]
 
             files = [{'name': 'main.py', 'content': student_response.encode()}]
             rates = []
@@ -273,7 +337,9 @@ class StepikGrader(object):
                         stdout_text = stdout_raw.decode("utf-8").strip()
 
                     if must_solve:
-                        clue = grader.solve(test)
+                        if test not in answers:
+                            answers[test] = grader.solve(test)
+                        clue = answers[test]
 
                     rate = grader.check(stdout_text, clue)
 
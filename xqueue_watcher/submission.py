@@ -0,0 +1,83 @@
+"""
+XQueue submission envelope
+"""
+import json
+from collections.abc import Mapping
+
+
+class Submission(Mapping):
+    """
+    Submission as returned by get_submission, decoded lazily.
+
+    XQueue nests JSON in JSON: the envelope holds `xqueue_body`, which
+    holds `grader_payload`. Each layer is decoded once, on first access,
+    and cached. Item access reads the envelope, so handlers written for
+    the plain dict keep working:
+
+        submission['xqueue_header']
+        submission.student_response
+        submission.grader_config
+    """
+    __slots__ = ('_raw', '_envelope', '_body', '_grader_config')
+
+    def __init__(self, raw=None, envelope=None):
+        self._raw = raw
+        self._envelope = envelope
+        self._body = None
+        self._grader_config = None
+
+    @classmethod
+    def wrap(cls, content):
+        """
+        Return content as a Submission; content may be one already,
+        the envelope dict or its JSON text.
+        """
+        if isinstance(content, cls):
+            return content
+        if isinstance(content, (str, bytes)):
+            return cls(raw=content)
+        return cls(envelope=content)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.envelope.get('xqueue_header'))
+
+    @property
+    def envelope(self):
+        if self._envelope is None:
+            self._envelope = json.loads(self._raw)
+            self._raw = None
+        return self._envelope
+
+    def __getitem__(self, key):
+        return self.envelope[key]
+
+    def __iter__(self):
+        return iter(self.envelope)
+
+    def __len__(self):
+        return len(self.envelope)
+
+    @property
+    def header(self):
+        return self.envelope['xqueue_header']
+
+    @property
+    def body(self):
+        if self._body is None:
+            body = self.envelope['xqueue_body']
+            self._body = json.loads(body) if isinstance(body, (str, bytes)) else body
+        return self._body
+
+    @property
+    def student_response(self):
+        return self.body['student_response']
+
+    @property
+    def grader_payload(self):
+        return self.body['grader_payload']
+
+    @property
+    def grader_config(self):
+        if self._grader_config is None:
+            self._grader_config = json.loads(self.grader_payload)
+        return self._grader_config
@@ -0,0 +1,63 @@
+"""
+Restarting clients that exited unexpectedly
+"""
+import time
+import logging
+from collections import Counter, deque
+
+from statsd import statsd
+
+from .polling import PollBackoff
+from .settings import MANAGER_CONFIG_DEFAULTS
+
+log = logging.getLogger(__name__)
+
+
+class Supervisor(object):
+    """
+    Decides when the crashed clients of a queue are restarted.
+
+    A queue's first crash is restarted after `backoff` seconds and every
+    further one waits twice as long, up to `backoff_max`. Once a queue
+    crashed more than `max_crashes` times within `window` seconds it is
+    in a crash loop, and crashed() returns None to give up.
+    """
+    def __init__(self,
+                 backoff=MANAGER_CONFIG_DEFAULTS['RESTART_BACKOFF'],
+                 backoff_max=MANAGER_CONFIG_DEFAULTS['RESTART_BACKOFF_MAX'],
+                 max_crashes=MANAGER_CONFIG_DEFAULTS['RESTART_MAX_CRASHES'],
+                 window=MANAGER_CONFIG_DEFAULTS['RESTART_WINDOW']):
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.max_crashes = max_crashes
+        self.window = window
+        # queue name -> times of its crashes within the window
+        self.crashes = {}
+        self.backoffs = {}
+        # queue name -> how many of its clients were restarted
+        self.restarts = Counter()
+
+    def __repr__(self):
+        return '{}({} crashes in {}s)'.format(self.__class__.__name__, self.max_crashes, self.window)
+
+    def crashed(self, queue_name, now=None):
+        """
+        Record a crash of a client of queue_name. Return the seconds to
+        wait before restarting it, or None if the queue is crash looping.
+        """
+        now = time.time() if now is None else now
+        crashes = self.crashes.setdefault(queue_name, deque())
+        while crashes and now - crashes[0] > self.window:
+            crashes.popleft()
+        if not crashes:
+            self.backoffs[queue_name] = PollBackoff(self.backoff, self.backoff_max, jitter=0)
+        crashes.append(now)
+        statsd.increment('xqueuewatcher.client-crash', tags=['queue:' + queue_name])
+        if len(crashes) > self.max_crashes:
+            log.error('%s crashed %d times in %ds', queue_name, len(crashes), self.window)
+            return None
+        return self.backoffs[queue_name].next_delay()
+
+    def restarted(self, queue_name):
+        self.restarts[queue_name] += 1
+        statsd.increment('xqueuewatcher.client-restart', tags=['queue:' + queue_name])
@@ -0,0 +1,190 @@
+"""
+Worker processes running several client threads of one queue
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+
+from . import servers, spool, journal
+
+log = logging.getLogger(__name__)
+
+
+class WorkerProcess(multiprocessing.Process):
+    """
+    Process running `threads` client threads of one queue.
+
+    The thread safe handlers are built once in the process and shared
+    by its threads, which also share one connection pool per server, so a
+    queue can use several cores without a process per connection. With
+    RESULT_SPOOL_DIR the process posts its results from a spool of its
+    own, named like its journal.
+    Every `health_interval` seconds the process sends the manager a
+    report of its threads and submissions in flight, see read_health().
+    If one of its threads dies the process exits, to be restarted, and
+    if one stalls the manager terminates it.
+
+    In the manager, a WorkerProcess stands in for a client: it drains
+    on SIGTERM and has the in_flight of its last report.
+    """
+    # missed reports after which the process is taken for hung
+    HEALTH_MISSED = 3
+
+    def __init__(self, manager, queue_name, index, threads, health_interval=5):
+        multiprocessing.Process.__init__(self, name='%s-worker-%d' % (queue_name, index))
+        self.manager = manager
+        self.queue_name = queue_name
+        self.index = index
+        self.threads = threads
+        self.health_interval = health_interval
+        self.running = True
+        # the clients are in the process, these are for the manager
+        self.result_sender = None
+        self.journal = None
+        self.scheduler = None
+        self.queue_probe = None
+        self.siblings = []
+        self.on_exit = None
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.health = None
+        self.health_at = time.time()
+        self.health_reader, self.health_writer = multiprocessing.Pipe(duplex=False)
+        self.health_lock = threading.Lock()
+
+    def __repr__(self):
+        return '{}({}, {}x{})'.format(self.__class__.__name__, self.queue_name, self.index, self.threads)
+
+    def _make_clients(self):
+        manager = self.manager
+        config = manager.queue_configs[self.queue_name]
+        # the thread safe handlers, built once in this process
+        shared = {}
+        journal_name = '%s-%d' % (self.queue_name, self.index)
+        clients = []
+        for i in range(self.threads):
+            client_config = manager.client_config(self.queue_name, self.index * self.threads + i)
+            clients.append(manager.client_from_config(self.queue_name, client_config,
+                                                      handlers=manager.build_handlers(config, shared),
+                                                      journal_name=journal_name,
+                                                      spool_name=journal_name))
+        return clients
+
+    def _stalled(self, client):
+        # its loop did not go round for as long as the manager waits for
+        # a report, while it was neither grading nor sleeping on purpose
+        limit = time.time() - self.HEALTH_MISSED * self.health_interval
+        return (client.is_alive() and not client.processing and not client.in_flight
+                and max(client.turned_at, client.idle_until) < limit)
+
+    def _report(self, clients):
+        in_flight = []
+        for client in clients:
+            with client.in_flight_lock:
+                in_flight.extend(client.in_flight)
+        report = {
+            'pid': os.getpid(),
+            'threads': sum(1 for client in clients if client.is_alive()),
+            'stalled': sum(1 for client in clients if self._stalled(client)),
+            'polls': sum(client.polls for client in clients),
+            'empty_polls': sum(client.empty_polls for client in clients),
+            'graded': sum(client.graded for client in clients),
+            'grading_time': sum(client.grading_time for client in clients),
+            'in_flight': in_flight,
+        }
+        with self.health_lock:
+            self.health_writer.send(report)
+
+    def _report_loop(self, clients, stopped):
+        while not stopped.wait(self.health_interval):
+            self._report(clients)
+
+    def _reset(self):
+        # forked from the manager's threads: start over from registries of
+        # this process, with the servers configured for its own threads
+        servers.clear_servers()
+        spool.clear_senders()
+        journal.clear_journals()
+        config = self.manager.queue_configs[self.queue_name]
+        self.manager.configure_server(config.get('SERVER', 'http://localhost:18040'), self.threads)
+
+    def run(self):
+        self.health_reader.close()
+        self._reset()
+        clients = []
+        # report from the start, building the handlers may take a while
+        stopped = threading.Event()
+        reporter = threading.Thread(target=self._report_loop, args=(clients, stopped),
+                                    name='%s-health' % self.name)
+        reporter.daemon = True
+        reporter.start()
+
+        def drain(signum, frame):
+            self.running = False
+            for client in clients:
+                client.drain()
+        signal.signal(signal.SIGTERM, drain)
+
+        self._report(clients)
+        clients.extend(self._make_clients())
+        senders = []
+        for client in clients:
+            if client.result_sender is not None and client.result_sender not in senders:
+                senders.append(client.result_sender)
+        for sender in senders:
+            sender.start()
+        for client in clients:
+            if self.running:
+                client.start()
+        crashed = False
+        while any(client.is_alive() for client in clients):
+            if self.running and not all(client.is_alive() for client in clients):
+                log.error('%r lost a client thread, exiting', self)
+                crashed = True
+                drain(None, None)
+            deadline = time.time() + self.health_interval
+            for client in clients:
+                client.join(max(0, deadline - time.time()))
+        stopped.set()
+        reporter.join()
+        self._report(clients)
+        for client in clients:
+            client.shutdown()
+        for sender in senders:
+            # unsent results stay in the spool for the next process
+            sender.shutdown()
+        if crashed:
+            sys.exit(1)
+
+    def read_health(self):
+        """
+        Take in the reports sent since the last call; return the latest.
+        """
+        try:
+            while self.health_reader.poll():
+                self.health = self.health_reader.recv()
+                self.health_at = time.time()
+        except (EOFError, OSError):
+            pass
+        if self.health is not None:
+            with self.in_flight_lock:
+                self.in_flight = dict.fromkeys(self.health['in_flight'])
+        return self.health
+
+    @property
+    def healthy(self):
+        if self.health is not None and self.health.get('stalled'):
+            return False
+        return time.time() - self.health_at < self.HEALTH_MISSED * self.health_interval
+
+    def drain(self):
+        self.running = False
+        if self.pid is not None and self.is_alive():
+            os.kill(self.pid, signal.SIGTERM)
+
+    def shutdown(self):
+        self.running = False